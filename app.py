@@ -5,38 +5,253 @@ import os
 import hmac
 import re
 import hashlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from flask import Flask, request, jsonify
-from components.twilio_component import TwilioManager
-from components.openai_component import OpenAIManager
+from components.twilio_component import TwilioManager, MessageDispatcher, DeliveryTracker, PRIORIDAD_CAMPANA
+from components.openai_component import OpenAIManager, CAMPOS_REQUERIDOS_INTENCION
 from components.calendar_component import GoogleCalendarManager
+from components.calendar_sync_component import CalendarSyncManager
 from components.database_mongodb_component import DataBaseMongoDBManager
 from components.database_mysql_component import DataBaseMySQLManager
 from components.leader_csv_component import LeadManager
 from components.zoho_component import ZohoCRMManager
-from helpers.helpers import format_number, extraer_json,json_a_lista
+from components.context_component import ConversationContextManager
+from components.intent_classifier_component import LocalIntentClassifier
+from components.faq_cache_component import FAQAnswerCache
+from components.campaign_component import LeadCampaignGenerator
+from components.speculation_component import SpeculativeExecutor
+from components.booking_component import BookingManager
+from components.registry_component import ComponentRegistry
+from helpers.helpers import format_number, extraer_json,json_a_lista, limpiar_respuesta
 from api_keys.api_keys import client_id_zoho, client_secret_zoho, refresh_token_zoho
 #from components.payments_component import CulqiManager
 
 app = Flask(__name__)
 
 # Inicializar Componentes
-twilio = TwilioManager()
-openai = OpenAIManager()
-calendar = GoogleCalendarManager()
-dbMongoManager = DataBaseMongoDBManager()
-dbMySQLManager = DataBaseMySQLManager()
-leaderManager = LeadManager("leads/Leads_Prueba.csv")
-zoho_manager = ZohoCRMManager(client_id_zoho, client_secret_zoho, 'http://localhost', refresh_token_zoho)
+# Los componentes que se conectan a servicios externos se registran con inicialización diferida: se
+# construyen en paralelo en segundo plano (o en su primer uso) y la app atiende /health de inmediato
+componentes = ComponentRegistry()
+
+def crear_espejo_calendario():
+    """Espejo local del calendario (sincronización incremental): las consultas de horarios no esperan a Google."""
+    if os.getenv("CALENDARIO_ESPEJO", "1") != "1":
+        return None
+    espejo = CalendarSyncManager.desde_entorno(calendar.service, calendar.CALENDAR_ID)
+    calendar.usar_espejo(espejo)
+    espejo.iniciar()
+    if os.getenv("CALENDARIO_WEBHOOK_URL"):
+        try:
+            espejo.suscribir(os.getenv("CALENDARIO_WEBHOOK_URL"), os.getenv("CALENDARIO_WEBHOOK_TOKEN", ""))
+        except Exception as e:
+            print("No se pudo registrar el canal de notificaciones de Calendar:", e)
+    return espejo
+
+twilio = componentes.registrar("twilio", TwilioManager)
+# Cola persistente de mensajes salientes: limita la tasa por número y reintenta los errores transitorios
+entregas = componentes.registrar("entregas", DeliveryTracker.desde_entorno)
+despachador = componentes.registrar("despachador", lambda: MessageDispatcher.desde_entorno(twilio, entregas).iniciar())
+openai = componentes.registrar("openai", OpenAIManager)
+calendar = componentes.registrar("calendar", GoogleCalendarManager)
+espejo_calendario = componentes.registrar("espejo_calendario", crear_espejo_calendario)
+dbMongoManager = componentes.registrar("mongodb", DataBaseMongoDBManager)
+dbMySQLManager = componentes.registrar("mysql", DataBaseMySQLManager)
+leaderManager = componentes.registrar("leads_csv", lambda: LeadManager("leads/Leads_Prueba.csv"))
+zoho_manager = componentes.registrar(
+    "zoho", lambda: ZohoCRMManager(client_id_zoho, client_secret_zoho, 'http://localhost', refresh_token_zoho)
+)
+reservas = componentes.registrar("reservas", lambda: BookingManager(calendar, dbMongoManager))
+# Componentes locales: solo guardan referencias a los anteriores y se crean al importar
+contexto = ConversationContextManager(openai, dbMongoManager)
+clasificador_local = LocalIntentClassifier()
+cache_faq = FAQAnswerCache()
+campana = LeadCampaignGenerator.desde_entorno(openai, dbMongoManager)
+especulaciones = SpeculativeExecutor()
+componentes.calentar()
+# Lecturas independientes de cada turno (MySQL, MongoDB, calendario) que se lanzan en paralelo
+ejecutor_turnos = ThreadPoolExecutor(max_workers=int(os.getenv("CHATBOT_HILOS_TURNO", "16")), thread_name_prefix="turno")
+# Escrituras que no afectan la respuesta y se hacen después del envío
+ejecutor_posterior = ThreadPoolExecutor(max_workers=int(os.getenv("CHATBOT_HILOS_POSTERIOR", "4")), thread_name_prefix="posterior")
 #culqi = CulqiManager()
 
 # Diccionario para almacenar temporizadores activos por cliente
 timers = {}
 
-# Función para enviar la respuesta al cliente después del retardo
-def enviar_respuesta(cliente, cliente_nuevo):
-    print("Enviando respuesta a:", cliente["celular"])
+# Modo de llamada única: la intención y el borrador de respuesta se obtienen en la misma llamada al modelo
+LLAMADA_UNICA = os.getenv("CHATBOT_LLAMADA_UNICA", "1") == "1"
+
+# Streaming: la respuesta se envía en cuanto el modelo completa el campo "mensaje" del JSON
+STREAMING = os.getenv("CHATBOT_STREAMING", "1") == "1"
+# Intenciones que se responden sin datos de herramientas (calendario, reservas, pagos)
+INTENCIONES_SIN_HERRAMIENTAS = (1, 5, 6)
+
+# Próximos horarios que se ofrecen cuando el cliente no indica fecha o la fecha pedida está llena
+HORARIOS_A_OFRECER = int(os.getenv("CHATBOT_HORARIOS_A_OFRECER", "3"))
+DURACION_CITA_MINUTOS = 30
+
+# Datos que necesita cada intención para ejecutar su acción: fecha y hora (3), nombre (5), categoría y detalle (6)
+DATOS_REQUERIDOS_INTENCION = {3: 1, 5: 1, 6: 2}
+
+def intencion_con_datos(intencion_list):
+    """Indica si la intención trae los datos no vacíos que necesita su acción."""
+    datos = [valor for valor in intencion_list[1:] if str(valor).strip()]
+    return len(datos) >= DATOS_REQUERIDOS_INTENCION.get(intencion_list[0], 0)
+
+# Modo especulativo: durante la espera de 2 s se cargan los datos del cliente y se clasifica el turno
+ESPECULATIVO = os.getenv("CHATBOT_ESPECULATIVO", "1") == "1"
+
+class EnvioAnticipado:
+    """
+    Envía la respuesta por Twilio en cuanto el parser incremental completa el campo "mensaje",
+    sin esperar a que el modelo termine el resto de la salida.
+    """
+
+    def __init__(self, celular):
+        self.celular = celular
+        self.intencion = None
+        self.mensaje = None
+        self._envio = None
+        self._campos = {}
+
+    @property
+    def enviado(self):
+        return self._envio is not None
+
+    def _enviar(self, mensaje):
+        self.mensaje = limpiar_respuesta(mensaje)
+        print("Envío anticipado a:", self.celular)
+        self._envio = despachador.encolar(self.celular, self.mensaje)
+
+    def al_campo_borrador(self, campo, valor):
+        """Callback de clasificar_y_responder: envía el borrador solo si la intención no necesita herramientas."""
+        self._campos[campo] = valor
+        if campo == "intencion":
+            self.intencion = valor
+        elif campo == "detalle" and self.intencion not in INTENCIONES_SIN_HERRAMIENTAS:
+            # Las intenciones 2, 3 y 4 no usan el borrador: se corta el stream para despacharlas cuanto antes
+            return True
+        elif campo == "mensaje" and self.intencion in INTENCIONES_SIN_HERRAMIENTAS and not self.enviado:
+            # Sin los campos requeridos clasificar_y_responder reclasifica y la respuesta puede ser otra:
+            # el borrador no se envía
+            requeridos = CAMPOS_REQUERIDOS_INTENCION.get(self.intencion, ())
+            if all(self._campos.get(requerido) not in ("", None) for requerido in requeridos):
+                self._enviar(valor)
+        return False
+
+    def al_campo_respuesta(self, campo, valor):
+        """Callback de las consultas de respuesta: envía el mensaje apenas está completo."""
+        if campo == "mensaje" and not self.enviado:
+            self._enviar(valor)
+        return False
+
+    def esperar(self):
+        """Devuelve el mensaje enviado; el envío en sí lo completa la cola de mensajes salientes."""
+        return self.mensaje
+
+def respuesta_desde_borrador(borrador, cliente_mysql, conversation_actual, conversation_history, al_campo=None):
+    """Usa el borrador de la llamada única como respuesta; sin borrador, genera la respuesta con consulta."""
+    if borrador:
+        return json.dumps({"mensaje": borrador}, ensure_ascii=False)
+    return openai.consulta(cliente_mysql, conversation_actual, conversation_history, al_campo=al_campo)
+
+def clasificar_turno(cliente_mysql, conversation_actual, conversation_history, envio=None):
+    """
+    Determina la intención del turno: primero con el clasificador local y, si no es concluyente, con el LLM.
+    Devuelve la intención (formato de prompt_intencionesv2) y el borrador de respuesta, si lo hay.
+    """
+    try:
+        resultado_local, confianza = clasificador_local.clasificar(conversation_actual)
+    except Exception as e:
+        # Una regla que falla no debe dejar al cliente sin respuesta: decide el LLM
+        print(f"Error en el clasificador local: {e}")
+        resultado_local, confianza = None, 0.0
+    if clasificador_local.decidir(resultado_local, confianza):
+        print("Intención resuelta por el clasificador local:", resultado_local)
+        return dict(resultado_local), None
+
+    # Preguntas frecuentes ya respondidas para el mismo estado y el mismo mensaje previo del asesor: se reutiliza
+    # la respuesta sin llamar al modelo
+    respuesta_cacheada = cache_faq.buscar(conversation_actual, cliente_mysql["estado"], cliente_mysql["nombre"])
+    if respuesta_cacheada:
+        # La marca evita volver a guardar la respuesta, lo que renovaría su TTL en cada acierto
+        return {"intencion": 1, "desde_cache_faq": True}, respuesta_cacheada
+
+    # En modo de llamada única, las intenciones 1, 5 y 6 se responden con el borrador sin una segunda llamada
+    borrador = None
+    intencion = None
+    if LLAMADA_UNICA:
+        intencion = openai.clasificar_y_responder(cliente_mysql, conversation_actual, conversation_history,
+                                                  al_campo=envio.al_campo_borrador if envio else None)
+        if intencion:
+            borrador = intencion.pop("mensaje", None)
+    if not intencion:
+        intencion = openai.clasificar_intencion(conversation_actual, conversation_history)
+        print("Intención detectada antes extraer json:", intencion)
+        intencion = extraer_json(intencion)
+    clasificador_local.registrar_comparacion(resultado_local, confianza, intencion)
+    return intencion, borrador
+
+def horarios_para_ofrecer(fecha):
+    """
+    Horarios de la intención 2: los libres de la fecha pedida o, si no hay fecha válida o ese día no queda
+    espacio, los próximos inicios libres de los días siguientes (una sola consulta free/busy).
+    """
+    if fecha:
+        try:
+            horarios = calendar.listar_horarios_disponibles(fecha)
+            if horarios:
+                return horarios
+            print(f"Sin horarios disponibles el {fecha}; se ofrecen los próximos")
+        except ValueError:
+            print("Fecha de la cita no válida:", fecha)
+    return [calendar.describir_horario(inicio)
+            for inicio in calendar.proximos_horarios(n=HORARIOS_A_OFRECER, duracion_minutos=DURACION_CITA_MINUTOS)]
+
+def preparar_turno(celular, version):
+    """
+    Trabajo especulativo de un turno: carga los datos del cliente y la conversación y clasifica la intención.
+    Se abandona si llega un mensaje más nuevo antes de la llamada al modelo.
+    """
+    futuro_conversacion = ejecutor_turnos.submit(dbMongoManager.obtener_conversacion_actual, celular)
+    futuro_historial = ejecutor_turnos.submit(dbMongoManager.obtener_historial_conversaciones, celular)
+    cliente_id_mysql = dbMySQLManager.obtener_id_cliente_por_celular(celular)
+    if not cliente_id_mysql:
+        return None
+    openai.metricas.etiquetar(cliente_id=cliente_id_mysql)
+    cliente_mysql = dbMySQLManager.obtener_cliente(cliente_id_mysql)
+    conversacion_completa = futuro_conversacion.result()
+    conversation_history = futuro_historial.result()
+    if not especulaciones.vigente(celular, version):
+        return None
+    conversation_actual = contexto.preparar(conversacion_completa)
+    # Sin envío anticipado: si llega otro mensaje, el borrador se descarta sin haber salido
+    intencion, borrador = clasificar_turno(cliente_mysql, conversation_actual, conversation_history)
+    return {
+        "cliente_id_mysql": cliente_id_mysql,
+        "cliente_mysql": cliente_mysql,
+        "conversacion_completa": conversacion_completa,
+        "conversation_actual": conversation_actual,
+        "conversation_history": conversation_history,
+        "intencion": intencion,
+        "borrador": borrador,
+    }
 
+def en_segundo_plano(funcion, *args):
+    """Ejecuta `funcion` fuera del camino de la respuesta, con las etiquetas de métricas del hilo actual."""
+    def _registrar_error(futuro):
+        if futuro.exception():
+            print(f"Error en la tarea en segundo plano {funcion.__name__}:", futuro.exception())
+    futuro = ejecutor_posterior.submit(contextvars.copy_context().run, funcion, *args)
+    futuro.add_done_callback(_registrar_error)
+    return futuro
+
+def cargar_cliente_mysql(cliente, especulacion):
+    """
+    Etapa MySQL del turno: obtiene o crea el cliente y su conversación activa.
+    Devuelve (cliente_id_mysql, cliente_mysql, conversacion_id_mysql); cliente_mysql se reutiliza de la especulación.
+    """
     # Obtener o crear cliente en MySQL
     cliente_id_mysql = dbMySQLManager.insertar_cliente(
         documento_identidad=None,
@@ -45,11 +260,12 @@ def enviar_respuesta(cliente, cliente_nuevo):
         apellido="",
         celular=cliente["celular"],
         email= cliente.get("email", None) or None
-    )    
+    )
     # Obtener cliente por id
-    cliente_mysql = dbMySQLManager.obtener_cliente(cliente_id_mysql)
-    estado_actual = cliente_mysql['estado']
-    dbMySQLManager.actualizar_fecha_ultima_interaccion(cliente_id_mysql, datetime.now())
+    if especulacion and especulacion["cliente_id_mysql"] == cliente_id_mysql:
+        cliente_mysql = especulacion["cliente_mysql"]
+    else:
+        cliente_mysql = dbMySQLManager.obtener_cliente(cliente_id_mysql)
     # Verificar si existe una conversación activa en MySQL para el cliente
     conversacion_mysql = dbMySQLManager.obtener_conversacion_activa(cliente_id_mysql)
     if not conversacion_mysql:
@@ -63,26 +279,78 @@ def enviar_respuesta(cliente, cliente_nuevo):
         )
     else:
         conversacion_id_mysql = conversacion_mysql["conversacion_id"]
+    return cliente_id_mysql, cliente_mysql, conversacion_id_mysql
+
+def registrar_respuesta(celular, cliente_id_mysql, conversacion_completa, response_message):
+    """Escrituras posteriores al envío: respuesta en MongoDB, fecha en MySQL y compactación del contexto."""
+    interacciones = (conversacion_completa or {}).get("interacciones", [])
+    if interacciones:
+        # Se escribe en la interacción respondida aunque el cliente ya haya abierto otra
+        dbMongoManager.guardar_respuesta_interaccion_chatbot(
+            celular, conversacion_completa["conversacion_id"], len(interacciones) - 1, response_message
+        )
+    else:
+        dbMongoManager.guardar_respuesta_ultima_interaccion_chatbot(celular, response_message)
+    dbMySQLManager.actualizar_fecha_ultima_interaccion_bot(cliente_id_mysql, datetime.now())
+    # Plegar en el resumen los turnos que salieron de la ventana
+    contexto.compactar(celular, conversacion_completa)
+
+# Función para enviar la respuesta al cliente después del retardo
+def enviar_respuesta(cliente, cliente_nuevo, version=None):
+    print("Enviando respuesta a:", cliente["celular"])
 
+    # Resultado del trabajo especulativo, si no llegó otro mensaje después de iniciarlo
+    especulacion = especulaciones.tomar(cliente["celular"], version) if version is not None else None
 
-    # Obtener la conversación actual del cliente
-    conversation_actual = dbMongoManager.obtener_conversacion_actual(cliente["celular"])
+    # Etapa 1: MySQL y MongoDB son independientes entre sí; sin especulación, las lecturas de MongoDB
+    # corren mientras se resuelve el cliente en MySQL
+    futuro_mysql = ejecutor_turnos.submit(cargar_cliente_mysql, cliente, especulacion)
+    if not especulacion:
+        futuro_conversacion = ejecutor_turnos.submit(dbMongoManager.obtener_conversacion_actual, cliente["celular"])
+        futuro_historial = ejecutor_turnos.submit(dbMongoManager.obtener_historial_conversaciones, cliente["celular"])
+    cliente_id_mysql, cliente_mysql, conversacion_id_mysql = futuro_mysql.result()
+    estado_actual = cliente_mysql['estado']
+    # Las llamadas al modelo de este hilo se atribuyen al cliente en las métricas
+    openai.metricas.etiquetar(cliente_id=cliente_id_mysql)
+    en_segundo_plano(dbMySQLManager.actualizar_fecha_ultima_interaccion, cliente_id_mysql, datetime.now())
+    if especulacion and especulacion["cliente_id_mysql"] != cliente_id_mysql:
+        especulacion = None
+        futuro_conversacion = ejecutor_turnos.submit(dbMongoManager.obtener_conversacion_actual, cliente["celular"])
+        futuro_historial = ejecutor_turnos.submit(dbMongoManager.obtener_historial_conversaciones, cliente["celular"])
+
+    envio = EnvioAnticipado(cliente["celular"]) if STREAMING else None
+    al_campo = envio.al_campo_respuesta if envio else None
+    if especulacion:
+        print("Se reutiliza el turno preparado durante la espera para:", cliente["celular"])
+        conversacion_completa = especulacion["conversacion_completa"]
+        conversation_actual = especulacion["conversation_actual"]
+        conversation_history = especulacion["conversation_history"]
+        intencion, borrador = especulacion["intencion"], especulacion["borrador"]
+    else:
+        # Obtener la conversación actual del cliente
+        conversacion_completa = futuro_conversacion.result()
+        # A los prompts solo van el resumen y los turnos recientes que caben en el presupuesto de tokens
+        conversation_actual = contexto.preparar(conversacion_completa)
 
-    # Obtener el historial de conversaciones del cliente en caso tenga
-    conversation_history = dbMongoManager.obtener_historial_conversaciones(cliente["celular"])
+        # Obtener el historial de conversaciones del cliente en caso tenga
+        conversation_history = futuro_historial.result()
 
-    # Hacemos un mapeo de intenciones para determinar si el chatbot necesita algo específico
-    # como agendar, pagar, horarios disponibles
-    intencion = openai.clasificar_intencion(conversation_actual, conversation_history)
-    print("Intención detectada antes extraer json:", intencion)
-    intencion = extraer_json(intencion)
+        # Etapa 2: hacemos un mapeo de intenciones para determinar si el chatbot necesita algo específico
+        # como agendar, pagar, horarios disponibles
+        intencion, borrador = clasificar_turno(cliente_mysql, conversation_actual, conversation_history, envio)
     print("Intención detectada:", intencion)
     # Generamos un mensaje de respuesta
     print("Cliente mysql", cliente_mysql)
     #intencion_list = intencion.split(")")
+    desde_cache_faq = intencion.pop("desde_cache_faq", False)
     intencion_list = json_a_lista(intencion)
     print("Intencion lista: ", intencion_list)
-    if intencion_list[0] == 1:
+    openai.metricas.etiquetar(intencion=intencion_list[0])
+    if not intencion_con_datos(intencion_list):
+        # Falta la fecha, el nombre o la causa: se responde la conversación sin ejecutar la acción
+        print("Intención sin los datos que necesita, se responde sin ejecutar la acción:", intencion_list)
+        response_message = respuesta_desde_borrador(borrador, cliente_mysql, conversation_actual, conversation_history, al_campo)
+    elif intencion_list[0] == 1:
         print("Ingreso a la intencion 1")
         nuevo_estado = 'seguimiento'
         if es_transicion_valida(estado_actual, nuevo_estado):
@@ -91,18 +359,22 @@ def enviar_respuesta(cliente, cliente_nuevo):
             dbMySQLManager.actualizar_estado_historico_cliente(cliente_id_mysql, nuevo_estado)
         else:
             print(f"No se actualiza el estado desde {estado_actual} a {nuevo_estado}.")
-        response_message = openai.consulta(cliente_mysql,conversation_actual, conversation_history)
+        response_message = respuesta_desde_borrador(borrador, cliente_mysql, conversation_actual, conversation_history, al_campo)
     elif intencion_list[0] == 2:
         print("Ingreso a la intencion 2")
+        # Sin fecha en el mensaje del cliente el clasificador devuelve solo la intención
+        fecha_cita = intencion_list[1].strip() if len(intencion_list) > 1 else ""
+        print("Fecha de la cita:", fecha_cita)
+        # La consulta al calendario corre mientras se actualiza el estado del cliente
+        futuro_horarios = ejecutor_turnos.submit(horarios_para_ofrecer, fecha_cita)
         nuevo_estado = 'interesado'
         if es_transicion_valida(estado_actual, nuevo_estado):
             cliente_mysql["estado"] = 'interesado'
             dbMySQLManager.actualizar_estado_cliente(cliente_id_mysql, nuevo_estado)  
             dbMySQLManager.actualizar_estado_historico_cliente(cliente_id_mysql, nuevo_estado)      
-        print("Fecha de la cita:", intencion_list[1].strip())
-        horarios_disponibles = calendar.listar_horarios_disponibles(intencion_list[1].strip())
+        horarios_disponibles = futuro_horarios.result()
         print("Horarios disponibles:", horarios_disponibles)
-        response_message = openai.consultaHorarios(cliente_mysql,horarios_disponibles,conversation_actual,conversation_history,intencion_list[1])
+        response_message = openai.consultaHorarios(cliente_mysql,horarios_disponibles,conversation_actual,conversation_history,fecha_cita, al_campo=al_campo)
     elif intencion_list[0] == 3:
         print("Ingreso a la intencion 3")
         nuevo_estado = 'promesas de pago'   
@@ -113,14 +385,15 @@ def enviar_respuesta(cliente, cliente_nuevo):
         else:
             print(f"No se actualiza el estado desde {estado_actual} a {nuevo_estado}.")             
         print("Fecha y hora de la cita:", intencion_list[1].lstrip())
-        reserva_cita = calendar.reservar_cita(intencion_list[1].lstrip(), summary=f"Cita reservada para {cliente['nombre']}",duration_minutes=30)
+        # La reserva retiene el horario antes de crear el evento: dos clientes no pueden confirmar el mismo
+        reserva_cita = reservas.reservar(intencion_list[1].lstrip(), cliente["celular"], summary=f"Cita reservada para {cliente['nombre']}",duration_minutes=DURACION_CITA_MINUTOS)
         if not reserva_cita:
             response_message = f"""{{"mensaje": "Hubo un error al reservar la cita. Por favor, intenta nuevamente."}}"""
         elif reserva_cita == "Horario no disponible":
             response_message = f"""{{"mensaje": "Lo siento, el horario seleccionado no está disponible. Por favor, selecciona otro horario."}}"""
         else:
             print("Cita reservada:", reserva_cita)
-            response_message = openai.consultaCitareservada(cliente_mysql,reserva_cita,conversation_actual, conversation_history)
+            response_message = openai.consultaCitareservada(cliente_mysql,reserva_cita,conversation_actual, conversation_history, al_campo=al_campo)
     
             fecha_cita = datetime.fromisoformat(reserva_cita["start"]["dateTime"]).strftime('%Y-%m-%d %H:%M:%S')
             # Registrar la cita en MySQL y vincularla con la conversación activa
@@ -144,7 +417,7 @@ def enviar_respuesta(cliente, cliente_nuevo):
             dbMySQLManager.actualizar_estado_historico_cliente(cliente_id_mysql, nuevo_estado)
         else:
             print(f"No se actualiza el estado desde {estado_actual} a {nuevo_estado}.")
-        response_message = openai.consultaPago(cliente_mysql,link_pago, conversation_actual, conversation_history)
+        response_message = openai.consultaPago(cliente_mysql,link_pago, conversation_actual, conversation_history, al_campo=al_campo)
 
     elif intencion_list[0] == 5:
         print("Ingreso a la intencion 5")
@@ -153,35 +426,43 @@ def enviar_respuesta(cliente, cliente_nuevo):
         dbMongoManager.editar_cliente_por_celular(cliente["celular"], cliente["nombre"])
         dbMySQLManager.actualizar_nombre_cliente(cliente_id_mysql, cliente["nombre"])
         #dbMySQLManager.
-        response_message = openai.consulta(cliente_mysql,conversation_actual, conversation_history)
+        response_message = respuesta_desde_borrador(borrador, cliente_mysql, conversation_actual, conversation_history, al_campo)
     elif intencion_list[0] == 6:
-        if len(intencion_list) > 2:
-            categoria = intencion_list[1].strip()
-            detalle = intencion_list[2].strip()
-            print("Causa de no interés:", categoria)
-            if es_transicion_valida(estado_actual, 'no interesado'):
-                cliente_mysql["estado"] = 'no interesado'
-                dbMySQLManager.actualizar_estado_cliente_no_interes(cliente_id_mysql, 'no interesado', categoria, detalle)
-                dbMySQLManager.actualizar_estado_historico_cliente(cliente_id_mysql, 'no interesado')
-            else:
-                print(f"No se actualiza el estado desde {estado_actual} a no interesado.")
-            response_message = openai.consulta(cliente_mysql, conversation_actual, conversation_history)
+        categoria = intencion_list[1].strip()
+        detalle = intencion_list[2].strip()
+        print("Causa de no interés:", categoria)
+        if es_transicion_valida(estado_actual, 'no interesado'):
+            cliente_mysql["estado"] = 'no interesado'
+            dbMySQLManager.actualizar_estado_cliente_no_interes(cliente_id_mysql, 'no interesado', categoria, detalle)
+            dbMySQLManager.actualizar_estado_historico_cliente(cliente_id_mysql, 'no interesado')
+        else:
+            print(f"No se actualiza el estado desde {estado_actual} a no interesado.")
+        response_message = respuesta_desde_borrador(borrador, cliente_mysql, conversation_actual, conversation_history, al_campo)
+    else:
+        # Intención desconocida: se responde la conversación sin acción
+        response_message = respuesta_desde_borrador(borrador, cliente_mysql, conversation_actual, conversation_history, al_campo)
 
     # Enviar respuesta al cliente
     #if cliente["nombre"] == "":
     #    response_message = openai.consultaNombre(cliente, response_message,conversation_actual)
 
-    print("Response message:", response_message)
-    response_message = extraer_json(response_message)
-    print("Response message json:", response_message)
-    response_message = response_message["mensaje"]
-    response_message = response_message.replace("Asesor: ", "").strip('"')
-    twilio.send_message(cliente["celular"], response_message)
+    if envio and envio.enviado:
+        # La respuesta ya salió durante el streaming
+        response_message = envio.esperar()
+    else:
+        print("Response message:", response_message)
+        response_message = extraer_json(response_message)
+        print("Response message json:", response_message)
+        response_message = response_message["mensaje"]
+        response_message = limpiar_respuesta(response_message)
+        despachador.encolar(cliente["celular"], response_message)
+
+    if intencion_list[0] == 1 and not desde_cache_faq:
+        cache_faq.guardar(conversation_actual, estado_actual, response_message, cliente_mysql["nombre"])
 
-    # Guardar la respuesta en la conversación actual
+    # Etapa 3: guardar la respuesta y compactar el contexto fuera del camino de la respuesta
     print("Response message:", response_message)
-    dbMongoManager.guardar_respuesta_ultima_interaccion_chatbot(cliente["celular"], response_message)
-    dbMySQLManager.actualizar_fecha_ultima_interaccion_bot(cliente_id_mysql, datetime.now())
+    en_segundo_plano(registrar_respuesta, cliente["celular"], cliente_id_mysql, conversacion_completa, response_message)
     # Eliminar el temporizador del cliente una vez que se haya respondido
     timers.pop(cliente["celular"], None)
 
@@ -220,8 +501,11 @@ def whatsapp_bot():
             print("Creando una nueva interacción para el cliente.")
             dbMongoManager.crear_nueva_interaccion(celular, incoming_msg)            
 
+        # Con el mensaje ya guardado, se adelanta la carga de datos y la clasificación durante la espera
+        version = especulaciones.iniciar(celular, preparar_turno, celular) if ESPECULATIVO and not cliente_nuevo else None
+
         # Crear un nuevo temporizador de 60 segundos antes de responder
-        timer = threading.Timer(2, enviar_respuesta, args=[cliente,cliente_nuevo])
+        timer = threading.Timer(2, enviar_respuesta, args=[cliente,cliente_nuevo,version])
         timers[celular] = timer
         timer.start()
         print("Nuevo temporizador iniciado para el cliente:", sender)
@@ -237,10 +521,17 @@ def iniciar_conversacion_leads():
     while True:
         print("Iniciando conversación con leads...")
         # Obtener los leeds de la base de datos
-        leeds = leaderManager.get_unanalyzed_leads(limit=10)
+        leeds = [lead for lead in leaderManager.get_unanalyzed_leads(limit=10) if lead["Mobile"] != ""]
+        # Los mensajes de toda la página se generan antes del envío, en paralelo (o en batch)
+        resultados_leads = campana.generar(
+            f"leads-csv-{datetime.now().strftime('%Y-%m-%d')}",
+            {str(lead["Record Id"]): openai.mensajes_lead(lead) for lead in leeds}
+        )
         for lead in leeds:
-            if lead["Mobile"] == "":
-                continue            
+            resultado_lead = resultados_leads.get(str(lead["Record Id"]))
+            if not resultado_lead:
+                print("No se generó mensaje para el lead:", lead["Record Id"])
+                continue
             # Buscar en la base de datos con su número de teléfono móvil
             cliente = dbMongoManager.obtener_cliente_por_celular(lead["Mobile"])
             if not cliente:
@@ -310,13 +601,11 @@ def iniciar_conversacion_leads():
             # Obtener el número de teléfono móvil del lead
             mobile = lead["Mobile"]
             print("Enviando mensaje a:", mobile)
-            # Obtener el nombre del lead
-            resultado_lead = openai.consultaLead(lead)
             print("Response resultado_lead lead:", resultado_lead)
             estado_lead = resultado_lead.split("-")[0].strip().replace('"','')
 
             response_message = resultado_lead.split("-")[1].strip().replace('"','')
-            twilio.send_message(mobile, response_message)
+            despachador.encolar(mobile, response_message, prioridad=PRIORIDAD_CAMPANA, campana="leads-csv")
             leaderManager.update_lead(lead["Record Id"], "Analizado", "Sí")
             # Actualizar el estado del cliente segun su lead en MySQL
             estado_lead = estado_lead.lower()
@@ -345,9 +634,16 @@ def iniciar_conversacion_leads_zoho():
             print("Iniciando conversación con leads desde Zoho...")
 
             # Obtener leads desde ZohoCRMManager
-            leads = zoho_manager.obtener_todos_los_leads(limit=10)  # Llama al método con un límite de 10 leads
+            leads = [lead for lead in zoho_manager.obtener_todos_los_leads(limit=10) if lead.get("Mobile")]  # Llama al método con un límite de 10 leads
+            # Los mensajes de toda la página se generan antes del envío, en paralelo (o en batch)
+            resultados_leads = campana.generar(
+                f"leads-zoho-{datetime.now().strftime('%Y-%m-%d')}",
+                {str(lead["id"]): openai.mensajes_lead_zoho(lead) for lead in leads}
+            )
             for lead in leads:
-                if not lead.get("Mobile"):
+                resultado_lead = resultados_leads.get(str(lead["id"]))
+                if not resultado_lead:
+                    print("No se generó mensaje para el lead:", lead["id"])
                     continue
 
                 # Buscar en la base de datos MongoDB usando el número de teléfono del lead
@@ -412,10 +708,9 @@ def iniciar_conversacion_leads_zoho():
                 # Enviar mensaje al lead usando Twilio
                 mobile = format_number(lead["Mobile"])
                 print("Enviando mensaje a:", mobile)
-                resultado_lead = openai.consultaLeadZoho(lead)
                 estado_lead = resultado_lead.split("-")[0].strip().replace('"','')
                 response_message = resultado_lead.split("-")[1].strip().replace('"','')
-                #twilio.send_message(mobile, response_message)
+                #despachador.encolar(mobile, response_message, prioridad=PRIORIDAD_CAMPANA, campana="leads-zoho")
                 #zoho_manager.marcar_lead_como_analizado(lead["id"])  # Ejemplo de función para actualizar estado en Zoho
 
                 # Actualizar estado en MySQL y MongoDB
@@ -439,6 +734,7 @@ def verificar_estados_clientes():
             if(cliente['nombre'] != "Daniel"):
                 continue
             cliente_id = cliente['cliente_id']
+            openai.metricas.etiquetar(cliente_id=cliente_id, intencion=None)
             estado = cliente['estado']
             fecha_ultima_interaccion = cliente['fecha_ultima_interaccion']
             fecha_ultima_interaccion_bot = cliente['fecha_ultima_interaccion_bot']
@@ -450,10 +746,10 @@ def verificar_estados_clientes():
                     dias_sin_interaccion = (fecha_actual - fecha_ultima_interaccion).days
                     if dias_sin_interaccion >= 2 and dias_sin_interaccion <= 7:
                         # Enviar mensaje de seguimiento
-                        conversation_actual = dbMongoManager.obtener_conversacion_actual(celular)
+                        conversation_actual = contexto.preparar(dbMongoManager.obtener_conversacion_actual(celular))
                         conversation_history = dbMongoManager.obtener_historial_conversaciones(celular)
                         response_message = openai.consulta(cliente, conversation_actual, conversation_history)
-                        twilio.send_message(celular, response_message)
+                        despachador.encolar(celular, response_message, prioridad=PRIORIDAD_CAMPANA, campana="seguimiento")
                         # Actualizar fechas de última interacción
                         dbMySQLManager.actualizar_fecha_ultima_interaccion_bot(cliente_id, fecha_actual)
                         dbMongoManager.guardar_respuesta_ultima_interaccion_chatbot(celular, response_message)
@@ -476,7 +772,7 @@ def verificar_estados_clientes():
                             print(f"No se actualiza el estado desde {estado} a {nuevo_estado}.")
                         # Notificar al cliente sobre la cancelación
                         response_message = "Estimado cliente, su cita ha sido cancelada debido a la falta de pago en el tiempo establecido. Si desea reprogramar, por favor contáctenos."
-                        twilio.send_message(celular, response_message)
+                        despachador.encolar(celular, response_message, prioridad=PRIORIDAD_CAMPANA, campana="cita-cancelada")
                         dbMongoManager.guardar_respuesta_ultima_interaccion_chatbot(celular, response_message)
                         dbMySQLManager.actualizar_fecha_ultima_interaccion(cliente_id, fecha_actual)
                         dbMySQLManager.actualizar_fecha_ultima_interaccion_bot(cliente_id, fecha_actual)
@@ -488,10 +784,10 @@ def verificar_estados_clientes():
                             if horas_desde_ultima_interaccion_bot >= 24:
                                 # Enviar recordatorio de pago
                                 link_pago = "https://culqi.com"  # Genera el link de pago real si es necesario
-                                conversation_actual = dbMongoManager.obtener_conversacion_actual(celular)
+                                conversation_actual = contexto.preparar(dbMongoManager.obtener_conversacion_actual(celular))
                                 conversation_history = dbMongoManager.obtener_historial_conversaciones(celular)
                                 response_message = openai.consultaPago(cliente, link_pago, conversation_actual, conversation_history)
-                                twilio.send_message(celular, response_message)
+                                despachador.encolar(celular, response_message, prioridad=PRIORIDAD_CAMPANA, campana="recordatorio-pago")
                                 # Actualizar fechas de última interacción
                                 dbMySQLManager.actualizar_fecha_ultima_interaccion(cliente_id, fecha_actual)
                                 dbMySQLManager.actualizar_fecha_ultima_interaccion_bot(cliente_id, fecha_actual)
@@ -505,10 +801,10 @@ def verificar_estados_clientes():
                     dias_sin_interaccion = (fecha_actual - fecha_ultima_interaccion).days
                     if dias_sin_interaccion >= 7 and dias_sin_interaccion <= 30:
                         # Enviar mensaje de seguimiento
-                        conversation_actual = dbMongoManager.obtener_conversacion_actual(celular)
+                        conversation_actual = contexto.preparar(dbMongoManager.obtener_conversacion_actual(celular))
                         conversation_history = dbMongoManager.obtener_historial_conversaciones(celular)
                         response_message = openai.consulta(cliente, conversation_actual, conversation_history)
-                        twilio.send_message(celular, response_message)
+                        despachador.encolar(celular, response_message, prioridad=PRIORIDAD_CAMPANA, campana="seguimiento")
                         # Actualizar fechas de última interacción
                         dbMySQLManager.actualizar_fecha_ultima_interaccion_bot(cliente_id, fecha_actual)
                         dbMongoManager.guardar_respuesta_ultima_interaccion_chatbot(celular, response_message)
@@ -590,7 +886,7 @@ def verificar_citas_pasadas():
             # Enviar mensaje de agradecimiento al cliente
             cliente = dbMySQLManager.obtener_cliente(cliente_id)
             response_message = "Esperamos que tu cita haya sido satisfactoria. ¡Gracias por confiar en nosotros!"
-            twilio.send_message(cliente['celular'], response_message)
+            despachador.encolar(cliente['celular'], response_message, prioridad=PRIORIDAD_CAMPANA, campana="citas-pasadas")
             dbMongoManager.guardar_respuesta_ultima_interaccion_chatbot(cliente['celular'], response_message)
             dbMySQLManager.actualizar_fecha_ultima_interaccion(cliente_id, fecha_actual)
             dbMySQLManager.actualizar_fecha_ultima_interaccion_bot(cliente_id, fecha_actual)
@@ -629,7 +925,7 @@ def culqi_webhook():
                     
                     # Enviar mensaje de confirmación al cliente
                     response_message = "¡Gracias por tu pago! Tu cita ha sido confirmada. Te esperamos."
-                    twilio.send_message(phone_number, response_message)
+                    despachador.encolar(phone_number, response_message)
 
                     # Actualizar fechas de última interacción
                     fecha_actual = datetime.now()
@@ -653,6 +949,144 @@ def culqi_webhook():
 def health_check():
     return '', 200
 
+@app.route('/health/listo', methods=['GET'])
+def health_listo():
+    # Preparado para atender mensajes: todos los componentes externos ya se construyeron
+    return jsonify(componentes.reporte()), 200 if componentes.listo() else 503
+
+@app.route('/metricas/arranque', methods=['GET'])
+def metricas_arranque():
+    # Estado y segundos de construcción de cada componente
+    return jsonify(componentes.reporte()), 200
+
+@app.route('/metricas/clasificador-local', methods=['GET'])
+def metricas_clasificador_local():
+    # Decisiones y concordancia con el LLM del clasificador local, por intención
+    return jsonify(clasificador_local.metricas()), 200
+
+@app.route('/metricas/prompts', methods=['GET'])
+def metricas_prompts():
+    # Versiones registradas de cada prompt y tokens de su parte estática
+    return jsonify(openai.prompts.resumen()), 200
+
+@app.route('/metricas/llm', methods=['GET'])
+def metricas_llm():
+    # Tokens, costo e histogramas de latencia/TTFT por prompt, ruta, modelo o intención (?dimension=...)
+    dimension = request.args.get("dimension", "prompt")
+    try:
+        return jsonify(openai.metricas.resumen(dimension)), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/metricas/llm/clientes', methods=['GET'])
+def metricas_llm_clientes():
+    # Clientes con más consumo (?n=10&por=costo_usd)
+    return jsonify(openai.metricas.top_clientes(int(request.args.get("n", 10)), request.args.get("por", "costo_usd"))), 200
+
+@app.route('/metricas/llm/clientes/<cliente_id>', methods=['GET'])
+def metricas_llm_cliente(cliente_id):
+    contadores = openai.metricas.cliente(cliente_id)
+    if contadores is None:
+        return jsonify({"error": "Cliente sin llamadas registradas"}), 404
+    return jsonify(contadores), 200
+
+@app.route('/metricas/llm-rutas', methods=['GET'])
+def metricas_llm_rutas():
+    # Llamadas, escalamientos, latencia media y costo por ruta de modelo
+    return jsonify(openai.metricas_rutas()), 200
+
+@app.route('/metricas/especulacion', methods=['GET'])
+def metricas_especulacion():
+    # Turnos preparados durante la espera: iniciados, reemplazados por un mensaje nuevo, reutilizados y descartados
+    return jsonify(especulaciones.metricas()), 200
+
+@app.route('/metricas/cache-faq', methods=['GET'])
+def metricas_cache_faq():
+    # Consultas, aciertos y tasa de aciertos del caché de respuestas frecuentes
+    return jsonify(cache_faq.metricas()), 200
+
+@app.route('/metricas/calendario', methods=['GET'])
+def metricas_calendario():
+    # Aciertos de la caché de ocupación del calendario y llamadas a la API de Calendar ahorradas
+    return jsonify(calendar.metricas_disponibilidad()), 200
+
+@app.route('/metricas/calendario/espejo', methods=['GET'])
+def metricas_espejo_calendario():
+    # Estado del espejo local del calendario: eventos, sincronizaciones, páginas leídas y antigüedad
+    if not espejo_calendario:
+        return jsonify({"error": "Espejo del calendario desactivado"}), 404
+    return jsonify(espejo_calendario.metricas()), 200
+
+@app.route('/calendario/notificaciones', methods=['POST'])
+def notificaciones_calendario():
+    # Notificación push de Google Calendar: el calendario cambió y se sincroniza el espejo
+    if not espejo_calendario:
+        return 'OK', 200
+    token = os.getenv("CALENDARIO_WEBHOOK_TOKEN", "")
+    if token and not hmac.compare_digest(request.headers.get("X-Goog-Channel-Token", ""), token):
+        return "No autorizado", 403
+    if request.headers.get("X-Goog-Resource-State") != "sync":
+        espejo_calendario.notificar()
+    return 'OK', 200
+
+@app.route('/metricas/reservas', methods=['GET'])
+def metricas_reservas():
+    # Citas reservadas y rechazos por retención de otra conversación o por conflicto en el calendario
+    return jsonify(reservas.metricas()), 200
+
+@app.route('/metricas/envios', methods=['GET'])
+def metricas_envios():
+    # Mensajes enviados, reintentados y fallidos, y tamaño de la cola por estado
+    return jsonify(despachador.metricas()), 200
+
+@app.route('/twilio/estado', methods=['POST'])
+def estado_mensaje_twilio():
+    # Webhook de estado de Twilio (status callback): un cambio de estado de entrega de un mensaje enviado
+    if not twilio.firma_valida(twilio.status_callback or request.url, request.form.to_dict(), request.headers.get("X-Twilio-Signature")):
+        return "No autorizado", 403
+    entregas.registrar_estado(request.form.get("MessageSid"), request.form.get("MessageStatus"), request.form.get("ErrorCode"))
+    return '', 204
+
+@app.route('/campanas/plantilla', methods=['POST'])
+def campana_plantilla():
+    # Envío masivo de una plantilla: {"campana", "content_sid", "destinatarios": [{"numero", "variables"}]}.
+    # Se encola y responde de inmediato; el avance se consulta en /metricas/campanas/<campana>.
+    # Envía plantillas pagadas: exige el secreto compartido CAMPANAS_TOKEN en la cabecera X-Campanas-Token
+    token = os.getenv("CAMPANAS_TOKEN", "")
+    if not token or not hmac.compare_digest(request.headers.get("X-Campanas-Token", ""), token):
+        return "No autorizado", 403
+    datos = request.get_json(silent=True)
+    if not isinstance(datos, dict):
+        return jsonify({"error": "Se esperaba un objeto JSON"}), 400
+    campana, content_sid, lista = datos.get("campana"), datos.get("content_sid"), datos.get("destinatarios")
+    if not campana or not isinstance(campana, str) or not content_sid or not isinstance(content_sid, str):
+        return jsonify({"error": "Faltan 'campana' o 'content_sid'"}), 400
+    if not isinstance(lista, list) or not all(isinstance(d, dict) and d.get("numero") for d in lista):
+        return jsonify({"error": "'destinatarios' debe ser una lista de objetos con 'numero'"}), 400
+    if any(not isinstance(d.get("variables"), (dict, str, type(None))) for d in lista):
+        return jsonify({"error": "'variables' debe ser un objeto o un JSON"}), 400
+    destinatarios = [(d["numero"], d.get("variables")) for d in lista]
+    resumen = despachador.encolar_plantillas(campana, content_sid, destinatarios,
+                                             reintentar_fallidos=bool(datos.get("reintentar_fallidos")))
+    return jsonify(resumen), 202
+
+@app.route('/metricas/campanas/<campana>', methods=['GET'])
+def metricas_campana(campana):
+    # Resultado por destinatario y mensajes por segundo de una campaña de plantillas
+    return jsonify(despachador.reporte_campana(campana)), 200
+
+@app.route('/metricas/zoho', methods=['GET'])
+def metricas_zoho():
+    # Renovaciones del access token de Zoho, tokens tomados del caché compartido y segundos para que venza
+    return jsonify(zoho_manager.tokens.metricas()), 200
+
+@app.route('/metricas/entregas', methods=['GET'])
+def metricas_entregas():
+    # Tasas de entrega, lectura y fallo por campaña; admite ?campana=...&horas=...
+    horas = request.args.get("horas", type=float)
+    desde = time.time() - horas * 3600 if horas else None
+    return jsonify(entregas.tasas(request.args.get("campana"), desde)), 200
+
 
 #def start_background_threads():
     # Iniciar el hilo en segundo plano para iniciar conversaciones automáticamente
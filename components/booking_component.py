@@ -0,0 +1,102 @@
+import threading
+import uuid
+import datetime as dt
+import pytz
+
+class BookingManager:
+    """
+    Reserva de citas sin doble agenda entre conversaciones simultáneas.
+
+    Antes de tocar Calendar, la reserva retiene en MongoDB las celdas de `celda_minutos` que ocupa la
+    cita: cada celda es un documento con la celda como _id, de modo que dos confirmaciones del mismo
+    horario no pueden retenerla a la vez y no hace falta un lock global. Con las celdas retenidas se
+    verifica el calendario en caché y se crea el evento una sola vez. Si algo falla las celdas se
+    liberan, y si el proceso se cae la retención vence sola a los `ttl_retencion` segundos. Las celdas
+    de una cita creada quedan confirmadas durante `ttl_confirmada` segundos (por defecto el TTL de la
+    caché de disponibilidad del calendario), el intervalo en que la caché de otro proceso aún puede no
+    ver el evento nuevo; después manda Calendar, y si el evento se cancela el horario vuelve a quedar libre.
+    """
+
+    def __init__(self, calendar, db, celda_minutos=15, ttl_retencion=120, ttl_confirmada=None):
+        self.calendar = calendar
+        self.db = db
+        self.celda_minutos = celda_minutos
+        self.ttl_retencion = ttl_retencion
+        self.ttl_confirmada = ttl_confirmada
+        self.lima_tz = pytz.timezone("America/Lima")
+        self._lock = threading.Lock()
+        self._metricas = {"reservas": 0, "conflictos_retencion": 0, "conflictos_calendario": 0, "errores": 0}
+        self.db.crear_indices_reservas()
+
+    def _celdas(self, inicio, fin):
+        """Claves de las celdas que cubren [inicio, fin), alineadas a `celda_minutos` (p. ej. "2024-10-29T17:00-05:00")."""
+        celda = inicio.replace(minute=inicio.minute - inicio.minute % self.celda_minutos, second=0, microsecond=0)
+        celdas = []
+        while celda < fin:
+            celdas.append(celda.isoformat(timespec="minutes"))
+            celda += dt.timedelta(minutes=self.celda_minutos)
+        return celdas
+
+    def _contar(self, campo):
+        with self._lock:
+            self._metricas[campo] += 1
+
+    def reservar(self, fecha_hora, celular, summary="Cita reservada", timezone="America/Lima", duration_minutes=60, attendees=None):
+        """
+        Reservar una cita con retención de horario.
+
+        :param fecha_hora: Fecha y hora de inicio en formato "YYYY-MM-DD HH:MM".
+        :param celular: Celular del cliente que reserva (queda registrado en la retención).
+        :return: El evento creado, "Horario no disponible" si otra reserva o un evento ocupa el horario,
+                 o None si ocurre un error (mismo contrato que GoogleCalendarManager.reservar_cita).
+        """
+        try:
+            inicio = self.lima_tz.localize(dt.datetime.strptime(fecha_hora, "%Y-%m-%d %H:%M"))
+        except ValueError as e:
+            print(f"Error al reservar cita: {e}")
+            self._contar("errores")
+            return None
+        fin = inicio + dt.timedelta(minutes=duration_minutes)
+
+        reserva_id = uuid.uuid4().hex
+        expira = dt.datetime.now(pytz.utc) + dt.timedelta(seconds=self.ttl_retencion)
+        if not self.db.retener_celdas(self._celdas(inicio, fin), reserva_id, celular, expira):
+            print(f"Horario {fecha_hora} retenido por otra reserva")
+            self._contar("conflictos_retencion")
+            return "Horario no disponible"
+
+        try:
+            if not self.calendar.is_time_available(inicio, fin):
+                print("El horario no está disponible. Por favor, elige otro horario.")
+                self.db.liberar_celdas(reserva_id)
+                self._contar("conflictos_calendario")
+                return "Horario no disponible"
+
+            event = self.calendar.create_event(
+                summary=summary,
+                start_time=inicio.isoformat(),
+                end_time=fin.isoformat(),
+                timezone=timezone,
+                attendees=attendees
+            )
+            if not event:
+                self.db.liberar_celdas(reserva_id)
+                self._contar("errores")
+                return None
+
+            ttl_confirmada = self.ttl_confirmada if self.ttl_confirmada is not None else self.calendar.ttl_disponibilidad
+            expira = dt.datetime.now(pytz.utc) + dt.timedelta(seconds=ttl_confirmada + self.ttl_retencion)
+            self.db.confirmar_celdas(reserva_id, event["id"], min(expira, fin.astimezone(pytz.utc)))
+            print(f"Cita reservada exitosamente: {event['id']}")
+            self._contar("reservas")
+            return event
+        except Exception as e:
+            print(f"Error al reservar cita: {e}")
+            self.db.liberar_celdas(reserva_id)
+            self._contar("errores")
+            return None
+
+    def metricas(self):
+        """Reservas creadas y rechazos por retención de otra conversación o por el calendario."""
+        with self._lock:
+            return dict(self._metricas)
@@ -5,15 +5,110 @@ from googleapiclient.discovery import build
 from google.auth.transport.requests import Request
 from googleapiclient.errors import HttpError
 import pytz
+import os
 import os.path
+import threading
+import time
+from bisect import bisect_left, bisect_right
 
 SCOPES = ["https://www.googleapis.com/auth/calendar"]
 
+# Horario de atención por día de la semana (0 = lunes); los días que no figuran no tienen disponibilidad
+HORARIO_LABORAL = {
+    1: [(dt.time(13, 30), dt.time(20, 30))],  # Martes: 1:30 PM a 8:30 PM
+    3: [(dt.time(13, 30), dt.time(20, 30))],  # Jueves: 1:30 PM a 8:30 PM
+    5: [(dt.time(10, 0), dt.time(17, 0))],    # Sábados: 10:00 AM a 5:00 PM
+}
+
+DIAS_SEMANA = ("lunes", "martes", "miércoles", "jueves", "viernes", "sábado", "domingo")
+
+def intervalo_evento(event, tz):
+    """
+    Intervalo (inicio, fin) en la zona `tz` que ocupa un evento de Calendar, o None si no bloquea la agenda
+    (cancelado o marcado como disponible). Los eventos de todo el día ocupan desde las 00:00 de su
+    fecha de inicio hasta las 00:00 de su fecha de fin (exclusiva).
+    """
+    if event.get('status') == 'cancelled' or event.get('transparency') == 'transparent':
+        return None
+    inicio, fin = event.get('start', {}), event.get('end', {})
+    if 'dateTime' in inicio and 'dateTime' in fin:
+        return (dt.datetime.fromisoformat(inicio['dateTime'].replace("Z", "+00:00")).astimezone(tz),
+                dt.datetime.fromisoformat(fin['dateTime'].replace("Z", "+00:00")).astimezone(tz))
+    if 'date' in inicio and 'date' in fin:
+        return (tz.localize(dt.datetime.strptime(inicio['date'], '%Y-%m-%d')),
+                tz.localize(dt.datetime.strptime(fin['date'], '%Y-%m-%d')))
+    return None
+
+class IndiceOcupacion:
+    """
+    Bloques ocupados de un día, fusionados y ordenados por inicio.
+
+    Como los bloques no se solapan, los finales también quedan ordenados y cada consulta se resuelve
+    con una bisección sobre los inicios, sin llamar a la API de Calendar.
+    """
+
+    def __init__(self, intervalos):
+        fusionados = []
+        for inicio, fin in sorted(intervalos):
+            if fusionados and inicio <= fusionados[-1][1]:
+                fusionados[-1][1] = max(fusionados[-1][1], fin)
+            else:
+                fusionados.append([inicio, fin])
+        self.intervalos = [(inicio, fin) for inicio, fin in fusionados]
+        self._inicios = [inicio for inicio, _ in self.intervalos]
+
+    def conflicto(self, inicio, fin):
+        """Indica si [inicio, fin) se solapa con algún bloque ocupado."""
+        # Basta revisar el último bloque que empieza antes de `fin`: es el de mayor final entre los candidatos
+        indice = bisect_left(self._inicios, fin) - 1
+        return indice >= 0 and self.intervalos[indice][1] > inicio
+
+    def libres(self, inicio, fin):
+        """Tramos libres (inicio, fin) dentro de [inicio, fin)."""
+        libres = []
+        cursor = inicio
+        for bloque_inicio, bloque_fin in self.intervalos[max(0, bisect_right(self._inicios, inicio) - 1):]:
+            if bloque_inicio >= fin:
+                break
+            if bloque_fin <= cursor:
+                continue
+            if bloque_inicio > cursor:
+                libres.append((cursor, bloque_inicio))
+            cursor = bloque_fin
+        if cursor < fin:
+            libres.append((cursor, fin))
+        return libres
+
 class GoogleCalendarManager:
     CALENDAR_ID = "195010dac8c1b91a8bbee7c8b9476895cc5cbf034e9d09bbf9fb7490e3f89d07@group.calendar.google.com"
 
-    def __init__(self):
-        self.service = self._authenticate()
+    def __init__(self, ttl_disponibilidad=None, service=None):
+        # `service` permite usar un cliente de Calendar ya construido (p. ej. uno simulado en las pruebas)
+        self.service = service or self._authenticate()
+        self.lima_tz = pytz.timezone('America/Lima')
+        # Caché de ocupación por fecha ("YYYY-MM-DD" -> (instante de lectura, IndiceOcupacion))
+        self.ttl_disponibilidad = ttl_disponibilidad if ttl_disponibilidad is not None else float(
+            os.getenv("CALENDARIO_TTL_SEGUNDOS", "120"))
+        self._disponibilidad = {}
+        # Se incrementa al invalidar una fecha para descartar lecturas que estaban en curso
+        self._generaciones = {}
+        self._lock = threading.Lock()
+        self._metricas = {"aciertos": 0, "fallos": 0, "llamadas_api": 0, "invalidaciones": 0}
+        # Espejo local del calendario (CalendarSyncManager); mientras esté al día reemplaza a la API
+        self.espejo = None
+
+    def usar_espejo(self, espejo):
+        """Responde las consultas de ocupación desde `espejo` e invalida la caché con sus cambios."""
+        espejo.al_cambiar = lambda fechas: [self.invalidar_disponibilidad(fecha) for fecha in fechas]
+        self.espejo = espejo
+
+    def _espejo_vigente(self):
+        return self.espejo is not None and self.espejo.vigente()
+
+    def _propagar_cambios_espejo(self):
+        # Otro worker pudo sincronizar el espejo o crear un evento: se invalidan esas fechas antes de usar la caché
+        if self.espejo is not None:
+            self.espejo.propagar_cambios()
 
     def _authenticate(self):
         """Autenticación usando una cuenta de servicio."""
@@ -21,7 +116,8 @@ class GoogleCalendarManager:
             "service_account_credentials.json",  # Archivo JSON descargado
             scopes=SCOPES
         )
-        return build("calendar", "v3", credentials=credentials)
+        # Documento de descubrimiento incluido en googleapiclient: no se descarga en cada arranque
+        return build("calendar", "v3", credentials=credentials, static_discovery=True, cache_discovery=False)
 
     def listar_eventos_calendario(self):
         """Listar eventos del calendario configurado."""
@@ -56,60 +152,220 @@ class GoogleCalendarManager:
             print(f"Error al listar calendarios: {e}")
 
 
-    def listar_horarios_disponibles(self, fecha, max_results=10):
-        """Listar horarios disponibles para una fecha."""
-        lima_tz = pytz.timezone('America/Lima')
-        hoy = dt.datetime.now(lima_tz).date()
-        input_date = dt.datetime.strptime(fecha, '%Y-%m-%d')  # Define input_date antes de usarlo
-
-        # Definir horarios según el día de la semana
-        if input_date.weekday() in [1, 3]:  # Martes y jueves
-            working_hours = [{"start": dt.time(13, 30), "end": dt.time(20, 30)}]  # 1:30 PM a 8:30 PM
-        elif input_date.weekday() == 5:  # Sábados
-            working_hours = [{"start": dt.time(10, 0), "end": dt.time(17, 0)}]  # 10:00 AM a 5:00 PM
-        else:
-            working_hours = []  # Otros días no tienen disponibilidad
+    def _eventos_ocupados(self, fecha, por_pagina=250):
+        """
+        Intervalos (inicio, fin) en hora de Lima de los eventos que ocupan una fecha, leídos del espejo local
+        si está al día o de Calendar siguiendo todas las páginas (nextPageToken).
+        """
+        input_date = dt.datetime.strptime(fecha, '%Y-%m-%d')
+        start_of_day = self.lima_tz.localize(dt.datetime.combine(input_date, dt.time(0, 0)))
+        end_of_day = self.lima_tz.localize(dt.datetime.combine(input_date + dt.timedelta(days=1), dt.time(0, 0)))
 
-        start_of_day = lima_tz.localize(dt.datetime.combine(input_date, dt.time(0, 0)))
-        end_of_day = lima_tz.localize(dt.datetime.combine(input_date, dt.time(23, 59, 59)))
+        if self._espejo_vigente():
+            return self.espejo.ocupados(start_of_day, end_of_day)
 
         print("Rango de tiempo para disponibilidad:", start_of_day, end_of_day)
-
-        try:
+        intervalos = []
+        page_token = None
+        while True:
             events_result = self.service.events().list(
                 calendarId=self.CALENDAR_ID,
                 timeMin=start_of_day.isoformat(),
                 timeMax=end_of_day.isoformat(),
-                maxResults=max_results,
+                maxResults=por_pagina,
                 singleEvents=True,
-                orderBy='startTime'
+                pageToken=page_token,
             ).execute()
+            with self._lock:
+                self._metricas["llamadas_api"] += 1
+
+            for event in events_result.get('items', []):
+                intervalo = intervalo_evento(event, self.lima_tz)
+                if intervalo:
+                    intervalos.append(intervalo)
+            page_token = events_result.get('nextPageToken')
+            if not page_token:
+                break
+        print(f"Bloques ocupados el {fecha}: {len(intervalos)}")
+        return intervalos
+
+    def _indice_dia(self, fecha, max_antiguedad=None):
+        """
+        Índice de ocupación de una fecha desde la caché; se lee de Calendar si no está o tiene más de
+        `max_antiguedad` segundos (por defecto, el TTL de la caché).
+        """
+        max_antiguedad = self.ttl_disponibilidad if max_antiguedad is None else max_antiguedad
+        self._propagar_cambios_espejo()
+        with self._lock:
+            entrada = self._disponibilidad.get(fecha)
+            if entrada and time.monotonic() - entrada[0] < max_antiguedad:
+                self._metricas["aciertos"] += 1
+                return entrada[1]
+            self._metricas["fallos"] += 1
+            generacion = self._generaciones.get(fecha, 0)
+
+        instante = time.monotonic()
+        indice = IndiceOcupacion(self._eventos_ocupados(fecha))
+        with self._lock:
+            # Si se creó un evento mientras se leía, la lectura puede no incluirlo y no se guarda
+            if self._generaciones.get(fecha, 0) == generacion:
+                self._disponibilidad[fecha] = (instante, indice)
+        return indice
+
+    def invalidar_disponibilidad(self, fecha):
+        """Descarta la ocupación en caché de una fecha ("YYYY-MM-DD")."""
+        with self._lock:
+            self._disponibilidad.pop(fecha, None)
+            self._generaciones[fecha] = self._generaciones.get(fecha, 0) + 1
+            self._metricas["invalidaciones"] += 1
+
+    def metricas_disponibilidad(self):
+        """
+        Aciertos y fallos por fecha de la caché de ocupación y llamadas reales a Calendar (una consulta
+        free/busy cubre varias fechas). Cada acierto es una lectura de Calendar ahorrada.
+        """
+        with self._lock:
+            metricas = dict(self._metricas)
+            metricas["fechas_en_cache"] = len(self._disponibilidad)
+        consultas = metricas["aciertos"] + metricas["fallos"]
+        metricas["llamadas_ahorradas"] = metricas["aciertos"]
+        metricas["tasa_aciertos"] = round(metricas["aciertos"] / consultas, 3) if consultas else 0.0
+        return metricas
+
+    def _horario_laboral(self, fecha):
+        """
+        Tramos (inicio, fin) de atención de una fecha en hora de Lima. Para hoy, la atención empieza
+        como pronto en la siguiente hora en punto tras una hora de margen.
+        """
+        tramos = []
+        ahora = dt.datetime.now(self.lima_tz)
+        for hora_inicio, hora_fin in HORARIO_LABORAL.get(fecha.weekday(), []):
+            inicio = self.lima_tz.localize(dt.datetime.combine(fecha, hora_inicio))
+            fin = self.lima_tz.localize(dt.datetime.combine(fecha, hora_fin))
+            if fecha == ahora.date() and inicio < ahora:
+                inicio = max(inicio, (ahora + dt.timedelta(hours=1)).replace(minute=0, second=0, microsecond=0))
+            if inicio < fin:
+                tramos.append((inicio, fin))
+        return tramos
+
+    def _ocupacion_rango(self, desde, hasta):
+        """
+        Índices de ocupación de las fechas laborables entre `desde` y `hasta` (inclusive). Las que faltan
+        en la caché o están vencidas se leen del espejo o, sin espejo al día, con una sola consulta
+        free/busy a Calendar.
+        """
+        indices = {}
+        pendientes = []
+        fecha = desde
+        self._propagar_cambios_espejo()
+        with self._lock:
+            while fecha <= hasta:
+                entrada = self._disponibilidad.get(fecha.isoformat())
+                if fecha.weekday() in HORARIO_LABORAL:
+                    if entrada and time.monotonic() - entrada[0] < self.ttl_disponibilidad:
+                        self._metricas["aciertos"] += 1
+                        indices[fecha] = entrada[1]
+                    else:
+                        self._metricas["fallos"] += 1
+                        pendientes.append(fecha)
+                fecha += dt.timedelta(days=1)
+            if not pendientes:
+                return indices
+            generaciones = {fecha: self._generaciones.get(fecha.isoformat(), 0) for fecha in pendientes}
+
+        instante = time.monotonic()
+        time_min = self.lima_tz.localize(dt.datetime.combine(pendientes[0], dt.time(0, 0)))
+        time_max = self.lima_tz.localize(dt.datetime.combine(pendientes[-1] + dt.timedelta(days=1), dt.time(0, 0)))
+        if self._espejo_vigente():
+            ocupados = self.espejo.ocupados(time_min, time_max)
+        else:
+            with self._lock:
+                self._metricas["llamadas_api"] += 1
+            respuesta = self.service.freebusy().query(body={
+                "timeMin": time_min.isoformat(),
+                "timeMax": time_max.isoformat(),
+                "timeZone": "America/Lima",
+                "items": [{"id": self.CALENDAR_ID}],
+            }).execute()
+            ocupados = [
+                (dt.datetime.fromisoformat(bloque["start"].replace("Z", "+00:00")).astimezone(self.lima_tz),
+                 dt.datetime.fromisoformat(bloque["end"].replace("Z", "+00:00")).astimezone(self.lima_tz))
+                for bloque in respuesta["calendars"][self.CALENDAR_ID].get("busy", [])
+            ]
+
+        # Cada bloque se reparte entre las fechas que abarca
+        por_fecha = {fecha: [] for fecha in pendientes}
+        for inicio, fin in ocupados:
+            fecha = inicio.date()
+            while fecha <= fin.date():
+                if fecha in por_fecha:
+                    por_fecha[fecha].append((inicio, fin))
+                fecha += dt.timedelta(days=1)
+        with self._lock:
+            for fecha, intervalos in por_fecha.items():
+                indices[fecha] = IndiceOcupacion(intervalos)
+                if self._generaciones.get(fecha.isoformat(), 0) == generaciones[fecha]:
+                    self._disponibilidad[fecha.isoformat()] = (instante, indices[fecha])
+        return indices
+
+    def proximos_horarios(self, n=3, duracion_minutos=30, dias=14, paso_minutos=30, max_por_dia=2):
+        """
+        Próximos `n` inicios de cita libres (datetimes en hora de Lima) de `duracion_minutos`, buscando
+        en los próximos `dias` días con una sola consulta free/busy. Los inicios se alinean a `paso_minutos`
+        y se ofrecen como máximo `max_por_dia` por fecha para dar opciones en días distintos.
+        """
+        hoy = dt.datetime.now(self.lima_tz).date()
+        try:
+            indices = self._ocupacion_rango(hoy, hoy + dt.timedelta(days=dias))
+        except Exception as e:
+            print(f"Error al consultar la disponibilidad de los próximos días: {e}")
+            return []
 
-            events = events_result.get('items', [])
-            print("Eventos existentes:", events)
-
-            available_slots = []
-            now = dt.datetime.now(lima_tz)  # Hora actual en Lima
-
-            for hours in working_hours:
-                start_time = lima_tz.localize(dt.datetime.combine(input_date, hours["start"]))
-                end_time = lima_tz.localize(dt.datetime.combine(input_date, hours["end"]))
-
-                if input_date.date() == hoy and start_time < now:
-                    now_plus_one_hour = (now + dt.timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
-                    start_time = max(start_time, now_plus_one_hour)
+        duracion = dt.timedelta(minutes=duracion_minutos)
+        paso = dt.timedelta(minutes=paso_minutos)
+        horarios = []
+        for desplazamiento in range(dias + 1):
+            fecha = hoy + dt.timedelta(days=desplazamiento)
+            tramos = self._horario_laboral(fecha)
+            if not tramos:
+                continue
+            indice = indices[fecha]
+            del_dia = 0
+            for tramo_inicio, tramo_fin in tramos:
+                for libre_inicio, libre_fin in indice.libres(tramo_inicio, tramo_fin):
+                    # Primer inicio alineado al paso dentro del tramo libre
+                    base = libre_inicio.replace(minute=0, second=0, microsecond=0)
+                    cursor = base + paso * -(-(libre_inicio - base) // paso)
+                    while cursor + duracion <= libre_fin and del_dia < max_por_dia:
+                        horarios.append(cursor)
+                        del_dia += 1
+                        if len(horarios) == n:
+                            return horarios
+                        cursor += paso
+        return horarios
+
+    def describir_horario(self, inicio):
+        """Texto de un inicio de cita para el cliente, p. ej. "martes 2024-10-29 15:00"."""
+        return f"{DIAS_SEMANA[inicio.weekday()]} {inicio.strftime('%Y-%m-%d %H:%M')}"
+
+    def listar_horarios_disponibles(self, fecha):
+        """Listar horarios disponibles para una fecha."""
+        input_date = dt.datetime.strptime(fecha, '%Y-%m-%d').date()  # Define input_date antes de usarlo
 
-                for event in events:
-                    event_start = dt.datetime.fromisoformat(event['start']['dateTime']).astimezone(lima_tz)
-                    event_end = dt.datetime.fromisoformat(event['end']['dateTime']).astimezone(lima_tz)
+        # Horarios según el día de la semana
+        working_hours = self._horario_laboral(input_date)
+        if not working_hours:
+            # Sin horario de atención no hace falta consultar el calendario
+            print("No hay horarios disponibles.")
+            return []
 
-                    if start_time < event_end and event_start < end_time:
-                        if event_start > start_time:
-                            available_slots.append(f"{start_time.strftime('%H:%M')} - {event_start.strftime('%H:%M')}")
-                        start_time = event_end
+        try:
+            indice = self._indice_dia(input_date.isoformat())
 
-                if start_time < end_time:
-                    available_slots.append(f"{start_time.strftime('%H:%M')} - {end_time.strftime('%H:%M')}")
+            available_slots = []
+            for start_time, end_time in working_hours:
+                for inicio, fin in indice.libres(start_time, end_time):
+                    available_slots.append(f"{inicio.strftime('%H:%M')} - {fin.strftime('%H:%M')}")
 
             if not available_slots:
                 print("No hay horarios disponibles.")
@@ -134,53 +390,35 @@ class GoogleCalendarManager:
         try:
             evento = self.service.events().insert(calendarId=self.CALENDAR_ID, body=event).execute()
             print(f"Evento creado: {evento['id']}")
+            if self.espejo is not None:
+                self.espejo.registrar_evento(evento)
             return evento
         except Exception as e:
             print(f"Error al crear el evento: {e}")
             return None
+        finally:
+            # Aunque la creación falle, el calendario pudo cambiar: la próxima consulta relee la fecha
+            self.invalidar_disponibilidad(start_time[:10])
 
-    def is_time_available(self, start_time, end_time):
-        """Verificar si un horario está disponible."""
+    def is_time_available(self, start_time, end_time, max_antiguedad=None):
+        """
+        Verificar si un horario está disponible, con el índice de ocupación de cada fecha que abarca.
+        `max_antiguedad` (segundos) exige datos de Calendar más recientes que el TTL de la caché.
+        """
         try:
             # Asegurarse de que start_time y end_time estén en la zona horaria de Lima
-            lima_tz = pytz.timezone("America/Lima")
+            lima_tz = self.lima_tz
             if start_time.tzinfo is None:
                 start_time = lima_tz.localize(start_time)
             if end_time.tzinfo is None:
                 end_time = lima_tz.localize(end_time)
 
-            # Convertir fechas al formato ISO sin forzar UTC
-            time_min = start_time.isoformat()
-            time_max = end_time.isoformat()
-            
-            events_result = self.service.events().list(
-                calendarId=self.CALENDAR_ID,
-                timeMin=time_min,
-                timeMax=time_max,
-                maxResults=10,
-                singleEvents=True,
-                orderBy='startTime'
-            ).execute()
-            events = events_result.get('items', [])
-            print(f"Verificando conflictos para {start_time} - {end_time}. Eventos encontrados: {len(events)}")
-            return len(events) == 0
-            # proximamente se implementara la verificacion de eventos
-            for event in events:
-                # Manejar eventos con dateTime o date
-                event_start = event.get('start').get('dateTime')
-                event_end = event.get('end').get('dateTime')
-
-                # Si no hay dateTime, manejarlo como un evento de todo el día
-                if not event_start or not event_end:
-                    continue                
-                # Obtener inicio y fin del evento existente
-                event_start = dt.datetime.fromisoformat(event['start']['dateTime']).astimezone(pytz.UTC)
-                event_end = dt.datetime.fromisoformat(event['end']['dateTime']).astimezone(pytz.UTC)
-
-                # Comparar si hay solapamiento
-                if not (end_time <= event_start or start_time >= event_end):
-                    print(f"Conflicto detectado con evento: {event['summary']} ({event_start} - {event_end})")
+            fecha = start_time.astimezone(lima_tz).date()
+            while fecha <= end_time.astimezone(lima_tz).date():
+                if self._indice_dia(fecha.isoformat(), max_antiguedad).conflicto(start_time, end_time):
+                    print(f"Conflicto detectado para {start_time} - {end_time}")
                     return False
+                fecha += dt.timedelta(days=1)
 
             # Si no hay conflictos, el horario está disponible
             return True
@@ -206,8 +444,10 @@ class GoogleCalendarManager:
             # Calcular la fecha y hora de fin sumando la duración de la cita
             end_datetime = start_datetime + dt.timedelta(minutes=duration_minutes)
 
-            # Verificar si el horario está disponible
-            if not self.is_time_available(start_datetime, end_datetime):
+            # Verificar si el horario está disponible: primero con la caché (un conflicto se rechaza sin
+            # llamar a la API) y luego con datos recién leídos, para no reservar sobre un evento nuevo
+            if (not self.is_time_available(start_datetime, end_datetime)
+                    or not self.is_time_available(start_datetime, end_datetime, max_antiguedad=0)):
                 print("El horario no está disponible. Por favor, elige otro horario.")
                 return "Horario no disponible"
 
@@ -0,0 +1,327 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import datetime as dt
+import pytz
+from googleapiclient.errors import HttpError
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos (un solo proceso en desarrollo)
+    fcntl = None
+from components.calendar_component import intervalo_evento
+
+class CalendarSyncManager:
+    """
+    Espejo local en SQLite de los eventos que ocupan el calendario de la clínica.
+
+    Se mantiene con la sincronización incremental de Calendar: la primera lectura recorre todos los
+    eventos y guarda el nextSyncToken; las siguientes solo traen lo que cambió desde entonces. Si Google
+    invalida el token (HTTP 410) se borra el espejo y se vuelve a leer completo. La sincronización corre
+    en un hilo cada `intervalo` segundos y también al llegar una notificación push (`notificar`).
+
+    Mientras la última sincronización tenga menos de `max_retraso` segundos (`vigente`), las consultas
+    de horarios se responden desde el espejo sin llamar a Google. `al_cambiar` recibe las fechas
+    ("YYYY-MM-DD", hora de Lima) afectadas por cada cambio para invalidar cachés.
+
+    El archivo lo comparten todos los workers de gunicorn: el syncToken, la hora de la última
+    sincronización y un registro de fechas cambiadas viven en la base, así que cada proceso sabe si el
+    espejo está al día y qué cachés invalidar aunque la sincronización la haya hecho otro. Solo un
+    proceso sincroniza a la vez (lock de archivo) y la lectura completa se arma en una tabla aparte que
+    reemplaza a `eventos` en una sola transacción, de modo que nunca se lee un espejo a medio llenar.
+    """
+
+    def __init__(self, service, calendar_id, ruta="calendario_espejo.db", intervalo=60, max_retraso=None,
+                 dias_conservados=7, al_cambiar=None):
+        self.service = service
+        self.calendar_id = calendar_id
+        self.intervalo = intervalo
+        self.max_retraso = max_retraso if max_retraso is not None else 3 * intervalo
+        self.dias_conservados = dias_conservados
+        self.al_cambiar = al_cambiar
+        self.lima_tz = pytz.timezone("America/Lima")
+        self.ruta = ruta
+        # Varios procesos escriben el mismo archivo: WAL para que las lecturas no esperen a la escritura
+        self._conexion = sqlite3.connect(ruta, check_same_thread=False, timeout=30)
+        self._conexion.execute("PRAGMA journal_mode=WAL")
+        self._lock = threading.Lock()
+        self._lock_sincronizacion = threading.Lock()
+        self._aviso = threading.Event()
+        self._hilo = None
+        self._canal = None
+        self._metricas = {"sincronizaciones": 0, "completas": 0, "paginas": 0, "cambios": 0, "errores": 0, "lecturas": 0,
+                          "omitidas": 0}
+        with self._lock:
+            for tabla in ("eventos", "eventos_completa"):
+                self._conexion.execute(
+                    f"CREATE TABLE IF NOT EXISTS {tabla} (id TEXT PRIMARY KEY, inicio TEXT NOT NULL, fin TEXT NOT NULL)"
+                )
+            self._conexion.execute("CREATE INDEX IF NOT EXISTS eventos_inicio ON eventos (inicio)")
+            self._conexion.execute("CREATE TABLE IF NOT EXISTS estado (clave TEXT PRIMARY KEY, valor TEXT)")
+            # Fechas cambiadas por cualquier proceso, para que cada uno invalide sus propias cachés
+            self._conexion.execute(
+                "CREATE TABLE IF NOT EXISTS cambios (version INTEGER PRIMARY KEY AUTOINCREMENT, fecha TEXT NOT NULL, creado REAL NOT NULL)"
+            )
+            self._conexion.commit()
+            self._version_vista = self._conexion.execute("SELECT COALESCE(MAX(version), 0) FROM cambios").fetchone()[0]
+
+    @classmethod
+    def desde_entorno(cls, service, calendar_id, al_cambiar=None):
+        return cls(
+            service,
+            calendar_id,
+            ruta=os.getenv("CALENDARIO_ESPEJO_RUTA", "calendario_espejo.db"),
+            intervalo=int(os.getenv("CALENDARIO_SINCRONIZACION_SEGUNDOS", "60")),
+            al_cambiar=al_cambiar,
+        )
+
+    # Las fechas se guardan en UTC con el mismo formato para poder compararlas como texto
+    def _a_texto(self, momento):
+        return momento.astimezone(pytz.utc).strftime("%Y-%m-%dT%H:%M:%S")
+
+    def _desde_texto(self, texto):
+        return dt.datetime.strptime(texto, "%Y-%m-%dT%H:%M:%S").replace(tzinfo=pytz.utc).astimezone(self.lima_tz)
+
+    def _fechas(self, inicio, fin):
+        """Fechas de Lima que abarca [inicio, fin)."""
+        fechas = set()
+        fecha = inicio.astimezone(self.lima_tz).date()
+        ultima = (fin.astimezone(self.lima_tz) - dt.timedelta(microseconds=1)).date()
+        while fecha <= ultima:
+            fechas.add(fecha.isoformat())
+            fecha += dt.timedelta(days=1)
+        return fechas
+
+    def _leer_estado(self, clave):
+        with self._lock:
+            fila = self._conexion.execute("SELECT valor FROM estado WHERE clave = ?", (clave,)).fetchone()
+        return fila[0] if fila else None
+
+    def _registrar_cambios(self, fechas):
+        """Anota las fechas cambiadas en el registro compartido. Se llama con el lock y dentro de la transacción."""
+        ahora = time.time()
+        self._conexion.executemany("INSERT INTO cambios (fecha, creado) VALUES (?, ?)", [(fecha, ahora) for fecha in fechas])
+
+    def _aplicar(self, eventos, token=None, tabla="eventos"):
+        """Aplica una página de eventos a `tabla` en una transacción y devuelve las fechas afectadas."""
+        fechas = set()
+        with self._lock:
+            for evento in eventos:
+                anterior = self._conexion.execute(f"SELECT inicio, fin FROM {tabla} WHERE id = ?", (evento["id"],)).fetchone()
+                if anterior:
+                    fechas |= self._fechas(self._desde_texto(anterior[0]), self._desde_texto(anterior[1]))
+                intervalo = intervalo_evento(evento, self.lima_tz)
+                if intervalo:
+                    self._conexion.execute(
+                        f"INSERT OR REPLACE INTO {tabla} (id, inicio, fin) VALUES (?, ?, ?)",
+                        (evento["id"], self._a_texto(intervalo[0]), self._a_texto(intervalo[1]))
+                    )
+                    fechas |= self._fechas(*intervalo)
+                else:
+                    # Cancelado o marcado como disponible: ya no ocupa la agenda
+                    self._conexion.execute(f"DELETE FROM {tabla} WHERE id = ?", (evento["id"],))
+            if tabla == "eventos":
+                self._registrar_cambios(fechas)
+            if token:
+                self._conexion.execute("INSERT OR REPLACE INTO estado (clave, valor) VALUES ('sync_token', ?)", (token,))
+            self._conexion.commit()
+            self._metricas["cambios"] += len(eventos)
+        return fechas
+
+    def _reemplazar_espejo(self, token):
+        """Reemplaza `eventos` por la lectura completa en una sola transacción y devuelve las fechas afectadas."""
+        fechas = set()
+        with self._lock:
+            # Cambian las fechas de los eventos que estaban y de los que quedan
+            for tabla in ("eventos", "eventos_completa"):
+                for inicio, fin in self._conexion.execute(f"SELECT inicio, fin FROM {tabla}").fetchall():
+                    fechas |= self._fechas(self._desde_texto(inicio), self._desde_texto(fin))
+            self._conexion.execute("DELETE FROM eventos")
+            self._conexion.execute("INSERT INTO eventos (id, inicio, fin) SELECT id, inicio, fin FROM eventos_completa")
+            self._conexion.execute("DELETE FROM eventos_completa")
+            self._conexion.execute("INSERT OR REPLACE INTO estado (clave, valor) VALUES ('sync_token', ?)", (token,))
+            self._registrar_cambios(fechas)
+            self._conexion.commit()
+        return fechas
+
+    def _leer_cambios(self):
+        """
+        Recorre las páginas de cambios desde el syncToken guardado y las aplica al espejo. Sin token hace
+        una lectura completa en `eventos_completa` y la aplica al final con `_reemplazar_espejo`.
+        """
+        token = self._leer_estado("sync_token")
+        completa = token is None
+        if completa:
+            with self._lock:
+                self._conexion.execute("DELETE FROM eventos_completa")
+                self._conexion.commit()
+        fechas = set()
+        page_token = None
+        while True:
+            parametros = {"calendarId": self.calendar_id, "singleEvents": True, "showDeleted": True,
+                          "maxResults": 250, "pageToken": page_token}
+            if token:
+                parametros["syncToken"] = token
+            resultado = self.service.events().list(**parametros).execute()
+            with self._lock:
+                self._metricas["paginas"] += 1
+            if completa:
+                self._aplicar(resultado.get("items", []), tabla="eventos_completa")
+            else:
+                fechas |= self._aplicar(resultado.get("items", []), resultado.get("nextSyncToken"))
+            page_token = resultado.get("nextPageToken")
+            if not page_token:
+                if completa:
+                    fechas = self._reemplazar_espejo(resultado.get("nextSyncToken"))
+                return fechas, completa
+
+    def sincronizar(self):
+        """
+        Trae los cambios desde el último syncToken (o todos los eventos si no hay token) y los aplica al espejo.
+        Si otro proceso está sincronizando el mismo archivo no hace nada y devuelve un conjunto vacío.
+        """
+        with self._lock_sincronizacion, open(f"{self.ruta}.lock", "a") as archivo_lock:
+            if fcntl:
+                try:
+                    fcntl.flock(archivo_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    with self._lock:
+                        self._metricas["omitidas"] += 1
+                    return set()
+            try:
+                try:
+                    fechas, completa = self._leer_cambios()
+                except HttpError as e:
+                    if e.resp.status != 410:
+                        raise
+                    print("Token de sincronización de Calendar vencido; se vuelve a leer el calendario completo")
+                    with self._lock:
+                        self._conexion.execute("DELETE FROM estado WHERE clave = 'sync_token'")
+                        self._conexion.commit()
+                    fechas, completa = self._leer_cambios()
+            except Exception:
+                with self._lock:
+                    self._metricas["errores"] += 1
+                raise
+            finally:
+                if fcntl:
+                    fcntl.flock(archivo_lock, fcntl.LOCK_UN)
+
+            self._podar()
+            with self._lock:
+                self._conexion.execute(
+                    "INSERT OR REPLACE INTO estado (clave, valor) VALUES ('ultima_sincronizacion', ?)", (str(time.time()),)
+                )
+                self._conexion.commit()
+                self._metricas["sincronizaciones"] += 1
+                self._metricas["completas"] += 1 if completa else 0
+        self.propagar_cambios()
+        return fechas
+
+    def propagar_cambios(self):
+        """Pasa a `al_cambiar` las fechas cambiadas (por este u otro proceso) desde la última llamada."""
+        with self._lock:
+            filas = self._conexion.execute(
+                "SELECT version, fecha FROM cambios WHERE version > ? ORDER BY version", (self._version_vista,)
+            ).fetchall()
+            if not filas:
+                return
+            self._version_vista = filas[-1][0]
+        if self.al_cambiar:
+            self.al_cambiar({fecha for _, fecha in filas})
+
+    def _sincronizar_seguro(self):
+        try:
+            self.sincronizar()
+        except Exception as e:
+            print(f"Error al sincronizar el calendario: {e}")
+
+    def _podar(self):
+        """Elimina del espejo los eventos que terminaron hace más de `dias_conservados` días."""
+        limite = dt.datetime.now(pytz.utc) - dt.timedelta(days=self.dias_conservados)
+        with self._lock:
+            self._conexion.execute("DELETE FROM eventos WHERE fin < ?", (self._a_texto(limite),))
+            # Un proceso que lleva más de un día sin leer el registro ya tiene sus cachés vencidas por TTL
+            self._conexion.execute("DELETE FROM cambios WHERE creado < ?", (time.time() - 86400,))
+            self._conexion.commit()
+
+    def registrar_evento(self, evento):
+        """Escribe en el espejo un evento recién creado por el bot, sin esperar a la próxima sincronización."""
+        self._aplicar([evento])
+        self.propagar_cambios()
+
+    def _segundos_desde_sincronizacion(self):
+        valor = self._leer_estado("ultima_sincronizacion")
+        return time.time() - float(valor) if valor else None
+
+    def vigente(self):
+        """Indica si algún proceso sincronizó el espejo hace menos de `max_retraso` segundos."""
+        segundos = self._segundos_desde_sincronizacion()
+        return segundos is not None and segundos < self.max_retraso
+
+    def ocupados(self, inicio, fin):
+        """Intervalos (inicio, fin) en hora de Lima de los eventos que se solapan con [inicio, fin)."""
+        with self._lock:
+            filas = self._conexion.execute(
+                "SELECT inicio, fin FROM eventos WHERE inicio < ? AND fin > ?",
+                (self._a_texto(fin), self._a_texto(inicio))
+            ).fetchall()
+            self._metricas["lecturas"] += 1
+        return [(self._desde_texto(a), self._desde_texto(b)) for a, b in filas]
+
+    def notificar(self):
+        """Pide una sincronización inmediata (p. ej. al recibir una notificación push de Calendar)."""
+        self._aviso.set()
+
+    def suscribir(self, direccion, token, ttl_segundos=7 * 24 * 3600):
+        """Registra un canal de notificaciones push de Calendar hacia `direccion` (URL https del webhook)."""
+        canal = self.service.events().watch(calendarId=self.calendar_id, body={
+            "id": uuid.uuid4().hex,
+            "type": "web_hook",
+            "address": direccion,
+            "token": token,
+            "params": {"ttl": str(ttl_segundos)},
+        }).execute()
+        with self._lock:
+            self._canal = {"direccion": direccion, "token": token, "ttl": ttl_segundos,
+                           "expira": int(canal.get("expiration", 0)) / 1000}
+        print("Canal de notificaciones de Calendar registrado:", canal.get("id"))
+        return canal
+
+    def _renovar_canal(self):
+        with self._lock:
+            canal = dict(self._canal) if self._canal else None
+        if canal and canal["expira"] - time.time() < 2 * self.intervalo:
+            self.suscribir(canal["direccion"], canal["token"], canal["ttl"])
+
+    def iniciar(self):
+        """Sincroniza en un hilo en segundo plano cada `intervalo` segundos o al recibir una notificación."""
+        if self._hilo is not None:
+            return
+        def _bucle():
+            while True:
+                forzada = self._aviso.is_set()
+                self._aviso.clear()
+                segundos = self._segundos_desde_sincronizacion()
+                # Si otro worker acaba de sincronizar basta con recoger sus cambios
+                if forzada or segundos is None or segundos >= self.intervalo / 2:
+                    self._sincronizar_seguro()
+                else:
+                    self.propagar_cambios()
+                try:
+                    self._renovar_canal()
+                except Exception as e:
+                    print(f"Error al renovar el canal de notificaciones de Calendar: {e}")
+                self._aviso.wait(self.intervalo)
+        self._hilo = threading.Thread(target=_bucle, daemon=True, name="sincronizacion-calendario")
+        self._hilo.start()
+
+    def metricas(self):
+        with self._lock:
+            metricas = dict(self._metricas)
+            metricas["eventos"] = self._conexion.execute("SELECT COUNT(*) FROM eventos").fetchone()[0]
+        segundos = self._segundos_desde_sincronizacion()
+        metricas["segundos_desde_sincronizacion"] = round(segundos, 1) if segundos is not None else None
+        metricas["vigente"] = self.vigente()
+        return metricas
@@ -0,0 +1,102 @@
+import asyncio
+import os
+import time
+
+class LeadCampaignGenerator:
+    """
+    Genera los mensajes de apertura de una página de leads antes de enviarlos.
+
+    Los prompts de toda la página se preparan de una vez y se ejecutan con concurrencia acotada
+    (`max_concurrencia`) sobre la API asíncrona de OpenAIManager, o bien como un batch offline de
+    OpenAI (`modo_lote`). Cada resultado se guarda en MongoDB por campaña y lead, así que si el proceso
+    se cae a mitad de la campaña, al reanudarla solo se generan los leads que faltan.
+    """
+
+    def __init__(self, openai_manager, db_mongo_manager, max_concurrencia=8, modo_lote=False, intervalo_lote=60):
+        self.openai = openai_manager
+        self.db = db_mongo_manager
+        self.max_concurrencia = max_concurrencia
+        self.modo_lote = modo_lote
+        self.intervalo_lote = intervalo_lote
+
+    @classmethod
+    def desde_entorno(cls, openai_manager, db_mongo_manager):
+        return cls(
+            openai_manager,
+            db_mongo_manager,
+            max_concurrencia=int(os.getenv("CAMPANA_MAX_CONCURRENCIA", "8")),
+            modo_lote=os.getenv("CAMPANA_MODO_LOTE", "0") == "1",
+        )
+
+    def generar(self, campana_id, peticiones):
+        """
+        Devuelve {lead_id: resultado} para todos los leads de `peticiones` ({lead_id: (messages, etiqueta)},
+        como las devuelven mensajes_lead y mensajes_lead_zoho; la etiqueta atribuye la llamada en las métricas).
+
+        Los leads que ya tienen un resultado guardado para `campana_id` no se vuelven a generar.
+        Los leads cuya generación falla no aparecen en el resultado.
+        """
+        resultados = {
+            lead_id: resultado
+            for lead_id, resultado in self.db.obtener_generaciones_campana(campana_id).items()
+            if lead_id in peticiones
+        }
+        pendientes = {lead_id: peticion for lead_id, peticion in peticiones.items() if lead_id not in resultados}
+        print(f"Campaña {campana_id}: {len(resultados)} leads ya generados, {len(pendientes)} pendientes")
+        if not pendientes:
+            return resultados
+
+        inicio = time.perf_counter()
+        if self.modo_lote:
+            nuevos = self._generar_lote(campana_id, pendientes)
+        else:
+            nuevos = asyncio.run(self._generar_concurrente(campana_id, pendientes))
+        print(f"Campaña {campana_id}: {len(nuevos)}/{len(pendientes)} leads generados en {time.perf_counter() - inicio:.1f}s")
+        resultados.update(nuevos)
+        return resultados
+
+    async def _generar_concurrente(self, campana_id, pendientes):
+        semaforo = asyncio.Semaphore(self.max_concurrencia)
+
+        async def generar_lead(lead_id, messages, etiqueta):
+            async with semaforo:
+                try:
+                    resultado = await self.openai.aconsulta_lead(messages, prompt=etiqueta)
+                except Exception as e:
+                    print(f"Error al generar el mensaje del lead {lead_id}: {e}")
+                    return lead_id, None
+            # Se guarda en cuanto está listo para no perderlo si el proceso se cae
+            await asyncio.to_thread(self.db.guardar_generacion_campana, campana_id, lead_id, resultado)
+            return lead_id, resultado
+
+        generados = await asyncio.gather(*(
+            generar_lead(lead_id, messages, etiqueta) for lead_id, (messages, etiqueta) in pendientes.items()
+        ))
+        return {lead_id: resultado for lead_id, resultado in generados if resultado}
+
+    def _generar_lote(self, campana_id, pendientes):
+        """Envía (o retoma) el batch de la campaña y espera sus resultados."""
+        lote = self.db.obtener_lote_campana(campana_id)
+        if lote:
+            batch_id = lote["batch_id"]
+            print(f"Campaña {campana_id}: retomando el batch {batch_id}")
+        else:
+            batch_id = self.openai.crear_lote({lead_id: messages for lead_id, (messages, _) in pendientes.items()})
+            self.db.guardar_lote_campana(campana_id, batch_id)
+
+        while True:
+            estado, resultados = self.openai.obtener_lote(batch_id)
+            if estado in ("completed", "failed", "expired", "cancelled"):
+                break
+            print(f"Campaña {campana_id}: batch {batch_id} en estado {estado}")
+            time.sleep(self.intervalo_lote)
+
+        self.db.guardar_lote_campana(campana_id, batch_id, estado)
+        nuevos = {}
+        for lead_id, resultado in resultados.items():
+            if lead_id in pendientes:
+                self.db.guardar_generacion_campana(campana_id, lead_id, resultado)
+                nuevos[lead_id] = resultado
+        if estado != "completed":
+            print(f"Campaña {campana_id}: el batch {batch_id} terminó en estado {estado}")
+        return nuevos
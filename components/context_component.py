@@ -0,0 +1,73 @@
+from helpers.helpers import formatear_conversacion, contar_tokens
+
+class ConversationContextManager:
+    """
+    Mantiene acotado el contexto de la conversación activa que se envía al modelo.
+
+    Los últimos turnos se envían tal cual, dentro de un máximo de turnos y de un presupuesto de tokens;
+    los turnos más antiguos se pliegan en un resumen incremental que se guarda junto a la conversación en
+    MongoDB (campos "resumen" e "interacciones_resumidas"). Así los tokens de entrada por turno no crecen
+    con la duración de la conversación.
+    """
+
+    def __init__(self, openai_manager, db_mongo_manager, max_turnos=12, presupuesto_tokens=1500):
+        self.openai = openai_manager
+        self.db = db_mongo_manager
+        self.max_turnos = max_turnos
+        self.presupuesto_tokens = presupuesto_tokens
+
+    def _ventana(self, interacciones, max_turnos, presupuesto_tokens):
+        """Devuelve los últimos turnos que caben en el límite de turnos y de tokens (siempre al menos el último)."""
+        ventana = []
+        tokens = 0
+        for interaccion in reversed(interacciones[-max_turnos:]):
+            tokens_turno = contar_tokens(formatear_conversacion({"interacciones": [interaccion]}))
+            if ventana and tokens + tokens_turno > presupuesto_tokens:
+                break
+            ventana.insert(0, interaccion)
+            tokens += tokens_turno
+        return ventana
+
+    def _pendientes(self, conversacion):
+        """Interacciones que todavía no se han plegado en el resumen."""
+        return conversacion.get("interacciones", [])[conversacion.get("interacciones_resumidas", 0):]
+
+    def preparar(self, conversacion):
+        """
+        Devuelve una vista de la conversación para los prompts: el resumen guardado más los turnos
+        recientes que caben en la ventana. No modifica la conversación original.
+        """
+        if not conversacion:
+            return conversacion
+        vista = dict(conversacion)
+        vista["interacciones"] = self._ventana(self._pendientes(conversacion), self.max_turnos, self.presupuesto_tokens)
+        return vista
+
+    def compactar(self, celular, conversacion):
+        """
+        Pliega en el resumen los turnos que ya no entran en la ventana y lo guarda en MongoDB.
+
+        Cuando hay desborde se compacta hasta la mitad de la ventana, de modo que la llamada de
+        resumen se hace cada varios turnos y no en cada mensaje.
+        """
+        if not conversacion:
+            return
+        pendientes = self._pendientes(conversacion)
+        if len(self._ventana(pendientes, self.max_turnos, self.presupuesto_tokens)) == len(pendientes):
+            return
+
+        conservar = self._ventana(pendientes, max(1, self.max_turnos // 2), self.presupuesto_tokens // 2)
+        a_resumir = pendientes[:len(pendientes) - len(conservar)]
+        try:
+            resumen = self.openai.resumir_conversacion(
+                conversacion.get("resumen", ""),
+                formatear_conversacion({"interacciones": a_resumir})
+            )
+        except Exception as e:
+            print(f"Error al resumir la conversación de {celular}: {e}")
+            return
+        self.db.guardar_resumen_conversacion(
+            celular,
+            resumen,
+            conversacion.get("interacciones_resumidas", 0) + len(a_resumir)
+        )
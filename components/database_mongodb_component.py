@@ -1,4 +1,5 @@
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
 from datetime import datetime
 import pytz
 
@@ -149,7 +150,31 @@ class DataBaseMongoDBManager:
                     )
                     return "Respuesta guardada en la última interacción"
         
-        return "No se encontró una conversación activa"     
+        return "No se encontró una conversación activa"
+
+    def guardar_respuesta_interaccion_chatbot(self, celular, conversacion_id, indice, respuesta_chatbot):
+        self._reconnect_if_needed()  # Verifica o reconecta
+        """
+        Guarda la respuesta del chatbot en la interacción `indice` de la conversación indicada.
+        Solo modifica esa interacción, de modo que no pisa los mensajes que el cliente haya enviado después.
+        """
+        cliente = self.db.clientes.find_one(
+            {"celular": celular, "conversaciones.conversacion_id": conversacion_id},
+            {"conversaciones.$": 1}
+        )
+        if not cliente:
+            return "No se encontró la conversación"
+        interacciones = cliente["conversaciones"][0].get("interacciones", [])
+        if indice >= len(interacciones):
+            return "No se encontró la interacción"
+
+        previa = interacciones[indice].get("mensaje_chatbot") or ""
+        self.db.clientes.update_one(
+            {"celular": celular, "conversaciones.conversacion_id": conversacion_id},
+            {"$set": {f"conversaciones.$.interacciones.{indice}.mensaje_chatbot":
+                      f"{previa} | {respuesta_chatbot}" if previa else respuesta_chatbot}}
+        )
+        return "Respuesta guardada en la interacción"
 
     def guardar_mensaje_cliente_ultima_interaccion(self, celular, mensaje_cliente):
         self._reconnect_if_needed()  # Verifica o reconecta
@@ -182,6 +207,18 @@ class DataBaseMongoDBManager:
         
         return "No se encontró una conversación activa"    
     
+    def guardar_resumen_conversacion(self, celular, resumen, interacciones_resumidas):
+        self._reconnect_if_needed()  # Verifica o reconecta
+        """Guarda el resumen incremental de la conversación activa y cuántas interacciones (desde el inicio) cubre."""
+        self.db.clientes.update_one(
+            {"celular": celular, "conversaciones.estado": "activa"},
+            {"$set": {
+                "conversaciones.$.resumen": resumen,
+                "conversaciones.$.interacciones_resumidas": interacciones_resumidas
+            }}
+        )
+        print(f"Resumen de conversación actualizado para el cliente con celular {celular} ({interacciones_resumidas} interacciones).")
+
     def crear_nueva_interaccion(self, celular, mensaje_cliente):
         self._reconnect_if_needed()  # Verifica o reconecta
         """Crea una nueva interacción en la conversación activa del cliente."""
@@ -292,3 +329,77 @@ class DataBaseMongoDBManager:
         
         print(f"Cliente con celular {celular} actualizado con éxito.")
         return "Cliente actualizado correctamente."
+
+    def obtener_generaciones_campana(self, campana_id):
+        self._reconnect_if_needed()  # Verifica o reconecta
+        """Devuelve {lead_id: resultado} con los mensajes ya generados para una campaña."""
+        return {
+            generacion["lead_id"]: generacion["resultado"]
+            for generacion in self.db.generaciones_campana.find({"campana_id": campana_id})
+        }
+
+    def guardar_generacion_campana(self, campana_id, lead_id, resultado):
+        self._reconnect_if_needed()  # Verifica o reconecta
+        """Guarda el mensaje generado para un lead de la campaña (idempotente por campaña y lead)."""
+        self.db.generaciones_campana.update_one(
+            {"campana_id": campana_id, "lead_id": lead_id},
+            {"$set": {"resultado": resultado, "fecha": datetime.now(self.lima_tz).astimezone(pytz.utc)}},
+            upsert=True
+        )
+
+    def obtener_lote_campana(self, campana_id):
+        self._reconnect_if_needed()  # Verifica o reconecta
+        """Devuelve el batch de OpenAI pendiente de la campaña, si existe."""
+        return self.db.lotes_campana.find_one({"campana_id": campana_id, "estado": "pendiente"})
+
+    def guardar_lote_campana(self, campana_id, batch_id, estado="pendiente"):
+        self._reconnect_if_needed()  # Verifica o reconecta
+        """Registra el batch de OpenAI de una campaña para poder retomarlo si el proceso se reinicia."""
+        self.db.lotes_campana.update_one(
+            {"campana_id": campana_id, "batch_id": batch_id},
+            {"$set": {"estado": estado, "fecha": datetime.now(self.lima_tz).astimezone(pytz.utc)}},
+            upsert=True
+        )
+
+    def crear_indices_reservas(self):
+        self._reconnect_if_needed()  # Verifica o reconecta
+        """Índices de las retenciones de horario: TTL sobre `expira` y búsqueda por reserva."""
+        self.db.reservas_horario.create_index("expira", expireAfterSeconds=0)
+        self.db.reservas_horario.create_index("reserva_id")
+
+    def retener_celdas(self, celdas, reserva_id, celular, expira):
+        self._reconnect_if_needed()  # Verifica o reconecta
+        """
+        Reclama para una reserva las celdas de horario indicadas. Cada celda es un documento con la celda
+        como _id, así que solo una reserva puede insertarlo. Devuelve True si obtuvo todas; si alguna está
+        tomada libera las que alcanzó a retener y devuelve False. Las retenciones vencidas (retenidas o
+        confirmadas) que el índice TTL todavía no borró se reemplazan.
+        """
+        ahora = datetime.now(pytz.utc)
+        for celda in celdas:
+            retencion = {"_id": celda, "reserva_id": reserva_id, "celular": celular, "estado": "retenida", "expira": expira}
+            try:
+                self.db.reservas_horario.insert_one(retencion)
+            except DuplicateKeyError:
+                # El reemplazo solo ocurre si la retención sigue vencida en ese momento (operación atómica)
+                vencida = self.db.reservas_horario.find_one_and_replace(
+                    {"_id": celda, "expira": {"$lt": ahora}}, retencion
+                )
+                if vencida is None:
+                    self.liberar_celdas(reserva_id)
+                    return False
+        return True
+
+    def confirmar_celdas(self, reserva_id, evento_id, expira):
+        self._reconnect_if_needed()  # Verifica o reconecta
+        """Marca como confirmadas las celdas de una reserva con evento en Calendar; se conservan hasta `expira`
+        (solo mientras las cachés de disponibilidad pueden no ver el evento)."""
+        self.db.reservas_horario.update_many(
+            {"reserva_id": reserva_id},
+            {"$set": {"estado": "confirmada", "evento_id": evento_id, "expira": expira}}
+        )
+
+    def liberar_celdas(self, reserva_id):
+        self._reconnect_if_needed()  # Verifica o reconecta
+        """Libera las celdas retenidas por una reserva que no llegó a confirmarse."""
+        self.db.reservas_horario.delete_many({"reserva_id": reserva_id, "estado": "retenida"})
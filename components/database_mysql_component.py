@@ -1,11 +1,24 @@
+import functools
+import threading
 import mysql.connector
 from mysql.connector import Error
 from datetime import datetime
 
+def _sincronizado(metodo):
+    """Ejecuta el método con el lock de la conexión tomado (todas las operaciones comparten self.connection)."""
+    @functools.wraps(metodo)
+    def envoltura(self, *args, **kwargs):
+        with self._lock:
+            return metodo(self, *args, **kwargs)
+    return envoltura
+
 class DataBaseMySQLManager:
     def __init__(self):
+        # La conexión de mysql.connector no es segura entre hilos (Timers, especulación, tareas de fondo)
+        self._lock = threading.RLock()
         self.connection = self._connect()
 
+    @_sincronizado
     def _reconnect_if_needed(self):
         """Reconnects if the current connection is not active."""
         if not self.connection.is_connected():
@@ -31,6 +44,7 @@ class DataBaseMySQLManager:
             print(f"Error al conectar a MySQL: {e}")
             return None
 
+    @_sincronizado
     def obtener_id_cliente_por_celular(self, celular):
         self._reconnect_if_needed()
         """Obtiene el cliente_id usando el número de celular."""
@@ -40,11 +54,13 @@ class DataBaseMySQLManager:
         result = cursor.fetchone()
         return result[0] if result else None
 
+    @_sincronizado
     def existe_cliente_por_celular(self, celular):
         self._reconnect_if_needed()
         """Verifica si un cliente ya existe en la base de datos usando el número de celular."""
         return self.obtener_id_cliente_por_celular(celular) is not None
 
+    @_sincronizado
     def insertar_cliente(self, documento_identidad, tipo_documento, nombre, apellido, celular, email,estado="activo"):
         self._reconnect_if_needed()
         """Inserta un nuevo cliente en la tabla de clientes si no existe ya."""
@@ -60,6 +76,7 @@ class DataBaseMySQLManager:
             print("El cliente ya existe en MySQL.")
             return self.obtener_id_cliente_por_celular(celular)
 
+    @_sincronizado
     def obtener_cliente(self, cliente_id):
         self._reconnect_if_needed()
         """Obtiene los datos de un cliente por su ID."""
@@ -68,6 +85,7 @@ class DataBaseMySQLManager:
         cursor.execute(query, (cliente_id,))
         return cursor.fetchone()
 
+    @_sincronizado
     def insertar_lead(self, cliente_id, fecha_contacto, prioridad_lead, lead_source, campaña=None, canal_lead=None, estado_lead="nuevo", notas=None):
         self._reconnect_if_needed()
         """Inserta un nuevo lead para un cliente en la tabla de leads."""
@@ -78,6 +96,7 @@ class DataBaseMySQLManager:
         self.connection.commit()
         return cursor.lastrowid
     
+    @_sincronizado
     def insertar_lead_zoho(self, cliente_id, fecha_contacto, prioridad_lead, lead_source, campaña=None, canal_lead=None, estado_lead="nuevo", notas=None, tipo_lead=None):
         self._reconnect_if_needed()
         """Inserta un nuevo lead para un cliente en la tabla de leads."""
@@ -88,6 +107,7 @@ class DataBaseMySQLManager:
         self.connection.commit()
         return cursor.lastrowid
 
+    @_sincronizado
     def obtener_leads_cliente(self, cliente_id):
         self._reconnect_if_needed()
         """Obtiene todos los leads de un cliente."""
@@ -96,6 +116,7 @@ class DataBaseMySQLManager:
         cursor.execute(query, (cliente_id,))
         return cursor.fetchall()
 
+    @_sincronizado
     def insertar_cita(self, cliente_id, fecha_cita, motivo, estado_cita="agendada", conversacion_id=None):
         self._reconnect_if_needed()
         """Inserta una nueva cita para un cliente en la tabla de citas."""
@@ -106,6 +127,7 @@ class DataBaseMySQLManager:
         self.connection.commit()
         return cursor.lastrowid
 
+    @_sincronizado
     def obtener_citas_cliente(self, cliente_id):
         self._reconnect_if_needed()
         """Obtiene todas las citas de un cliente."""
@@ -114,6 +136,7 @@ class DataBaseMySQLManager:
         cursor.execute(query, (cliente_id,))
         return cursor.fetchall()
 
+    @_sincronizado
     def insertar_pago(self, cliente_id, cita_id, fecha_pago, monto, metodo_pago, estado_pago="pendiente"):
         self._reconnect_if_needed()
         """Inserta un nuevo pago para un cliente en la tabla de pagos."""
@@ -124,6 +147,7 @@ class DataBaseMySQLManager:
         self.connection.commit()
         return cursor.lastrowid
 
+    @_sincronizado
     def obtener_pagos_cliente(self, cliente_id):
         self._reconnect_if_needed()
         """Obtiene todos los pagos de un cliente."""
@@ -132,6 +156,7 @@ class DataBaseMySQLManager:
         cursor.execute(query, (cliente_id,))
         return cursor.fetchall()
 
+    @_sincronizado
     def insertar_conversacion(self, cliente_id, mensaje, tipo_conversacion, resultado=None, estado_conversacion="activa"):
         self._reconnect_if_needed()
         """Inserta una nueva conversación para un cliente en la tabla de conversaciones."""
@@ -142,6 +167,7 @@ class DataBaseMySQLManager:
         self.connection.commit()
         return cursor.lastrowid
 
+    @_sincronizado
     def obtener_conversaciones_cliente(self, cliente_id, estado_conversacion=None):
         self._reconnect_if_needed()
         """Obtiene todas las conversaciones de un cliente, filtrando opcionalmente por estado."""
@@ -154,6 +180,7 @@ class DataBaseMySQLManager:
             cursor.execute(query, (cliente_id,))
         return cursor.fetchall()
 
+    @_sincronizado
     def actualizar_estado_conversacion(self, conversacion_id, nuevo_estado):
         self._reconnect_if_needed()
         """Actualiza el estado de una conversación a 'completada' o 'activa'."""
@@ -162,6 +189,7 @@ class DataBaseMySQLManager:
         cursor.execute(query, (nuevo_estado, conversacion_id))
         self.connection.commit()
 
+    @_sincronizado
     def obtener_conversacion_activa(self, cliente_id):
         self._reconnect_if_needed()
         """Obtiene la conversación activa actual de un cliente, si existe."""
@@ -170,6 +198,7 @@ class DataBaseMySQLManager:
         cursor.execute(query, (cliente_id,))
         return cursor.fetchone()
 
+    @_sincronizado
     def actualizar_estado_lead(self, lead_id, nuevo_estado):
         self._reconnect_if_needed()
         """Actualiza el estado de un lead en la tabla de leads."""
@@ -179,6 +208,7 @@ class DataBaseMySQLManager:
         self.connection.commit()
         print(f"Estado del lead {lead_id} actualizado a '{nuevo_estado}'.")
 
+    @_sincronizado
     def actualizar_estado_cliente(self, client_id, nuevo_estado):
         self._reconnect_if_needed()
         cursor = self.connection.cursor()
@@ -187,6 +217,7 @@ class DataBaseMySQLManager:
         self.connection.commit()
         print(f"Estado del cliente {client_id} actualizado a {nuevo_estado}.")
        
+    @_sincronizado
     def actualizar_estado_cliente_no_interes(self, client_id, nuevo_estado,categoria_no_interes,detalle_no_interes):
         self._reconnect_if_needed()
         cursor = self.connection.cursor()
@@ -195,6 +226,7 @@ class DataBaseMySQLManager:
         self.connection.commit()
         print(f"Estado del cliente {client_id} actualizado a {nuevo_estado}.")        
     
+    @_sincronizado
     def actualizar_fecha_ultima_interaccion(self, cliente_id, fecha):
         self._reconnect_if_needed()
         cursor = self.connection.cursor()
@@ -212,6 +244,7 @@ class DataBaseMySQLManager:
         self.connection.commit()
         cursor.close()
 
+    @_sincronizado
     def actualizar_fecha_ultima_interaccion_bot(self, cliente_id, fecha):
         self._reconnect_if_needed()
         cursor = self.connection.cursor()
@@ -230,6 +263,7 @@ class DataBaseMySQLManager:
         cursor.close()
 
     
+    @_sincronizado
     def obtener_citas_pendientes(self):
         self._reconnect_if_needed()
         cursor = self.connection.cursor(dictionary=True)
@@ -243,6 +277,7 @@ class DataBaseMySQLManager:
         cursor.close()
         return citas
     
+    @_sincronizado
     def obtener_todos_los_clientes(self):
         self._reconnect_if_needed()
         """Obtiene los datos de un cliente por su ID."""
@@ -250,6 +285,7 @@ class DataBaseMySQLManager:
         query = "SELECT * FROM clientes"
         cursor.execute(query)
         return cursor.fetchall()
+    @_sincronizado
     def obtener_citas_pasadas(self, fecha_actual):
         self._reconnect_if_needed()
         cursor = self.connection.cursor(dictionary=True)
@@ -262,6 +298,7 @@ class DataBaseMySQLManager:
         cursor.close()
         return citas
     
+    @_sincronizado
     def actualizar_estado_cita(self, cita_id, nuevo_estado):
         self._reconnect_if_needed()
         cursor = self.connection.cursor()
@@ -270,6 +307,7 @@ class DataBaseMySQLManager:
         self.connection.commit()
         cursor.close()
 
+    @_sincronizado
     def obtener_estado_cliente(self, cliente_id):
         self._reconnect_if_needed()
         cursor = self.connection.cursor()
@@ -279,6 +317,7 @@ class DataBaseMySQLManager:
         cursor.close()
         return estado
     
+    @_sincronizado
     def actualizar_nombre_cliente(self, cliente_id, nombre):
         self._reconnect_if_needed()
         cursor = self.connection.cursor()
@@ -287,6 +326,7 @@ class DataBaseMySQLManager:
         self.connection.commit()
         cursor.close()
 
+    @_sincronizado
     def actualizar_estado_historico_cliente(self, cliente_id, nuevo_estado):
         self._reconnect_if_needed()
         cursor = self.connection.cursor()
@@ -310,6 +350,7 @@ class DataBaseMySQLManager:
         self.connection.commit()
         cursor.close()
 
+    @_sincronizado
     def agregar_pago_y_confirmar_cita(self, cliente_id, monto, metodo_pago):
         """
         Agrega un pago relacionado a la cita más próxima del cliente en estado 'agendada'
@@ -359,4 +400,4 @@ class DataBaseMySQLManager:
         cursor.close()
         
         print(f"Pago agregado y cita {cita_id} confirmada para el cliente {cliente_id}.")
-        return pago_id
\ No newline at end of file
+        return pago_id
@@ -0,0 +1,132 @@
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from helpers.helpers import normalizar_texto
+
+# Palabras que indican que el mensaje es una pregunta que se puede responder con el FAQ
+PATRON_PREGUNTA = r"(\?|\b(cuanto|cuanta|como|que|cual|cuales|donde|duele|dura|demora|precio|costo|tecnica)\b)"
+
+# Marca que reemplaza al nombre del cliente dentro de las respuestas guardadas
+MARCA_NOMBRE = "[[NOMBRE]]"
+
+class FAQAnswerCache:
+    """
+    Caché semántico de respuestas a preguntas frecuentes.
+
+    La clave es el último mensaje del cliente normalizado y vectorizado localmente (palabras y bigramas)
+    junto con el estado del cliente y el mensaje previo del asesor. Una consulta acierta si la similitud
+    coseno con una pregunta guardada supera `umbral` y la del mensaje previo supera `umbral_contexto`: un
+    acierto se salta la clasificación, así que una pregunta que depende del contexto ("¿y cuánto cuesta?"
+    tras hablar de un servicio, o en medio de una reserva) no debe responderse con la de otra conversación.
+    Las entradas se desalojan por LRU (`max_entradas` por partición) y por TTL.
+    Las respuestas se guardan con el nombre del cliente como marca para reutilizarlas con otros clientes.
+    """
+
+    def __init__(self, umbral=0.88, umbral_contexto=0.7, max_entradas=300, ttl_segundos=6 * 3600, min_palabras=3):
+        self.umbral = umbral
+        self.umbral_contexto = umbral_contexto
+        self.max_entradas = max_entradas
+        self.ttl_segundos = ttl_segundos
+        self.min_palabras = min_palabras
+        self._particiones = {}
+        self._lock = threading.Lock()
+        self._metricas = {"consultas": 0, "aciertos": 0, "fallos": 0, "guardadas": 0, "expiradas": 0, "desalojadas": 0}
+
+    def _vectorizar(self, texto):
+        """Vector disperso normalizado (L2) de palabras y bigramas del texto normalizado."""
+        palabras = re.findall(r"[a-z0-9ñ]+", texto)
+        terminos = palabras + [f"{a} {b}" for a, b in zip(palabras, palabras[1:])]
+        vector = {}
+        for termino in terminos:
+            vector[termino] = vector.get(termino, 0.0) + 1.0
+        norma = math.sqrt(sum(peso * peso for peso in vector.values())) or 1.0
+        return {termino: peso / norma for termino, peso in vector.items()}
+
+    def _similitud(self, vector_a, vector_b):
+        if not vector_a or not vector_b:
+            # Sin mensaje previo del asesor solo coincide con otra entrada sin mensaje previo
+            return 1.0 if not vector_a and not vector_b else 0.0
+        if len(vector_a) > len(vector_b):
+            vector_a, vector_b = vector_b, vector_a
+        return sum(peso * vector_b.get(termino, 0.0) for termino, peso in vector_a.items())
+
+    def _pregunta(self, conversacion):
+        """Último mensaje del cliente normalizado, o None si no parece una pregunta cacheable."""
+        interacciones = (conversacion or {}).get("interacciones", [])
+        if not interacciones:
+            return None
+        texto = normalizar_texto(interacciones[-1].get("mensaje_cliente", "") or "")
+        if len(texto.split()) < self.min_palabras or not re.search(PATRON_PREGUNTA, texto):
+            return None
+        return texto
+
+    def _contexto(self, conversacion):
+        """Mensaje del asesor que precede a la pregunta, normalizado ("" si no hay)."""
+        interacciones = (conversacion or {}).get("interacciones", [])
+        if len(interacciones) < 2:
+            return ""
+        return normalizar_texto(interacciones[-2].get("mensaje_chatbot", "") or "")
+
+    def _particion(self, conversacion, estado):
+        # La primera respuesta incluye la presentación de Sofía, así que no se mezcla con las siguientes
+        primer_mensaje = len(conversacion.get("interacciones", [])) == 1 and not conversacion.get("resumen")
+        return (estado or "", primer_mensaje)
+
+    def buscar(self, conversacion, estado, nombre=""):
+        """Devuelve la respuesta guardada para una pregunta similar, personalizada con `nombre`, o None."""
+        texto = self._pregunta(conversacion)
+        if texto is None:
+            return None
+        vector = self._vectorizar(texto)
+        vector_contexto = self._vectorizar(self._contexto(conversacion))
+        ahora = time.monotonic()
+        with self._lock:
+            self._metricas["consultas"] += 1
+            entradas = self._particiones.get(self._particion(conversacion, estado), OrderedDict())
+            mejor_clave, mejor_similitud = None, 0.0
+            for clave, entrada in list(entradas.items()):
+                if ahora - entrada["creada"] > self.ttl_segundos:
+                    del entradas[clave]
+                    self._metricas["expiradas"] += 1
+                    continue
+                similitud = self._similitud(vector, entrada["vector"])
+                if similitud > mejor_similitud and self._similitud(vector_contexto, entrada["contexto"]) >= self.umbral_contexto:
+                    mejor_clave, mejor_similitud = clave, similitud
+            if mejor_clave is None or mejor_similitud < self.umbral:
+                self._metricas["fallos"] += 1
+                return None
+            entradas.move_to_end(mejor_clave)
+            self._metricas["aciertos"] += 1
+            respuesta = entradas[mejor_clave]["respuesta"]
+        print(f"Acierto en caché de FAQ (similitud {mejor_similitud:.2f}): {mejor_clave[0]}")
+        return respuesta.replace(MARCA_NOMBRE, nombre or "").replace(" ,", ",")
+
+    def guardar(self, conversacion, estado, respuesta, nombre=""):
+        """Guarda la respuesta a la última pregunta del cliente si es una pregunta cacheable."""
+        texto = self._pregunta(conversacion)
+        if texto is None or not respuesta:
+            return
+        if nombre and len(nombre.strip()) > 1:
+            # Solo la palabra completa: "Ana" no debe reemplazarse dentro de "mañana" o "semana"
+            respuesta = re.sub(rf"(?<!\w){re.escape(nombre.strip())}(?!\w)", MARCA_NOMBRE, respuesta)
+        contexto = self._contexto(conversacion)
+        clave = (texto, contexto)
+        with self._lock:
+            entradas = self._particiones.setdefault(self._particion(conversacion, estado), OrderedDict())
+            entradas[clave] = {"vector": self._vectorizar(texto), "contexto": self._vectorizar(contexto),
+                               "respuesta": respuesta, "creada": time.monotonic()}
+            entradas.move_to_end(clave)
+            self._metricas["guardadas"] += 1
+            while len(entradas) > self.max_entradas:
+                entradas.popitem(last=False)
+                self._metricas["desalojadas"] += 1
+
+    def metricas(self):
+        """Contadores del caché y tasa de aciertos."""
+        with self._lock:
+            metricas = dict(self._metricas)
+            metricas["entradas"] = sum(len(entradas) for entradas in self._particiones.values())
+        metricas["tasa_aciertos"] = round(metricas["aciertos"] / metricas["consultas"], 3) if metricas["consultas"] else 0.0
+        return metricas
@@ -0,0 +1,174 @@
+import re
+import random
+import threading
+from datetime import datetime
+import pytz
+from helpers.helpers import extract_datetime, normalizar_texto
+
+# Frases de no interés explícito (sobre el texto normalizado, sin tildes)
+PATRONES_NO_INTERES = [
+    r"\bno me interesa\b",
+    r"\bno estoy interesad[oa]\b",
+    r"\bya no (me )?interesa\b",
+    r"\bno (quiero|deseo) (nada|el servicio|el tratamiento|la cita|agendar)\b",
+    r"^no gracias$",
+]
+
+# Categorías de no interés de prompt_intencionesv2 y sus palabras clave
+CATEGORIAS_NO_INTERES = [
+    ("Precio", r"\b(caro|cara|precio|precios|costo|dinero|plata|monto|presupuesto)\b"),
+    ("Ubicación", r"\b(lejos|ubicacion|distancia)\b"),
+    ("Horarios", r"\b(horario|horarios|tiempo)\b"),
+    ("Preferencias", r"\b(otra clinica|otro lugar|otro doctor|prefiero)\b"),
+]
+
+# Palabras que indican que el cliente pregunta por disponibilidad en lugar de confirmar un horario
+PATRON_DISPONIBILIDAD = r"(\?|disponib|horario|libre|tienen|hay cupo|atienden)"
+
+# Palabras con las que el cliente confirma un horario; sin ellas la reserva la decide el LLM
+PATRON_CONFIRMACION = (
+    r"\b(confirm\w*|reserv\w*|agend\w*|separ\w*|quiero|quisiera|me queda bien|me parece bien|esta bien|"
+    r"perfecto|dale|listo|de acuerdo)\b"
+)
+
+# Negaciones o cambios de fecha que impiden tomar el mensaje como confirmación
+PATRON_NEGACION = r"\b(no|nunca|tampoco|otro dia|otra fecha|otro horario|otra hora|mejor otro|mejor otra)\b"
+
+# Palabras que descartan que una respuesta corta sea un nombre
+PALABRAS_NO_NOMBRE = {
+    "si", "no", "ok", "okey", "hola", "gracias", "claro", "bueno", "dale", "listo", "perfecto",
+    "buenas", "buenos", "dias", "tardes", "noches", "ya", "aja", "vale", "genial", "quiero", "que",
+    "cuanto", "como", "donde", "cuando", "info", "informacion", "precio", "cita", "me", "mi", "el",
+    "la", "de", "por", "para", "con", "y", "es", "un", "una", "hay", "tiene", "tienen", "puedo", "necesito",
+    # Fechas y momentos del día: tras pedir el nombre también pueden responder cuándo quieren la cita
+    "hoy", "manana", "pasado", "ayer", "tarde", "noche", "mediodia", "semana", "mes", "proximo", "proxima",
+    "lunes", "martes", "miercoles", "jueves", "viernes", "sabado", "domingo",
+    "enero", "febrero", "marzo", "abril", "mayo", "junio", "julio", "agosto", "septiembre", "setiembre",
+    "octubre", "noviembre", "diciembre",
+}
+
+PATRON_NOMBRE_EXPLICITO = r"^(?:me llamo|mi nombre es)\s+([a-záéíóúüñ]+(?:\s+[a-záéíóúüñ]+){0,3})$"
+# "soy ..." también introduce lugares o estados ("soy de lima", "soy nuevo"): solo se considera si se pidió el nombre
+PATRON_NOMBRE_SOY = r"^soy\s+([a-záéíóúüñ]+(?:\s+[a-záéíóúüñ]+){0,3})$"
+PATRON_NOMBRE_SUELTO = r"^[a-záéíóúüñ]+(?:\s+[a-záéíóúüñ]+){0,3}$"
+
+class LocalIntentClassifier:
+    """
+    Clasificador local de intenciones basado en reglas, previo a clasificar_intencion.
+
+    Devuelve resultados con el mismo formato JSON que prompt_intencionesv2 (`{"intencion": n, ...}`)
+    junto con una confianza. Cuando la confianza supera `umbral` la intención se usa directamente y se
+    evita la llamada al modelo; en otro caso se recurre al LLM. Una fracción `tasa_muestreo` de las
+    decisiones confiables se verifica igualmente contra el LLM para medir la tasa de concordancia.
+    """
+
+    def __init__(self, umbral=0.9, tasa_muestreo=0.1):
+        self.umbral = umbral
+        self.tasa_muestreo = tasa_muestreo
+        self.lima_tz = pytz.timezone("America/Lima")
+        self._lock = threading.Lock()
+        self._metricas = {}
+
+    def _ultimos_mensajes(self, conversacion):
+        """Último mensaje del cliente y el mensaje del asesor que lo precede."""
+        interacciones = (conversacion or {}).get("interacciones", [])
+        if not interacciones:
+            return "", ""
+        mensaje_cliente = interacciones[-1].get("mensaje_cliente", "") or ""
+        mensaje_asesor = interacciones[-2].get("mensaje_chatbot", "") if len(interacciones) > 1 else ""
+        return mensaje_cliente.strip(), (mensaje_asesor or "").strip()
+
+    def _no_interes(self, mensaje, texto):
+        if "?" in texto or len(texto.split()) > 25:
+            return None
+        if not any(re.search(patron, texto) for patron in PATRONES_NO_INTERES):
+            return None
+        categoria = next((nombre for nombre, patron in CATEGORIAS_NO_INTERES if re.search(patron, texto)), "Otros")
+        return {"intencion": 6, "categoria": categoria, "detalle": mensaje}, 0.95
+
+    def _fecha_hora(self, mensaje, texto):
+        fecha, hora = extract_datetime(mensaje)
+        if not fecha:
+            return None
+        hoy = datetime.now(self.lima_tz).strftime("%Y-%m-%d")
+        if fecha < hoy:
+            return None
+        pregunta_disponibilidad = re.search(PATRON_DISPONIBILIDAD, texto) is not None
+        confirma = re.search(PATRON_CONFIRMACION, texto) is not None and re.search(PATRON_NEGACION, texto) is None
+        if hora and not pregunta_disponibilidad and confirma:
+            return {"intencion": 3, "detalle": f"{fecha} {hora}"}, 0.95
+        if not hora and pregunta_disponibilidad:
+            return {"intencion": 2, "detalle": fecha}, 0.9
+        # Fecha y hora sin confirmación explícita o dentro de una pregunta, o fecha sin contexto: se deja al LLM
+        return {"intencion": 3 if hora else 2, "detalle": f"{fecha} {hora}" if hora else fecha}, 0.6
+
+    def _nombre(self, mensaje, mensaje_asesor):
+        mensaje = mensaje.lower().strip(" .!¡")
+        explicito = re.match(PATRON_NOMBRE_EXPLICITO, mensaje)
+        if explicito:
+            return {"intencion": 5, "detalle": explicito.group(1).title()}, 0.95
+        pidio_nombre = "nombre" in normalizar_texto(mensaje_asesor) and "?" in mensaje_asesor
+        soy = re.match(PATRON_NOMBRE_SOY, mensaje)
+        if soy:
+            # Por debajo del umbral: el LLM confirma que es un nombre antes de guardarlo
+            return ({"intencion": 5, "detalle": soy.group(1).title()}, 0.6) if pidio_nombre else None
+        palabras = set(normalizar_texto(mensaje).split())
+        if pidio_nombre and re.match(PATRON_NOMBRE_SUELTO, mensaje) and not palabras & PALABRAS_NO_NOMBRE:
+            return {"intencion": 5, "detalle": mensaje.title()}, 0.9
+        return None
+
+    def clasificar(self, conversacion):
+        """
+        Clasifica el último mensaje del cliente con reglas locales.
+
+        :return: Tupla (resultado, confianza); resultado es None si ninguna regla aplica.
+        """
+        mensaje, mensaje_asesor = self._ultimos_mensajes(conversacion)
+        if not mensaje:
+            return None, 0.0
+        texto = normalizar_texto(mensaje)
+        for candidato in (self._no_interes(mensaje, texto), self._fecha_hora(mensaje, texto), self._nombre(mensaje, mensaje_asesor)):
+            if candidato:
+                return candidato
+        return None, 0.0
+
+    def decidir(self, resultado, confianza):
+        """Indica si el resultado local se usa sin consultar al LLM (confiable y no elegido para verificación)."""
+        if resultado is None or confianza < self.umbral:
+            return False
+        if random.random() < self.tasa_muestreo:
+            return False
+        self._contar(resultado["intencion"], "decididas")
+        return True
+
+    def registrar_comparacion(self, resultado_local, confianza, resultado_llm):
+        """Registra si la regla local coincidió con la intención (y el detalle) que devolvió el LLM."""
+        if resultado_local is None or not resultado_llm:
+            return
+        coincide = resultado_local.get("intencion") == resultado_llm.get("intencion")
+        if coincide and resultado_local["intencion"] in (2, 3):
+            coincide = str(resultado_llm.get("detalle", "")).strip() == resultado_local.get("detalle")
+        tipo = "confiables" if confianza >= self.umbral else "no_confiables"
+        self._contar(resultado_local["intencion"], f"comparadas_{tipo}")
+        if coincide:
+            self._contar(resultado_local["intencion"], f"coincidencias_{tipo}")
+        else:
+            print(f"Clasificador local en desacuerdo: local={resultado_local} llm={resultado_llm}")
+
+    def _contar(self, intencion, campo):
+        with self._lock:
+            contadores = self._metricas.setdefault(intencion, {})
+            contadores[campo] = contadores.get(campo, 0) + 1
+
+    def metricas(self):
+        """Contadores por intención y tasas de concordancia con el LLM."""
+        with self._lock:
+            resumen = {}
+            for intencion, contadores in self._metricas.items():
+                datos = dict(contadores)
+                for tipo in ("confiables", "no_confiables"):
+                    comparadas = datos.get(f"comparadas_{tipo}", 0)
+                    if comparadas:
+                        datos[f"concordancia_{tipo}"] = round(datos.get(f"coincidencias_{tipo}", 0) / comparadas, 3)
+                resumen[intencion] = datos
+            return resumen
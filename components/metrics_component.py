@@ -0,0 +1,142 @@
+import contextvars
+import threading
+from bisect import bisect_left
+from collections import OrderedDict, deque
+
+# Límites superiores (en segundos) de los buckets de los histogramas de latencia y TTFT
+LIMITES_HISTOGRAMA = (0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0)
+
+# Dimensiones por las que se agregan las llamadas
+DIMENSIONES = ("prompt", "ruta", "modelo", "intencion")
+
+# Contadores que se suman por dimensión y por cliente
+CAMPOS_CONTADOR = ("prompt_tokens", "cached_tokens", "completion_tokens", "costo_usd")
+
+_etiquetas = contextvars.ContextVar("etiquetas_llm", default={})
+
+class Histograma:
+    """Histograma de buckets fijos; los percentiles se aproximan por el límite superior del bucket."""
+
+    def __init__(self, limites=LIMITES_HISTOGRAMA):
+        self.limites = limites
+        self.conteos = [0] * (len(limites) + 1)
+        self.suma = 0.0
+        self.total = 0
+        self.maximo = 0.0
+
+    def observar(self, valor):
+        self.conteos[bisect_left(self.limites, valor)] += 1
+        self.suma += valor
+        self.total += 1
+        self.maximo = max(self.maximo, valor)
+
+    def percentil(self, p):
+        if not self.total:
+            return None
+        objetivo = p * self.total
+        acumulado = 0
+        for indice, conteo in enumerate(self.conteos):
+            acumulado += conteo
+            if acumulado >= objetivo:
+                # En el último bucket (sin límite superior) se usa el máximo observado
+                return self.limites[indice] if indice < len(self.limites) else round(self.maximo, 3)
+        return round(self.maximo, 3)
+
+    def resumen(self):
+        buckets = {f"<={limite}": conteo for limite, conteo in zip(self.limites, self.conteos)}
+        buckets["+inf"] = self.conteos[-1]
+        return {
+            "total": self.total,
+            "media": round(self.suma / self.total, 3) if self.total else None,
+            "p50": self.percentil(0.5),
+            "p95": self.percentil(0.95),
+            "maximo": round(self.maximo, 3),
+            "buckets": buckets,
+        }
+
+class LLMMetrics:
+    """
+    Registro de las llamadas al modelo: tokens (incluidos los de caché), TTFT, latencia y costo.
+
+    Cada llamada se agrega por prompt, ruta, modelo e intención (contadores e histogramas) y por cliente.
+    La intención y el cliente no los conoce OpenAIManager: se fijan con `etiquetar` en el contexto del
+    hilo que atiende al cliente (cada Timer de enviar_respuesta corre en su propio hilo y contexto).
+    """
+
+    def __init__(self, max_clientes=5000, max_recientes=200):
+        self.max_clientes = max_clientes
+        self._lock = threading.Lock()
+        self._agregados = {dimension: {} for dimension in DIMENSIONES}
+        self._clientes = OrderedDict()
+        self._recientes = deque(maxlen=max_recientes)
+
+    def etiquetar(self, **etiquetas):
+        """Añade etiquetas (p. ej. cliente_id, intencion) a las llamadas que se hagan desde el contexto actual."""
+        _etiquetas.set({**_etiquetas.get(), **etiquetas})
+
+    def registrar(self, registro):
+        """Registra una llamada; `registro` trae modelo, prompt, ruta, tokens, ttft, latencia, costo_usd y escalada."""
+        registro = {**_etiquetas.get(), **registro}
+        with self._lock:
+            self._recientes.append(registro)
+            for dimension in DIMENSIONES:
+                valor = registro.get(dimension)
+                if valor is None:
+                    continue
+                agregado = self._agregados[dimension].setdefault(str(valor), {
+                    "llamadas": 0, "escalamientos": 0, "uso_estimado": 0, **{campo: 0 for campo in CAMPOS_CONTADOR},
+                    "latencia": Histograma(), "ttft": Histograma(),
+                })
+                self._sumar(agregado, registro)
+                agregado["escalamientos"] += 1 if registro.get("escalada") else 0
+                # Llamadas cuyos tokens se estimaron localmente porque el stream se cortó antes del uso
+                agregado["uso_estimado"] += 1 if registro.get("uso_estimado") else 0
+                agregado["latencia"].observar(registro.get("latencia") or 0.0)
+                agregado["ttft"].observar(registro.get("ttft") or 0.0)
+
+            cliente_id = registro.get("cliente_id")
+            if cliente_id is not None:
+                cliente_id = str(cliente_id)
+                contadores = self._clientes.pop(cliente_id, None) or {"llamadas": 0, "latencia_total": 0.0,
+                                                                     **{campo: 0 for campo in CAMPOS_CONTADOR}}
+                self._sumar(contadores, registro)
+                contadores["latencia_total"] += registro.get("latencia") or 0.0
+                self._clientes[cliente_id] = contadores
+                while len(self._clientes) > self.max_clientes:
+                    self._clientes.popitem(last=False)
+
+    def _sumar(self, contadores, registro):
+        contadores["llamadas"] += 1
+        for campo in CAMPOS_CONTADOR:
+            contadores[campo] += registro.get(campo) or 0
+
+    def resumen(self, dimension="prompt"):
+        """Contadores e histogramas de latencia/TTFT agregados por `dimension` (prompt, ruta, modelo o intencion)."""
+        if dimension not in DIMENSIONES:
+            raise ValueError(f"Dimensión no soportada: {dimension}")
+        with self._lock:
+            return {
+                valor: {
+                    **{clave: dato for clave, dato in agregado.items() if clave not in ("latencia", "ttft")},
+                    "costo_usd": round(agregado["costo_usd"], 6),
+                    "latencia": agregado["latencia"].resumen(),
+                    "ttft": agregado["ttft"].resumen(),
+                }
+                for valor, agregado in self._agregados[dimension].items()
+            }
+
+    def cliente(self, cliente_id):
+        """Contadores acumulados de un cliente, o None si no tiene llamadas registradas."""
+        with self._lock:
+            contadores = self._clientes.get(str(cliente_id))
+            return dict(contadores) if contadores else None
+
+    def top_clientes(self, n=10, por="costo_usd"):
+        """Los `n` clientes con mayor valor del contador `por`."""
+        with self._lock:
+            ordenados = sorted(self._clientes.items(), key=lambda item: item[1].get(por, 0), reverse=True)
+            return [{"cliente_id": cliente_id, **contadores} for cliente_id, contadores in ordenados[:n]]
+
+    def recientes(self, n=50):
+        with self._lock:
+            return list(self._recientes)[-n:]
@@ -1,105 +1,712 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, APIStatusError, APIConnectionError
 from api_keys.api_keys import openai_api_key
-from prompt.prompt import prompt_intenciones, prompt_consulta_v2, prompt_lead_estado, prompt_cliente_nombre, prompt_consulta_v3, prompt_lead_estado_zoho, prompt_intencionesv2,prompt_consulta_v4
-from helpers.helpers import formatear_conversacion, formatear_historial_conversaciones, formatear_horarios_disponibles
+from prompt.registro import registro_prompts
+from components.metrics_component import LLMMetrics
+from helpers.helpers import formatear_conversacion, formatear_historial_conversaciones, formatear_horarios_disponibles, extraer_json, ExtractorJSONIncremental, TokenBucket, contar_tokens
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+import asyncio
+import os
 import pytz
+import json
+import math
+import random
+import threading
+import time
+import weakref
 from datetime import datetime
 
+# Salida estructurada del modo de llamada única (intención, datos de la opción y borrador de respuesta)
+ESQUEMA_INTENCION_RESPUESTA = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "intencion_respuesta",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "intencion": {"type": "integer", "enum": [1, 2, 3, 4, 5, 6]},
+                "categoria": {"type": "string"},
+                "detalle": {"type": "string"},
+                "mensaje": {"type": "string"},
+            },
+            "required": ["intencion", "categoria", "detalle", "mensaje"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# Claves del JSON de respuesta que se notifican durante el streaming
+CAMPOS_STREAM = ("intencion", "categoria", "detalle", "mensaje")
+
+# Modelo por tarea; cada ruta se puede sobrescribir con OPENAI_MODELO_<RUTA> (p. ej. OPENAI_MODELO_CLASIFICACION)
+MODELOS_POR_RUTA = {
+    "clasificacion": "gpt-4o-mini",
+    "intencion_respuesta": "gpt-4o",
+    "respuesta": "gpt-4o",
+    "lead": "gpt-4o-mini",
+    "nombre": "gpt-4o-mini",
+    "resumen": "gpt-4o-mini",
+}
+
+# Modelo al que se escala cuando el modelo de la ruta devuelve una salida inválida o poco confiable
+MODELO_ESCALAMIENTO = "gpt-4o"
+
+# Confianza mínima (probabilidad del token de la intención) para aceptar la clasificación del modelo pequeño
+UMBRAL_CONFIANZA_CLASIFICACION = 0.8
+
+# Campos sin los que no se puede ejecutar la acción de cada intención: fecha y hora (3), nombre (5), causa (6)
+CAMPOS_REQUERIDOS_INTENCION = {3: ("detalle",), 5: ("detalle",), 6: ("categoria", "detalle")}
+
+# Precios en USD por millón de tokens: entrada, entrada servida desde caché y salida
+PRECIOS_MODELO = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+}
+
+def costo_llamada(modelo, prompt_tokens, cached_tokens, completion_tokens):
+    """Costo estimado en USD de una llamada según PRECIOS_MODELO (0 si el modelo no tiene precio)."""
+    # "gpt-4o-2024-08-06" usa el precio de "gpt-4o"; se prueba primero el prefijo más largo
+    clave = next((nombre for nombre in sorted(PRECIOS_MODELO, key=len, reverse=True) if (modelo or "").startswith(nombre)), None)
+    if clave is None:
+        return 0.0
+    entrada, entrada_cache, salida = PRECIOS_MODELO[clave]
+    prompt_tokens, cached_tokens, completion_tokens = prompt_tokens or 0, cached_tokens or 0, completion_tokens or 0
+    return ((prompt_tokens - cached_tokens) * entrada + cached_tokens * entrada_cache + completion_tokens * salida) / 1_000_000
+
+def es_resultado_lead(contenido):
+    """La salida de los prompts de lead tiene el formato "estado - mensaje"."""
+    return "-" in (contenido or "")
+
+def _es_json_intencion(contenido):
+    resultado = extraer_json(contenido or "")
+    return bool(resultado) and "intencion" in resultado
+
+class LLMGateway:
+    """
+    Capa compartida para las llamadas a chat completions.
+
+    - Plazo por llamada (`plazo`, incluye reintentos) y timeout por intento.
+    - Reintentos con backoff exponencial y jitter ante 429, 5xx y errores de conexión (respeta Retry-After).
+    - Token buckets de peticiones y de tokens por minuto ajustados a los límites de la cuenta.
+    - Límite de peticiones simultáneas.
+    - Peticiones cubiertas (hedging): si la primera no responde en el p95 de latencia reciente se lanza
+      una segunda y se usa la que llegue antes.
+    - API síncrona (`completar`) y asíncrona (`acompletar`).
+
+    Los clientes se crean con max_retries=0 porque los reintentos los controla el gateway.
+    """
+
+    def __init__(self, api_key, rpm=500, tpm=30000, timeout=20.0, plazo=45.0, max_reintentos=3,
+                 max_concurrencia=8, retraso_cobertura=2.0):
+        self.client = OpenAI(api_key=api_key, max_retries=0)
+        self.api_key = api_key
+        self.timeout = timeout
+        self.plazo = plazo
+        self.max_reintentos = max_reintentos
+        self.max_concurrencia = max_concurrencia
+        self.retraso_cobertura = retraso_cobertura
+        self._peticiones = TokenBucket(rpm / 60.0, max(1, rpm // 6))
+        self._tokens = TokenBucket(tpm / 60.0, max(1, tpm // 6))
+        self._semaforo = threading.BoundedSemaphore(max_concurrencia)
+        self._ejecutor = ThreadPoolExecutor(max_workers=max_concurrencia * 2, thread_name_prefix="llm")
+        self._latencias = deque(maxlen=200)
+        self._lock = threading.Lock()
+        # Un cliente asíncrono y un semáforo por event loop: httpx no permite compartirlos entre loops
+        self._estado_async = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def desde_entorno(cls, api_key):
+        """Crea el gateway con los límites configurados en variables de entorno OPENAI_*."""
+        return cls(
+            api_key,
+            rpm=int(os.getenv("OPENAI_RPM", "500")),
+            tpm=int(os.getenv("OPENAI_TPM", "30000")),
+            timeout=float(os.getenv("OPENAI_TIMEOUT", "20")),
+            plazo=float(os.getenv("OPENAI_PLAZO", "45")),
+            max_reintentos=int(os.getenv("OPENAI_MAX_REINTENTOS", "3")),
+            max_concurrencia=int(os.getenv("OPENAI_MAX_CONCURRENCIA", "8")),
+            retraso_cobertura=float(os.getenv("OPENAI_RETRASO_COBERTURA", "2")),
+        )
+
+    def _es_reintentable(self, error):
+        if isinstance(error, APIConnectionError):
+            # Incluye APITimeoutError
+            return True
+        if isinstance(error, APIStatusError):
+            if error.status_code == 429:
+                # Sin saldo no tiene sentido reintentar
+                return getattr(error, "code", None) != "insufficient_quota"
+            return error.status_code >= 500
+        return False
+
+    def _espera_reintento(self, error, intento):
+        espera = random.uniform(0, min(8.0, 0.5 * 2 ** intento))
+        respuesta = getattr(error, "response", None)
+        retry_after = respuesta.headers.get("retry-after") if respuesta is not None else None
+        try:
+            return max(espera, float(retry_after)) if retry_after else espera
+        except ValueError:
+            return espera
+
+    def _espera_cupo(self, params):
+        """Reserva cupo en los token buckets y devuelve los segundos que hay que esperar."""
+        tokens = sum(contar_tokens(str(mensaje.get("content", ""))) for mensaje in params.get("messages", []))
+        tokens += params.get("max_tokens") or 0
+        return max(self._peticiones.reservar(1), self._tokens.reservar(tokens))
+
+    def _registrar_latencia(self, inicio):
+        with self._lock:
+            self._latencias.append(time.monotonic() - inicio)
+
+    def _retraso_cobertura(self):
+        """p95 de la latencia reciente hasta obtener la respuesta (o el retraso configurado si hay pocas muestras)."""
+        with self._lock:
+            latencias = sorted(self._latencias)
+        if len(latencias) < 20:
+            return self.retraso_cobertura
+        return latencias[int(len(latencias) * 0.95) - 1]
+
+    def _descartar(self, futuro):
+        """Cierra el stream de una petición cubierta que perdió la carrera."""
+        if futuro.cancelled() or futuro.exception() is not None:
+            return
+        cerrar = getattr(futuro.result(), "close", None)
+        if cerrar:
+            cerrar()
+
+    def _intentar(self, params, plazo, reservar=True):
+        # `reservar` es False en la petición de cobertura: el cupo ya lo reservó la primera petición de la llamada
+        fin = time.monotonic() + (plazo or self.plazo)
+        espera = self._espera_cupo(params) if reservar else 0.0
+        if espera > 0:
+            time.sleep(min(espera, max(0.0, fin - time.monotonic())))
+        for intento in range(self.max_reintentos + 1):
+            restante = fin - time.monotonic()
+            if restante <= 0:
+                raise TimeoutError(f"Plazo de {plazo or self.plazo}s agotado para la llamada al modelo")
+            inicio = time.monotonic()
+            try:
+                with self._semaforo:
+                    respuesta = self.client.with_options(timeout=min(self.timeout, restante)).chat.completions.create(**params)
+                self._registrar_latencia(inicio)
+                return respuesta
+            except Exception as error:
+                if not self._es_reintentable(error) or intento == self.max_reintentos:
+                    raise
+                espera = self._espera_reintento(error, intento)
+                if time.monotonic() + espera >= fin:
+                    raise
+                print(f"Reintento {intento + 1} de la llamada al modelo en {espera:.2f}s: {error}")
+                time.sleep(espera)
+
+    def completar(self, plazo=None, cobertura=False, **params):
+        """
+        Ejecuta `chat.completions.create(**params)` con plazo, reintentos y límites de tasa.
+
+        :param plazo: Segundos totales para la llamada, reintentos incluidos.
+        :param cobertura: Si es True, lanza una segunda petición cuando la primera tarda más que el p95 reciente.
+        :return: La respuesta (o el stream, si params incluye stream=True) de la petición ganadora.
+        """
+        if not cobertura:
+            return self._intentar(params, plazo)
+        futuros = [self._ejecutor.submit(self._intentar, params, plazo)]
+        hechos, _ = wait(futuros, timeout=self._retraso_cobertura())
+        if not hechos:
+            print("Petición cubierta: se lanza una segunda llamada al modelo")
+            # Sin reservar de nuevo: esperar cupo para la cobertura anularía su propósito
+            futuros.append(self._ejecutor.submit(self._intentar, params, plazo, False))
+        pendientes = set(futuros)
+        error = None
+        while pendientes:
+            hechos, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+            for futuro in hechos:
+                if futuro.exception() is None:
+                    for otro in pendientes | (hechos - {futuro}):
+                        otro.add_done_callback(self._descartar)
+                    return futuro.result()
+                error = futuro.exception()
+        raise error
+
+    def _estado_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._estado_async:
+            self._estado_async[loop] = (
+                AsyncOpenAI(api_key=self.api_key, max_retries=0),
+                asyncio.Semaphore(self.max_concurrencia),
+            )
+        return self._estado_async[loop]
+
+    async def _aintentar(self, params, plazo):
+        cliente, semaforo = self._estado_loop()
+        fin = time.monotonic() + (plazo or self.plazo)
+        espera = self._espera_cupo(params)
+        if espera > 0:
+            await asyncio.sleep(min(espera, max(0.0, fin - time.monotonic())))
+        for intento in range(self.max_reintentos + 1):
+            restante = fin - time.monotonic()
+            if restante <= 0:
+                raise TimeoutError(f"Plazo de {plazo or self.plazo}s agotado para la llamada al modelo")
+            inicio = time.monotonic()
+            try:
+                async with semaforo:
+                    respuesta = await cliente.with_options(timeout=min(self.timeout, restante)).chat.completions.create(**params)
+                self._registrar_latencia(inicio)
+                return respuesta
+            except Exception as error:
+                if not self._es_reintentable(error) or intento == self.max_reintentos:
+                    raise
+                espera = self._espera_reintento(error, intento)
+                if time.monotonic() + espera >= fin:
+                    raise
+                print(f"Reintento {intento + 1} de la llamada al modelo en {espera:.2f}s: {error}")
+                await asyncio.sleep(espera)
+
+    async def acompletar(self, plazo=None, cobertura=False, **params):
+        """Versión asíncrona de `completar`; la petición cubierta que pierde se cancela."""
+        primera = asyncio.ensure_future(self._aintentar(params, plazo))
+        if not cobertura:
+            return await primera
+        hechos, _ = await asyncio.wait({primera}, timeout=self._retraso_cobertura())
+        pendientes = {primera}
+        if not hechos:
+            print("Petición cubierta: se lanza una segunda llamada al modelo")
+            pendientes.add(asyncio.ensure_future(self._aintentar(params, plazo)))
+        error = None
+        while pendientes:
+            hechos, pendientes = await asyncio.wait(pendientes, return_when=asyncio.FIRST_COMPLETED)
+            for tarea in hechos:
+                if tarea.exception() is None:
+                    for otra in pendientes:
+                        otra.cancel()
+                    return tarea.result()
+                error = tarea.exception()
+        raise error
+
 class OpenAIManager:
     def __init__(self):
-        self.client = OpenAI(api_key=openai_api_key)
-
-    def consulta(self, cliente,conversation_actual, conversation_history):
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": prompt_consulta_v4(cliente) + formatear_conversacion(conversation_actual)},
-            ],
-            max_tokens=250,
+        self.gateway = LLMGateway.desde_entorno(openai_api_key)
+        self.client = self.gateway.client
+        self.ultimo_uso = None
+        self.modelos = {ruta: os.getenv(f"OPENAI_MODELO_{ruta.upper()}", modelo) for ruta, modelo in MODELOS_POR_RUTA.items()}
+        self.modelo_escalamiento = os.getenv("OPENAI_MODELO_ESCALAMIENTO", MODELO_ESCALAMIENTO)
+        self.metricas = LLMMetrics()
+        self.prompts = registro_prompts
+
+    def _mensajes(self, prompt_estatico, prompt_dinamico):
+        """
+        Arma los mensajes con la parte estática del prompt como prefijo exacto y la parte variable
+        (cliente, fecha, conversación) al final, para que el proveedor pueda reutilizar el prefijo en caché.
+        """
+        if not prompt_estatico:
+            return [{"role": "system", "content": prompt_dinamico}]
+        return [
+            {"role": "system", "content": prompt_estatico},
+            {"role": "system", "content": prompt_dinamico},
+        ]
+
+    def _prompt(self, nombre, sufijo="", **datos):
+        """
+        Arma los mensajes de la versión vigente del prompt `nombre` del registro, con `sufijo`
+        (conversación, instrucciones del turno) al final de la parte dinámica.
+
+        :return: Tupla (mensajes, plantilla); la etiqueta de la plantilla identifica el prompt en métricas y caché.
+        """
+        plantilla = self.prompts.obtener(nombre)
+        estatico, dinamico = plantilla.armar(**datos)
+        return self._mensajes(estatico, dinamico + sufijo), plantilla
+
+    def _modelo(self, ruta, escalar=False):
+        return self.modelo_escalamiento if escalar else self.modelos.get(ruta, self.modelo_escalamiento)
+
+    def _completar(self, messages, max_tokens, al_campo=None, campos=CAMPOS_STREAM, clave_cache=None, cobertura=False,
+                   ruta="respuesta", escalar=False, con_confianza=False, prompt=None, **kwargs):
+        """
+        Ejecuta una completion y devuelve el texto generado.
+
+        Sin `al_campo` espera la respuesta completa. Con `al_campo` consume la respuesta en streaming y
+        llama a `al_campo(clave, valor)` en cuanto se completa cada clave de `campos` del JSON generado.
+        Si el callback devuelve True se deja de leer el stream y se devuelven los campos ya extraídos.
+        `clave_cache` agrupa en el mismo caché de prompts las llamadas que comparten prefijo estático.
+        `cobertura` activa las peticiones cubiertas del gateway (solo para el camino de la respuesta).
+        `ruta` elige el modelo de la tarea (MODELOS_POR_RUTA) y `escalar` fuerza el modelo de escalamiento.
+        Con `con_confianza` (sin streaming) devuelve (texto, confianza del primer dígito generado).
+        `prompt` es el nombre del prompt con el que se agregan las métricas de la llamada.
+        """
+        if clave_cache:
+            kwargs["extra_body"] = {"prompt_cache_key": clave_cache}
+        modelo = self._modelo(ruta, escalar)
+        inicio = time.perf_counter()
+        if con_confianza and al_campo is None:
+            kwargs["logprobs"] = True
+        if al_campo is None:
+            response = self.gateway.completar(
+                model=modelo,
+                messages=messages,
+                max_tokens=max_tokens,
+                cobertura=cobertura,
+                **kwargs
+            )
+            self._registrar_uso(response.usage, inicio, None, ruta, modelo, escalar, prompt)
+            contenido = response.choices[0].message.content.strip()
+            if con_confianza:
+                return contenido, self._confianza_digito(response.choices[0].logprobs)
+            return contenido
+
+        extractor = ExtractorJSONIncremental(campos, al_campo)
+        fragmentos = []
+        uso = None
+        primer_token = None
+        stream = self.gateway.completar(
+            model=modelo,
+            messages=messages,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+            cobertura=cobertura,
+            **kwargs
         )
+        try:
+            for chunk in stream:
+                if chunk.usage:
+                    uso = chunk.usage
+                if not chunk.choices:
+                    continue
+                fragmento = chunk.choices[0].delta.content
+                if not fragmento:
+                    continue
+                if primer_token is None:
+                    primer_token = time.perf_counter()
+                fragmentos.append(fragmento)
+                if extractor.alimentar(fragmento):
+                    # El llamador ya tiene lo que necesita; se cierra el stream sin esperar el resto.
+                    # El uso solo llega en el último chunk, así que se estima con lo enviado y lo recibido
+                    self._registrar_uso(uso or self._uso_estimado(messages, fragmentos), inicio, primer_token,
+                                        ruta, modelo, escalar, prompt)
+                    return json.dumps(extractor.valores, ensure_ascii=False)
+        finally:
+            stream.close()
+        self._registrar_uso(uso or self._uso_estimado(messages, fragmentos), inicio, primer_token, ruta, modelo, escalar, prompt)
+        contenido = "".join(fragmentos).strip()
+        # En streaming no se piden logprobs, así que no se evalúa la confianza
+        return (contenido, None) if con_confianza else contenido
+
+    def _confianza_digito(self, logprobs):
+        """Probabilidad del primer token numérico (el número de la intención), o None si no hay logprobs."""
+        for token in getattr(logprobs, "content", None) or []:
+            if token.token.strip().isdigit():
+                return math.exp(token.logprob)
+        return None
+
+    def _completar_escalable(self, messages, max_tokens, ruta, es_valido, umbral_confianza=None, **kwargs):
+        """
+        Ejecuta la tarea con el modelo de su ruta y la repite con el modelo de escalamiento si la salida
+        no pasa `es_valido` o si la confianza queda por debajo de `umbral_confianza`.
+        """
+        con_confianza = umbral_confianza is not None and kwargs.get("al_campo") is None
+        contenido = self._completar(messages, max_tokens, ruta=ruta, con_confianza=con_confianza, **kwargs)
+        confianza = None
+        if con_confianza:
+            contenido, confianza = contenido
+        if self._modelo(ruta) == self.modelo_escalamiento:
+            return contenido
+        if not es_valido(contenido):
+            motivo = "salida inválida"
+        elif confianza is not None and confianza < umbral_confianza:
+            motivo = f"confianza {confianza:.2f}"
+        else:
+            return contenido
+        print(f"Escalando la ruta {ruta} a {self.modelo_escalamiento} ({motivo})")
+        return self._completar(messages, max_tokens, ruta=ruta, escalar=True, **kwargs)
+
+    async def _acompletar(self, messages, max_tokens, clave_cache=None, ruta="respuesta", escalar=False, prompt=None, **kwargs):
+        """Versión asíncrona (sin streaming) de `_completar`, para generar muchas respuestas en paralelo."""
+        if clave_cache:
+            kwargs["extra_body"] = {"prompt_cache_key": clave_cache}
+        modelo = self._modelo(ruta, escalar)
+        inicio = time.perf_counter()
+        response = await self.gateway.acompletar(
+            model=modelo,
+            messages=messages,
+            max_tokens=max_tokens,
+            **kwargs
+        )
+        self._registrar_uso(response.usage, inicio, None, ruta, modelo, escalar, prompt)
         return response.choices[0].message.content.strip()
 
-    def clasificar_intencion(self, conversation_actual, conversation_history):
+    def _uso_estimado(self, messages, fragmentos):
+        """Uso aproximado con contar_tokens para un stream que no llegó a traer `usage` (p. ej. cortado antes de tiempo)."""
+        return {
+            "prompt_tokens": sum(contar_tokens(str(mensaje.get("content", ""))) for mensaje in messages),
+            "completion_tokens": contar_tokens("".join(fragmentos)) if fragmentos else 0,
+        }
+
+    def _registrar_uso(self, uso, inicio, primer_token, ruta="respuesta", modelo=None, escalada=False, prompt=None):
+        """
+        Guarda, imprime y agrega en `metricas` los tokens (incluidos los de caché), el TTFT, la latencia y el costo.
+        `uso` puede ser el de la API o el dict de `_uso_estimado`; en ese caso el registro queda marcado como estimado.
+        """
+        fin = time.perf_counter()
+        estimado = isinstance(uso, dict)
+        if estimado:
+            prompt_tokens, completion_tokens, detalles = uso["prompt_tokens"], uso["completion_tokens"], None
+        else:
+            prompt_tokens = uso.prompt_tokens if uso else None
+            completion_tokens = uso.completion_tokens if uso else None
+            detalles = getattr(uso, "prompt_tokens_details", None)
+        self.ultimo_uso = {
+            "prompt": prompt,
+            "ruta": ruta,
+            "modelo": modelo,
+            "escalada": escalada,
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": (detalles.cached_tokens or 0) if detalles else 0,
+            "completion_tokens": completion_tokens,
+            "uso_estimado": estimado,
+            # Sin streaming el primer token llega junto con la respuesta completa
+            "ttft": round((primer_token or fin) - inicio, 3),
+            "latencia": round(fin - inicio, 3),
+        }
+        self.ultimo_uso["costo_usd"] = round(costo_llamada(modelo, self.ultimo_uso["prompt_tokens"], self.ultimo_uso["cached_tokens"],
+                                                           self.ultimo_uso["completion_tokens"]), 6)
+        print("Uso LLM:", self.ultimo_uso)
+        self.metricas.registrar(self.ultimo_uso)
+
+    def metricas_rutas(self):
+        """Llamadas, escalamientos, tokens, latencia y costo acumulados por ruta."""
+        return self.metricas.resumen("ruta")
+
+    def consulta(self, cliente,conversation_actual, conversation_history, al_campo=None):
+        mensajes, plantilla = self._prompt("consulta", formatear_conversacion(conversation_actual), cliente=cliente,
+                                           conversacion=conversation_actual)
+        return self._completar(
+            mensajes,
+            max_tokens=250,
+            al_campo=al_campo,
+            clave_cache=plantilla.etiqueta,
+            prompt=plantilla.etiqueta,
+            cobertura=True,
+        )
+
+    def clasificar_intencion(self, conversation_actual, conversation_history, al_campo=None):
         conversacion_actual_formateada = formatear_conversacion(conversation_actual)
         #conversacion_history_formateada = formatear_historial_conversaciones(conversation_history)
-        print("Fecha actual",datetime.now(pytz.timezone("America/Lima")).strftime("%Y-%m-%d"))
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": prompt_intencionesv2(datetime.now(pytz.timezone("America/Lima")).strftime("%Y-%m-%d")) + conversacion_actual_formateada},
-                #{"role": "user", "content": conversacion_actual_formateada}
-            ],
+        fecha_actual = datetime.now(pytz.timezone("America/Lima")).strftime("%Y-%m-%d")
+        print("Fecha actual", fecha_actual)
+        mensajes, plantilla = self._prompt("intenciones", conversacion_actual_formateada, fecha_actual=fecha_actual)
+        return self._completar_escalable(
+            mensajes,
             max_tokens=50,
+            ruta="clasificacion",
+            prompt=plantilla.etiqueta,
+            es_valido=_es_json_intencion,
+            umbral_confianza=UMBRAL_CONFIANZA_CLASIFICACION,
+            al_campo=al_campo,
         )
-        #print("Conversación actual formateada:", conversacion_actual_formateada)
-        #print("Prompt intenciones:", prompt_intenciones(datetime.now(pytz.timezone("America/Lima")).strftime("%Y-%m-%d")) + conversacion_actual_formateada)
-        return response.choices[0].message.content.strip()
 
-    def consultaHorarios(self,cliente_mysql, horarios_disponibles, conversation_actual, conversation_history, fecha):
+    def clasificar_y_responder(self, cliente, conversation_actual, conversation_history, al_campo=None):
+        """
+        Clasifica la intención y redacta el borrador de respuesta en una sola llamada.
+
+        :param al_campo: Callback opcional para recibir "intencion", "detalle" y "mensaje" durante el streaming.
+        :return: Diccionario con "intencion" y, si aplican, "categoria", "detalle" y "mensaje";
+                 None si el modelo no devolvió un JSON válido.
+        """
+        fecha_actual = datetime.now(pytz.timezone("America/Lima")).strftime("%Y-%m-%d")
+        mensajes, plantilla = self._prompt("intencion_respuesta", formatear_conversacion(conversation_actual),
+                                           cliente=cliente, fecha_actual=fecha_actual)
+        resultado = self._json_intencion(self._completar(
+            mensajes,
+            max_tokens=300,
+            al_campo=al_campo,
+            clave_cache=plantilla.etiqueta,
+            cobertura=True,
+            ruta="intencion_respuesta",
+            prompt=plantilla.etiqueta,
+            response_format=ESQUEMA_INTENCION_RESPUESTA,
+        ))
+        if resultado is None and self._modelo("intencion_respuesta") != self.modelo_escalamiento:
+            # Sin streaming: si el primer intento ya envió el mensaje, enviar_respuesta no lo repite
+            print(f"Escalando la ruta intencion_respuesta a {self.modelo_escalamiento} (salida inválida)")
+            resultado = self._json_intencion(self._completar(
+                mensajes,
+                max_tokens=300,
+                clave_cache=plantilla.etiqueta,
+                ruta="intencion_respuesta",
+                prompt=plantilla.etiqueta,
+                escalar=True,
+                response_format=ESQUEMA_INTENCION_RESPUESTA,
+            ))
+        if resultado is None:
+            return None
+        # La categoría solo aplica a la opción 6; en otra posición desplazaría el detalle en json_a_lista
+        if resultado["intencion"] != 6:
+            resultado.pop("categoria", None)
+        # Se descartan las claves vacías para que json_a_lista mantenga el formato de prompt_intencionesv2
+        resultado = {clave: valor for clave, valor in resultado.items() if valor not in ("", None)}
+        faltantes = [campo for campo in CAMPOS_REQUERIDOS_INTENCION.get(resultado["intencion"], ()) if campo not in resultado]
+        if faltantes:
+            # Sin esos campos la acción no se puede ejecutar: se reclasifica con el prompt de intenciones
+            print(f"Intención {resultado['intencion']} sin {', '.join(faltantes)}; se reclasifica")
+            return None
+        return resultado
+
+    def _json_intencion(self, contenido):
+        try:
+            resultado = json.loads(contenido)
+        except json.JSONDecodeError:
+            resultado = extraer_json(contenido)
+        if not isinstance(resultado, dict) or "intencion" not in resultado:
+            return None
+        return resultado
+
+    def consultaHorarios(self,cliente_mysql, horarios_disponibles, conversation_actual, conversation_history, fecha, al_campo=None):
         horarios_disponibles = formatear_horarios_disponibles(horarios_disponibles)
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": prompt_consulta_v4(cliente_mysql) + formatear_conversacion(conversation_actual)
-                    + f"\n Los horarios disponibles para que le digas al cliente son {horarios_disponibles}"},
-            ],
+        mensajes, plantilla = self._prompt(
+            "consulta",
+            formatear_conversacion(conversation_actual) + f"\n Los horarios disponibles para que le digas al cliente son {horarios_disponibles}",
+            cliente=cliente_mysql,
+            conversacion=conversation_actual,
+        )
+        return self._completar(
+            mensajes,
             max_tokens=100,
+            al_campo=al_campo,
+            clave_cache=plantilla.etiqueta,
+            prompt=plantilla.etiqueta,
+            cobertura=True,
         )
-        return response.choices[0].message.content.strip()
 
-    def consultaCitareservada(self,cliente_mysql, reserva_cita, conversation_actual, conversation_history):
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": prompt_consulta_v4(cliente_mysql) + formatear_conversacion(conversation_actual)
-                    + "\n Dile que la cita ha sido reservada para  el ...  y mandale el link pago mencionandole que atraves de este link puede pagar usando yape, plin o tarjetas credito/debito.}"},
-            ],
+    def consultaCitareservada(self,cliente_mysql, reserva_cita, conversation_actual, conversation_history, al_campo=None):
+        mensajes, plantilla = self._prompt(
+            "consulta",
+            formatear_conversacion(conversation_actual)
+                    + "\n Dile que la cita ha sido reservada para  el ...  y mandale el link pago mencionandole que atraves de este link puede pagar usando yape, plin o tarjetas credito/debito.}",
+            cliente=cliente_mysql,
+            conversacion=conversation_actual,
+        )
+        return self._completar(
+            mensajes,
             max_tokens=100,
+            al_campo=al_campo,
+            clave_cache=plantilla.etiqueta,
+            prompt=plantilla.etiqueta,
+            cobertura=True,
         )
-        return response.choices[0].message.content.strip()
     
-    def consultaPago(self, cliente_mysql,link_pago, conversation_actual, conversation_history):
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": prompt_consulta_v4(cliente_mysql) + formatear_conversacion(conversation_actual)
-                    },
-            ],
+    def consultaPago(self, cliente_mysql,link_pago, conversation_actual, conversation_history, al_campo=None):
+        mensajes, plantilla = self._prompt("consulta", formatear_conversacion(conversation_actual), cliente=cliente_mysql,
+                                           conversacion=conversation_actual)
+        return self._completar(
+            mensajes,
             max_tokens=100,
+            al_campo=al_campo,
+            clave_cache=plantilla.etiqueta,
+            prompt=plantilla.etiqueta,
+            cobertura=True,
         )
-        return response.choices[0].message.content.strip()
+
+    def mensajes_lead(self, lead):
+        """Mensajes del prompt de lead del CSV y la etiqueta de su plantilla (para LeadCampaignGenerator)."""
+        mensajes, plantilla = self._prompt("lead_estado", lead=lead)
+        return mensajes, plantilla.etiqueta
+
+    def mensajes_lead_zoho(self, lead):
+        """Mensajes del prompt de lead de Zoho y la etiqueta de su plantilla (para LeadCampaignGenerator)."""
+        mensajes, plantilla = self._prompt("lead_estado_zoho", lead=lead)
+        return mensajes, plantilla.etiqueta
 
     def consultaLead(self, lead):
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": prompt_lead_estado(lead) },
-            ],
+        mensajes, plantilla = self._prompt("lead_estado", lead=lead)
+        contenido = self._completar_escalable(
+            mensajes,
             max_tokens=100,
+            ruta="lead",
+            prompt=plantilla.etiqueta,
+            es_valido=es_resultado_lead,
         )
-        print("Prompt lead :", prompt_lead_estado(lead))
-        return response.choices[0].message.content.strip()
+        print("Prompt lead :", mensajes[-1]["content"])
+        return contenido
     
     def consultaLeadZoho(self, lead):
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": prompt_lead_estado_zoho(lead) },
-            ],
+        mensajes, plantilla = self._prompt("lead_estado_zoho", lead=lead)
+        contenido = self._completar_escalable(
+            mensajes,
             max_tokens=100,
+            ruta="lead",
+            prompt=plantilla.etiqueta,
+            es_valido=es_resultado_lead,
         )
-        #print("Prompt lead :", prompt_lead_estado_zoho(lead))
-        return response.choices[0].message.content.strip()
+        #print("Prompt lead :", mensajes[-1]["content"])
+        return contenido
+
+    async def aconsulta_lead(self, messages, prompt):
+        """Versión asíncrona de consultaLead/consultaLeadZoho a partir de los mensajes ya preparados."""
+        contenido = await self._acompletar(messages, max_tokens=100, ruta="lead", prompt=prompt)
+        if es_resultado_lead(contenido) or self._modelo("lead") == self.modelo_escalamiento:
+            return contenido
+        print(f"Escalando la ruta lead a {self.modelo_escalamiento} (salida inválida)")
+        return await self._acompletar(messages, max_tokens=100, ruta="lead", escalar=True, prompt=prompt)
+
+    def crear_lote(self, peticiones, max_tokens=100, ruta="lead"):
+        """
+        Envía un batch offline de OpenAI (ventana de 24 h, a mitad de precio).
+
+        :param peticiones: Diccionario {custom_id: messages}.
+        :return: Id del batch creado.
+        """
+        lineas = [
+            json.dumps({
+                "custom_id": str(custom_id),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {"model": self._modelo(ruta), "messages": messages, "max_tokens": max_tokens},
+            }, ensure_ascii=False)
+            for custom_id, messages in peticiones.items()
+        ]
+        archivo = self.client.files.create(file=("lote.jsonl", "\n".join(lineas).encode("utf-8")), purpose="batch")
+        lote = self.client.batches.create(input_file_id=archivo.id, endpoint="/v1/chat/completions", completion_window="24h")
+        print(f"Batch {lote.id} creado con {len(lineas)} peticiones")
+        return lote.id
+
+    def obtener_lote(self, batch_id):
+        """
+        Consulta un batch y, si terminó, descarga sus resultados.
+
+        :return: Tupla (estado, {custom_id: contenido}); el diccionario está vacío mientras el batch no termine.
+        """
+        lote = self.client.batches.retrieve(batch_id)
+        if lote.status != "completed" or not lote.output_file_id:
+            return lote.status, {}
+        resultados = {}
+        for linea in self.client.files.content(lote.output_file_id).text.splitlines():
+            if not linea.strip():
+                continue
+            registro = json.loads(linea)
+            respuesta = registro.get("response") or {}
+            if respuesta.get("status_code") == 200:
+                resultados[registro["custom_id"]] = respuesta["body"]["choices"][0]["message"]["content"].strip()
+        return lote.status, resultados
     
     def consultaNombre(self, cliente, response_message,conversation_actual):
-        response = self.client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": prompt_cliente_nombre(cliente, response_message,formatear_conversacion(conversation_actual))},
-            ],
+        mensajes, plantilla = self._prompt("cliente_nombre", cliente=cliente, response_message=response_message,
+                                           conversacion_actual=formatear_conversacion(conversation_actual))
+        return self._completar(
+            mensajes,
             max_tokens=100,
+            ruta="nombre",
+            prompt=plantilla.etiqueta,
+        )
+
+    def resumir_conversacion(self, resumen_previo, interacciones_formateadas):
+        """Pliega interacciones antiguas en el resumen incremental de la conversación activa."""
+        mensajes, plantilla = self._prompt("resumen_conversacion", resumen_previo=resumen_previo, interacciones=interacciones_formateadas)
+        return self._completar(
+            mensajes,
+            max_tokens=250,
+            ruta="resumen",
+            prompt=plantilla.etiqueta,
         )
-        return response.choices[0].message.content.strip()
 
     def extract_datetime(self, message):
         # Aquí deberías implementar la lógica para extraer la fecha y hora de un mensaje
@@ -0,0 +1,100 @@
+import threading
+import time
+
+class ComponenteDiferido:
+    """
+    Sustituto de un componente del registro: lo construye en el primer uso y delega en él todos los
+    atributos, de modo que el resto del código lo usa como si fuera la instancia real.
+    """
+
+    def __init__(self, registro, nombre):
+        object.__setattr__(self, "_registro", registro)
+        object.__setattr__(self, "_nombre", nombre)
+
+    def __getattr__(self, atributo):
+        return getattr(self._registro.obtener(self._nombre), atributo)
+
+    def __setattr__(self, atributo, valor):
+        setattr(self._registro.obtener(self._nombre), atributo, valor)
+
+    def __bool__(self):
+        # Un componente desactivado se registra con una fábrica que devuelve None
+        return bool(self._registro.obtener(self._nombre))
+
+    def __repr__(self):
+        return f"<ComponenteDiferido {self._nombre}>"
+
+class ComponentRegistry:
+    """
+    Registro de los componentes de la aplicación con inicialización diferida.
+
+    Cada componente se registra con una fábrica y se construye una sola vez, en el primer uso o al
+    precalentar: `calentar` lanza todas las fábricas en paralelo, así que el arranque tarda lo que la
+    dependencia más lenta y no la suma. Una fábrica puede pedir otros componentes con `obtener`; si
+    otro hilo ya los está construyendo, espera a que terminen. Si una fábrica falla, el error queda
+    en el reporte y se reintenta en el siguiente uso.
+    """
+
+    def __init__(self):
+        self._fabricas = {}
+        self._instancias = {}
+        self._locks = {}
+        self._reporte = {}
+        self._lock = threading.Lock()
+
+    def registrar(self, nombre, fabrica):
+        """Registra `fabrica` (sin argumentos) como constructor del componente `nombre` y devuelve su sustituto."""
+        with self._lock:
+            self._fabricas[nombre] = fabrica
+            self._locks[nombre] = threading.Lock()
+            self._reporte[nombre] = {"estado": "pendiente", "segundos": None, "error": None}
+        return ComponenteDiferido(self, nombre)
+
+    def obtener(self, nombre):
+        """Devuelve la instancia del componente, construyéndola si todavía no existe."""
+        try:
+            return self._instancias[nombre]
+        except KeyError:
+            pass
+        with self._locks[nombre]:
+            if nombre in self._instancias:
+                return self._instancias[nombre]
+            with self._lock:
+                self._reporte[nombre].update(estado="iniciando", error=None)
+            inicio = time.perf_counter()
+            try:
+                instancia = self._fabricas[nombre]()
+            except Exception as e:
+                with self._lock:
+                    self._reporte[nombre].update(estado="error", segundos=round(time.perf_counter() - inicio, 3), error=str(e))
+                raise
+            with self._lock:
+                self._reporte[nombre].update(estado="listo", segundos=round(time.perf_counter() - inicio, 3))
+            self._instancias[nombre] = instancia
+            print(f"Componente {nombre} listo en {self._reporte[nombre]['segundos']} s")
+            return instancia
+
+    def _construir(self, nombre):
+        try:
+            self.obtener(nombre)
+        except Exception as e:
+            print(f"Error al iniciar el componente {nombre}: {e}")
+
+    def calentar(self, nombres=None):
+        """Construye en paralelo, en segundo plano, los componentes indicados (todos por defecto)."""
+        hilos = []
+        for nombre in nombres or list(self._fabricas):
+            hilo = threading.Thread(target=self._construir, args=[nombre], daemon=True, name=f"inicio-{nombre}")
+            hilo.start()
+            hilos.append(hilo)
+        return hilos
+
+    def listo(self):
+        """Indica si todos los componentes registrados están construidos."""
+        with self._lock:
+            return all(estado["estado"] == "listo" for estado in self._reporte.values())
+
+    def reporte(self):
+        """Estado y segundos de construcción de cada componente."""
+        with self._lock:
+            return {nombre: dict(estado) for nombre, estado in self._reporte.items()}
@@ -0,0 +1,73 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+
+class SpeculativeExecutor:
+    """
+    Ejecuta trabajo especulativo por clave (celular) con versiones.
+
+    Cada `iniciar` crea una nueva versión para la clave y deja obsoletas las anteriores: si aún no
+    empezaron se cancelan, y las que están en curso pueden consultar `vigente` para abandonar el
+    trabajo antes de los pasos costosos. `tomar` devuelve el resultado solo si la versión pedida
+    sigue siendo la última, de modo que nunca se reutiliza un resultado calculado con mensajes viejos.
+    """
+
+    def __init__(self, max_hilos=8, timeout=30):
+        self.timeout = timeout
+        self._ejecutor = ThreadPoolExecutor(max_workers=max_hilos, thread_name_prefix="especulacion")
+        self._lock = threading.Lock()
+        self._versiones = {}
+        self._futuros = {}
+        self._metricas = {"iniciadas": 0, "reemplazadas": 0, "reutilizadas": 0, "descartadas": 0}
+
+    def iniciar(self, clave, funcion, *args):
+        """Lanza `funcion(*args, version)` como la nueva versión especulativa de `clave` y devuelve la versión."""
+        with self._lock:
+            version = self._versiones.get(clave, 0) + 1
+            self._versiones[clave] = version
+            anterior = self._futuros.get(clave)
+            if anterior is not None and not anterior.done():
+                anterior.cancel()
+                self._metricas["reemplazadas"] += 1
+            self._futuros[clave] = self._ejecutor.submit(funcion, *args, version)
+            self._metricas["iniciadas"] += 1
+        return version
+
+    def vigente(self, clave, version):
+        """Indica si `version` sigue siendo la última versión de `clave`."""
+        with self._lock:
+            return self._versiones.get(clave) == version
+
+    def tomar(self, clave, version):
+        """
+        Espera y devuelve el resultado especulativo de `version`, o None si quedó obsoleto, falló o no existe.
+        El resultado se entrega una sola vez.
+        """
+        with self._lock:
+            futuro = self._futuros.get(clave) if self._versiones.get(clave) == version else None
+            if futuro is not None:
+                del self._futuros[clave]
+        if futuro is None:
+            self._contar("descartadas")
+            return None
+        try:
+            resultado = futuro.result(timeout=self.timeout)
+        except FuturesTimeoutError:
+            print(f"Especulación de {clave} sin terminar tras {self.timeout}s; se descarta")
+            resultado = None
+        except Exception as e:
+            print(f"Error en la especulación de {clave}: {e}")
+            resultado = None
+        # Un mensaje nuevo pudo llegar mientras se esperaba el resultado
+        if resultado is None or not self.vigente(clave, version):
+            self._contar("descartadas")
+            return None
+        self._contar("reutilizadas")
+        return resultado
+
+    def _contar(self, campo):
+        with self._lock:
+            self._metricas[campo] += 1
+
+    def metricas(self):
+        with self._lock:
+            return dict(self._metricas)
@@ -1,36 +1,591 @@
+import os
+import json
+import random
+import sqlite3
+import threading
+import time
+from requests.exceptions import ConnectionError as ErrorConexion, Timeout
+from twilio.base.exceptions import TwilioRestException
 from twilio.rest import Client
+from twilio.request_validator import RequestValidator
 from api_keys.api_keys import account_sid, auth_token, messaging_service_sid
+from helpers.helpers import format_number
+
+# Prioridades de la cola de envíos: un número menor sale antes
+PRIORIDAD_RESPUESTA = 0
+PRIORIDAD_CAMPANA = 10
+
+# Estados de entrega de Twilio en el orden en que avanzan; los fallos van al final porque son definitivos
+ESTADOS_ENTREGA = ("queued", "sent", "delivered", "read", "undelivered", "failed")
+
+def _conectar(ruta):
+    """Conexión a la base de envíos, compartida por los workers de gunicorn: WAL y espera ante bloqueos."""
+    conexion = sqlite3.connect(ruta, timeout=30, check_same_thread=False)
+    conexion.execute("PRAGMA journal_mode=WAL")
+    return conexion
+
+def _proceso_vivo(pid):
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
 
 class TwilioManager:
     def __init__(self):
         self.client = self._authenticate()
+        self.remitente = os.getenv("TWILIO_WHATSAPP_REMITENTE", "whatsapp:+51944749102")
+        # Con una URL pública Twilio notifica cada cambio de estado del mensaje (ver DeliveryTracker)
+        self.status_callback = os.getenv("TWILIO_STATUS_CALLBACK_URL")
+        self._validador = RequestValidator(auth_token)
 
     def _authenticate(self):
         return Client(account_sid, auth_token)
 
+    def enviar(self, to_number, message_body=None, content_sid=None, content_variables=None, remitente=None):
+        """Un único intento de envío por la API de Twilio (texto o plantilla); devuelve el SID del mensaje."""
+        to_number = f'whatsapp:{to_number}' if not to_number.startswith('whatsapp:') else to_number
+        parametros = {"from_": remitente or self.remitente, "to": to_number}
+        if self.status_callback:
+            parametros["status_callback"] = self.status_callback
+        if content_sid:
+            parametros.update(content_sid=content_sid, content_variables=content_variables)
+        else:
+            parametros["body"] = message_body
+        return self.client.messages.create(**parametros).sid
+
     def send_message(self, to_number, message_body):
         to_number = f'whatsapp:{to_number}' if not to_number.startswith('whatsapp:') else to_number
 
-        message = self.client.messages.create(
-            body=message_body,
-            from_='whatsapp:+51944749102',  # Cambia por tu número de Twilio
-            #from_='whatsapp:+14155238886',  # Cambia por tu número de Twilio
-            to=to_number
-        )
-        print(f"Message sent to {to_number}: {message.sid}")
-        message_status = self.client.messages(message.sid).fetch()
-        print(f"Message status: {message_status.status}")
-        return message.sid
+        sid = self.enviar(to_number, message_body)
+        print(f"Message sent to {to_number}: {sid}")
+        return sid
 
     def send_template_message(self, to_number, template_content_sid, parameters):
         to_number = f'whatsapp:{to_number}' if not to_number.startswith('whatsapp:') else to_number
-        
+
         # Configuración del mensaje usando Content SID
-        message = self.client.messages.create(
-            content_sid=template_content_sid,  # Aquí pones el Content SID de la plantilla
-            from_='whatsapp:+51944749102',  # Número de Twilio
-            to=to_number,
-            content_variables=parameters  # Parámetros de la plantilla
+        sid = self.enviar(to_number, content_sid=template_content_sid, content_variables=parameters)
+        print(f"Template message sent to {to_number}: {sid}")
+        return sid
+
+    def firma_valida(self, url, parametros, firma):
+        """Verifica la cabecera X-Twilio-Signature de un webhook recibido en `url` con los parámetros del formulario."""
+        return self._validador.validate(url, parametros, firma or "")
+
+class DeliveryTracker:
+    """
+    Estado de entrega de cada mensaje enviado, alimentado por el webhook de estado de Twilio.
+
+    Guarda una fila por SID con la campaña y el estado más avanzado recibido (como índice de
+    ESTADOS_ENTREGA), ya que Twilio puede notificar los estados fuera de orden. Reemplaza la consulta
+    del estado justo después de cada envío, que además siempre devolvía "queued".
+    """
+
+    def __init__(self, ruta="envios_twilio.db", dias_conservados=30):
+        self._conexion = _conectar(ruta)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conexion.execute(
+                "CREATE TABLE IF NOT EXISTS entregas (sid TEXT PRIMARY KEY, campana TEXT, estado INTEGER NOT NULL, "
+                "codigo_error TEXT, creado REAL NOT NULL, actualizado REAL NOT NULL)"
+            )
+            self._conexion.execute("CREATE INDEX IF NOT EXISTS entregas_campana ON entregas (campana, creado)")
+            self._conexion.execute("DELETE FROM entregas WHERE creado < ?", (time.time() - dias_conservados * 86400,))
+            self._conexion.commit()
+
+    @classmethod
+    def desde_entorno(cls):
+        return cls(ruta=os.getenv("TWILIO_COLA_RUTA", "envios_twilio.db"))
+
+    def registrar_envio(self, sid, campana=None):
+        """Registra un mensaje recién aceptado por Twilio con la campaña a la que pertenece."""
+        ahora = time.time()
+        with self._lock:
+            # El webhook puede haber llegado antes: en ese caso solo se completa la campaña
+            self._conexion.execute(
+                "INSERT INTO entregas (sid, campana, estado, creado, actualizado) VALUES (?, ?, 0, ?, ?) "
+                "ON CONFLICT (sid) DO UPDATE SET campana = excluded.campana",
+                (sid, campana, ahora, ahora)
+            )
+            self._conexion.commit()
+
+    def registrar_estado(self, sid, estado, codigo_error=None):
+        """Aplica una notificación de estado; devuelve False si el estado no es de entrega (p. ej. "sending")."""
+        if estado not in ESTADOS_ENTREGA:
+            return False
+        indice = ESTADOS_ENTREGA.index(estado)
+        ahora = time.time()
+        with self._lock:
+            self._conexion.execute(
+                "INSERT INTO entregas (sid, estado, codigo_error, creado, actualizado) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (sid) DO UPDATE SET estado = excluded.estado, codigo_error = excluded.codigo_error, "
+                "actualizado = excluded.actualizado WHERE excluded.estado > entregas.estado",
+                (sid, indice, codigo_error, ahora, ahora)
+            )
+            self._conexion.commit()
+        return True
+
+    def estado(self, sid):
+        """Último estado conocido del mensaje, o None si no está registrado."""
+        with self._lock:
+            fila = self._conexion.execute("SELECT estado FROM entregas WHERE sid = ?", (sid,)).fetchone()
+        return ESTADOS_ENTREGA[fila[0]] if fila else None
+
+    def tasas(self, campana=None, desde=None):
+        """
+        Mensajes por estado y tasas de entrega, lectura y fallo de cada campaña.
+
+        :param campana: Limita el resultado a una campaña.
+        :param desde: Solo mensajes enviados a partir de este timestamp (segundos desde epoch).
+        :return: {campana: {"total", "por_estado", "tasa_entrega", "tasa_lectura", "tasa_fallo"}}; los
+                 mensajes sin campaña (respuestas) aparecen bajo la clave "respuestas".
+        """
+        condiciones, parametros = [], []
+        if campana is not None:
+            condiciones.append("campana = ?")
+            parametros.append(campana)
+        if desde is not None:
+            condiciones.append("creado >= ?")
+            parametros.append(desde)
+        donde = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+        with self._lock:
+            filas = self._conexion.execute(
+                f"SELECT campana, estado, COUNT(*) FROM entregas {donde} GROUP BY campana, estado", parametros
+            ).fetchall()
+
+        resultado = {}
+        for nombre, indice, cantidad in filas:
+            resumen = resultado.setdefault(nombre or "respuestas", {"total": 0, "por_estado": dict.fromkeys(ESTADOS_ENTREGA, 0)})
+            resumen["total"] += cantidad
+            resumen["por_estado"][ESTADOS_ENTREGA[indice]] += cantidad
+        for resumen in resultado.values():
+            por_estado, total = resumen["por_estado"], resumen["total"]
+            resumen["tasa_entrega"] = round((por_estado["delivered"] + por_estado["read"]) / total, 4)
+            resumen["tasa_lectura"] = round(por_estado["read"] / total, 4)
+            resumen["tasa_fallo"] = round((por_estado["undelivered"] + por_estado["failed"]) / total, 4)
+        return resultado
+
+class EnvioEncolado:
+    """Comprobante de un mensaje encolado en MessageDispatcher."""
+
+    def __init__(self, id, despachador):
+        self.id = id
+        self._despachador = despachador
+        self.sid = None
+        self.error = None
+        self._listo = threading.Event()
+
+    @property
+    def terminado(self):
+        return self._listo.is_set()
+
+    def esperar(self, timeout=None):
+        """Espera a que el mensaje salga o falle definitivamente; devuelve el SID (None si falló o venció `timeout`)."""
+        limite = time.monotonic() + timeout if timeout is not None else None
+        # El mensaje puede enviarlo el despachador de otro worker: se consulta la base cada segundo
+        while not self._listo.wait(1.0 if limite is None else max(0.0, min(1.0, limite - time.monotonic()))):
+            self._despachador._consultar(self.id)
+            if limite is not None and time.monotonic() >= limite:
+                break
+        return self.sid
+
+    def _resolver(self, sid=None, error=None):
+        self.sid = sid
+        self.error = error
+        self._listo.set()
+
+class MessageDispatcher:
+    """
+    Cola persistente de mensajes salientes de WhatsApp.
+
+    Los mensajes se guardan en SQLite al encolarlos y un grupo acotado de `hilos` los envía por
+    prioridad (las respuestas antes que las campañas) respetando un token bucket por número remitente.
+    Los errores 429, 5xx y de conexión se reintentan con espera exponencial hasta `max_intentos`; el
+    resto de errores de Twilio marcan el mensaje como fallido. Los mensajes a un mismo destino salen en
+    el orden en que se encolaron.
+
+    La base se comparte entre los workers de gunicorn: cada mensaje se reclama con un UPDATE condicional
+    (solo un proceso lo envía), el token bucket de cada remitente se guarda en la tabla `limitadores`
+    para que el límite sea global, y los reclamos de un proceso caído o con más de `plazo_reclamo`
+    segundos vuelven a la cola.
+    """
+
+    def __init__(self, twilio, ruta="envios_twilio.db", mensajes_por_segundo=10, hilos=4, max_intentos=5,
+                 espera_base=2.0, espera_maxima=300, dias_conservados=7, entregas=None, plazo_reclamo=300):
+        self.twilio = twilio
+        self.entregas = entregas
+        self.mensajes_por_segundo = mensajes_por_segundo
+        self.hilos = hilos
+        self.max_intentos = max_intentos
+        self.espera_base = espera_base
+        self.espera_maxima = espera_maxima
+        self.plazo_reclamo = plazo_reclamo
+        self._conexion = _conectar(ruta)
+        self._lock = threading.Lock()
+        self._hay_trabajo = threading.Condition(self._lock)
+        self._comprobantes = {}
+        self._ultima_recuperacion = 0.0
+        self._trabajadores = []
+        self._metricas = {"encolados": 0, "enviados": 0, "reintentos": 0, "fallidos": 0}
+        with self._lock:
+            self._conexion.execute(
+                "CREATE TABLE IF NOT EXISTS envios (id INTEGER PRIMARY KEY AUTOINCREMENT, prioridad INTEGER NOT NULL, "
+                "remitente TEXT NOT NULL, destino TEXT NOT NULL, cuerpo TEXT, content_sid TEXT, variables TEXT, "
+                "campana TEXT, estado TEXT NOT NULL, intentos INTEGER NOT NULL DEFAULT 0, disponible_en REAL NOT NULL, "
+                "creado REAL NOT NULL, terminado REAL, sid TEXT, error TEXT, reclamado REAL, dueno INTEGER, "
+                "masivo INTEGER NOT NULL DEFAULT 0)"
+            )
+            columnas = {columna[1] for columna in self._conexion.execute("PRAGMA table_info(envios)")}
+            for columna, tipo in (("reclamado", "REAL"), ("dueno", "INTEGER"), ("masivo", "INTEGER NOT NULL DEFAULT 0")):
+                if columna not in columnas:
+                    self._conexion.execute(f"ALTER TABLE envios ADD COLUMN {columna} {tipo}")
+            self._conexion.execute(
+                "CREATE TABLE IF NOT EXISTS limitadores (remitente TEXT PRIMARY KEY, saldo REAL NOT NULL, actualizado REAL NOT NULL)"
+            )
+            self._conexion.execute("CREATE INDEX IF NOT EXISTS envios_estado ON envios (estado, prioridad, id)")
+            self._conexion.execute("CREATE INDEX IF NOT EXISTS envios_destino ON envios (destino, estado)")
+            self._conexion.execute("CREATE INDEX IF NOT EXISTS envios_campana ON envios (campana, destino)")
+            # Un solo envío vigente por número en cada campaña masiva; los fallidos quedan fuera para poder reencolarlos.
+            # Los mensajes sueltos de `encolar` (seguimientos, recordatorios) repiten campaña y destino, por eso no cuentan.
+            self._conexion.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS envios_campana_masiva ON envios (campana, destino) "
+                "WHERE masivo = 1 AND estado != 'fallido'"
+            )
+            # Los envíos que quedaron a medias cuando se cayó un proceso vuelven a la cola
+            self._recuperar_abandonados()
+            self._conexion.execute(
+                "DELETE FROM envios WHERE estado IN ('enviado', 'fallido') AND creado < ?",
+                (time.time() - dias_conservados * 86400,)
+            )
+            self._conexion.commit()
+
+    @classmethod
+    def desde_entorno(cls, twilio, entregas=None):
+        return cls(
+            twilio,
+            ruta=os.getenv("TWILIO_COLA_RUTA", "envios_twilio.db"),
+            mensajes_por_segundo=float(os.getenv("TWILIO_MENSAJES_POR_SEGUNDO", "10")),
+            hilos=int(os.getenv("TWILIO_HILOS_ENVIO", "4")),
+            max_intentos=int(os.getenv("TWILIO_MAX_INTENTOS", "5")),
+            entregas=entregas,
         )
-        print(f"Template message sent to {to_number}: {message.sid}")
-        return message.sid
\ No newline at end of file
+
+    def encolar(self, destino, cuerpo=None, content_sid=None, variables=None, prioridad=PRIORIDAD_RESPUESTA,
+                campana=None, remitente=None):
+        """
+        Encola un mensaje de texto (`cuerpo`) o de plantilla (`content_sid` y `variables`) y devuelve su EnvioEncolado.
+
+        :param prioridad: PRIORIDAD_RESPUESTA para respuestas a conversaciones, PRIORIDAD_CAMPANA para envíos masivos.
+        :param campana: Etiqueta opcional de la campaña a la que pertenece el mensaje.
+        """
+        if isinstance(variables, dict):
+            variables = json.dumps(variables)
+        remitente = remitente or self.twilio.remitente
+        ahora = time.time()
+        with self._hay_trabajo:
+            cursor = self._conexion.execute(
+                "INSERT INTO envios (prioridad, remitente, destino, cuerpo, content_sid, variables, campana, estado, "
+                "disponible_en, creado) VALUES (?, ?, ?, ?, ?, ?, ?, 'pendiente', ?, ?)",
+                (prioridad, remitente, destino, cuerpo, content_sid, variables, campana, ahora, ahora)
+            )
+            self._conexion.commit()
+            comprobante = EnvioEncolado(cursor.lastrowid, self)
+            self._comprobantes[comprobante.id] = comprobante
+            self._metricas["encolados"] += 1
+            self._hay_trabajo.notify()
+        return comprobante
+
+    def encolar_plantillas(self, campana, content_sid, destinatarios, prioridad=PRIORIDAD_CAMPANA, reintentar_fallidos=False):
+        """
+        Encola en una sola transacción la plantilla `content_sid` para todos los destinatarios de una campaña.
+
+        Los números se normalizan con format_number y se envía uno por número. La cola hace de punto de
+        control: si la campaña se relanza (p. ej. tras una caída o desde otro worker), los números que ya
+        tienen un envío de esa campaña no se vuelven a encolar, y los pendientes los retoma la propia cola.
+        La deduplicación la garantiza el índice único envios_campana_masiva con INSERT OR IGNORE.
+
+        :param destinatarios: Lista de (numero, variables), con las variables como dict o JSON.
+        :param reintentar_fallidos: Si es True, vuelve a encolar los números cuyo envío anterior falló.
+        :return: Cantidad de números encolados, repetidos en la lista y ya encolados antes para la campaña.
+        """
+        unicos = {}
+        for numero, variables in destinatarios:
+            numero = format_number(str(numero).replace("whatsapp:", "").replace(" ", "").replace("-", ""))
+            if numero not in unicos:
+                unicos[numero] = json.dumps(variables) if isinstance(variables, dict) else variables
+        remitente = self.twilio.remitente
+        ahora = time.time()
+        # Sin reintentar_fallidos, un número cuyo envío falló también cuenta como ya encolado
+        sin_fallidos = "" if reintentar_fallidos else (
+            " WHERE NOT EXISTS (SELECT 1 FROM envios WHERE campana = ? AND destino = ? AND masivo = 1 AND estado = 'fallido')"
+        )
+        with self._hay_trabajo:
+            antes = self._conexion.total_changes
+            self._conexion.executemany(
+                "INSERT OR IGNORE INTO envios (prioridad, remitente, destino, content_sid, variables, campana, estado, "
+                f"disponible_en, creado, masivo) SELECT ?, ?, ?, ?, ?, ?, 'pendiente', ?, ?, 1{sin_fallidos}",
+                [
+                    (prioridad, remitente, numero, content_sid, variables, campana, ahora, ahora)
+                    + (() if reintentar_fallidos else (campana, numero))
+                    for numero, variables in unicos.items()
+                ]
+            )
+            self._conexion.commit()
+            encolados = self._conexion.total_changes - antes
+            self._metricas["encolados"] += encolados
+            self._hay_trabajo.notify_all()
+        resumen = {"encolados": encolados, "repetidos": len(destinatarios) - len(unicos),
+                   "ya_encolados": len(unicos) - encolados}
+        print(f"Campaña {campana}: {resumen}")
+        return resumen
+
+    def reporte_campana(self, campana):
+        """
+        Resultado por destinatario y rendimiento de una campaña.
+
+        :return: Total de números, cantidad por estado, segundos desde el primer encolado hasta el último
+                 envío terminado, mensajes enviados por segundo y {numero: {"estado", "sid", "error", "intentos"}}.
+        """
+        with self._lock:
+            filas = self._conexion.execute(
+                "SELECT destino, estado, sid, error, intentos, creado, terminado FROM envios WHERE campana = ? ORDER BY id",
+                (campana,)
+            ).fetchall()
+        resultados = {}
+        inicio, fin = None, None
+        for destino, estado, sid, error, intentos, creado, terminado in filas:
+            # Si un número se reencoló, vale su último envío
+            resultados[destino] = {"estado": estado, "sid": sid, "error": error, "intentos": intentos}
+            inicio = creado if inicio is None else min(inicio, creado)
+            if terminado:
+                fin = terminado if fin is None else max(fin, terminado)
+        por_estado = {}
+        for resultado in resultados.values():
+            por_estado[resultado["estado"]] = por_estado.get(resultado["estado"], 0) + 1
+        segundos = round(fin - inicio, 2) if fin else None
+        return {
+            "campana": campana,
+            "total": len(resultados),
+            "por_estado": por_estado,
+            "segundos": segundos,
+            "mensajes_por_segundo": round(por_estado.get("enviado", 0) / segundos, 2) if segundos else None,
+            "resultados": resultados,
+        }
+
+    def esperar_campana(self, campana, timeout=None):
+        """Espera a que no queden envíos pendientes de la campaña (o a que venza `timeout`) y devuelve su reporte."""
+        limite = time.monotonic() + timeout if timeout is not None else None
+        with self._hay_trabajo:
+            while self._conexion.execute(
+                "SELECT 1 FROM envios WHERE campana = ? AND estado IN ('pendiente', 'enviando') LIMIT 1", (campana,)
+            ).fetchone():
+                restante = limite - time.monotonic() if limite is not None else 1.0
+                if restante <= 0:
+                    break
+                self._hay_trabajo.wait(min(restante, 1.0))
+        return self.reporte_campana(campana)
+
+    def enviar_plantillas(self, campana, content_sid, destinatarios, timeout=None, reintentar_fallidos=False):
+        """Encola la campaña con `encolar_plantillas`, espera a que termine y devuelve el reporte con el resumen del encolado."""
+        resumen = self.encolar_plantillas(campana, content_sid, destinatarios, reintentar_fallidos=reintentar_fallidos)
+        reporte = self.esperar_campana(campana, timeout)
+        reporte.update(resumen)
+        print(f"Campaña {campana}: {reporte['por_estado']} en {reporte['segundos']}s ({reporte['mensajes_por_segundo']} msg/s)")
+        return reporte
+
+    def _reservar(self, remitente):
+        """
+        Reserva un envío en el token bucket del remitente y devuelve los segundos a esperar antes de hacerlo.
+
+        El saldo vive en la tabla `limitadores` y se actualiza bajo BEGIN IMMEDIATE, de modo que todos los
+        workers descuentan del mismo bucket (como TokenBucket.reservar, el saldo puede quedar negativo).
+        """
+        capacidad = max(1, self.mensajes_por_segundo)
+        with self._lock:
+            self._conexion.execute("BEGIN IMMEDIATE")
+            try:
+                ahora = time.time()
+                fila = self._conexion.execute(
+                    "SELECT saldo, actualizado FROM limitadores WHERE remitente = ?", (remitente,)
+                ).fetchone()
+                saldo = capacidad if fila is None else min(capacidad, fila[0] + max(0.0, ahora - fila[1]) * self.mensajes_por_segundo)
+                saldo -= 1
+                self._conexion.execute(
+                    "INSERT INTO limitadores (remitente, saldo, actualizado) VALUES (?, ?, ?) ON CONFLICT (remitente) "
+                    "DO UPDATE SET saldo = excluded.saldo, actualizado = excluded.actualizado",
+                    (remitente, saldo, ahora)
+                )
+                self._conexion.commit()
+            except Exception:
+                self._conexion.rollback()
+                raise
+        return 0.0 if saldo >= 0 else -saldo / self.mensajes_por_segundo
+
+    def _recuperar_abandonados(self):
+        """
+        Devuelve a la cola los envíos reclamados por un proceso que ya no existe o hace más de `plazo_reclamo`
+        segundos, y resuelve los comprobantes de mensajes que terminó otro worker. Se llama con el lock tomado.
+        """
+        ahora = time.time()
+        self._ultima_recuperacion = ahora
+        reclamos = self._conexion.execute("SELECT id, reclamado, dueno FROM envios WHERE estado = 'enviando'").fetchall()
+        abandonados = [
+            (id, reclamado) for id, reclamado, dueno in reclamos
+            if reclamado is None or reclamado < ahora - self.plazo_reclamo or not _proceso_vivo(dueno)
+        ]
+        if abandonados:
+            # La condición sobre `reclamado` evita devolver un mensaje que otro proceso acaba de volver a reclamar
+            self._conexion.executemany(
+                "UPDATE envios SET estado = 'pendiente', dueno = NULL WHERE id = ? AND estado = 'enviando' AND reclamado IS ?",
+                abandonados
+            )
+            self._conexion.commit()
+            print(f"Envíos abandonados devueltos a la cola: {len(abandonados)}")
+        if self._comprobantes:
+            marcas = ",".join("?" * len(self._comprobantes))
+            for id, sid, error in self._conexion.execute(
+                f"SELECT id, sid, error FROM envios WHERE estado IN ('enviado', 'fallido') AND id IN ({marcas})",
+                list(self._comprobantes)
+            ).fetchall():
+                self._comprobantes.pop(id)._resolver(sid, error)
+
+    def _consultar(self, id):
+        """Resuelve el comprobante `id` si su mensaje ya terminó (p. ej. lo envió el despachador de otro worker)."""
+        with self._lock:
+            fila = self._conexion.execute(
+                "SELECT sid, error FROM envios WHERE id = ? AND estado IN ('enviado', 'fallido')", (id,)
+            ).fetchone()
+            comprobante = self._comprobantes.pop(id, None) if fila else None
+        if comprobante:
+            comprobante._resolver(*fila)
+
+    def _tomar(self):
+        """
+        Marca como 'enviando' el siguiente mensaje listo y lo devuelve junto con None, o devuelve (None, espera)
+        con los segundos hasta que haya uno listo (None si solo queda esperar a que termine otro envío).
+        Se llama con el lock tomado.
+
+        El reclamo es un UPDATE condicional: si otro worker tomó el mensaje (o otro de su destino) entre la
+        consulta y el UPDATE, no se modifica ninguna fila y se busca el siguiente candidato.
+        """
+        if time.time() - self._ultima_recuperacion >= 30:
+            self._recuperar_abandonados()
+        # Solo es candidato el mensaje más antiguo pendiente de cada destino que no tenga otro en curso
+        candidatos = (
+            "FROM envios e WHERE e.estado = 'pendiente' AND NOT EXISTS ("
+            "SELECT 1 FROM envios o WHERE o.destino = e.destino AND o.estado IN ('pendiente', 'enviando') AND o.id < e.id)"
+            " AND NOT EXISTS (SELECT 1 FROM envios o WHERE o.destino = e.destino AND o.estado = 'enviando')"
+        )
+        while True:
+            ahora = time.time()
+            fila = self._conexion.execute(
+                "SELECT e.id, e.remitente, e.destino, e.cuerpo, e.content_sid, e.variables, e.campana, e.intentos "
+                f"{candidatos} AND e.disponible_en <= ? ORDER BY e.prioridad, e.id LIMIT 1", (ahora,)
+            ).fetchone()
+            if not fila:
+                break
+            cursor = self._conexion.execute(
+                "UPDATE envios SET estado = 'enviando', reclamado = ?, dueno = ? WHERE id = ? AND estado = 'pendiente' "
+                "AND NOT EXISTS (SELECT 1 FROM envios o WHERE o.destino = envios.destino AND o.estado = 'enviando')",
+                (ahora, os.getpid(), fila[0])
+            )
+            self._conexion.commit()
+            if cursor.rowcount == 1:
+                return fila, None
+        proximo = self._conexion.execute(f"SELECT MIN(e.disponible_en) {candidatos}").fetchone()[0]
+        return None, (max(0.0, proximo - ahora) if proximo is not None else None)
+
+    def _terminar(self, id, campos, sid=None, error=None, definitivo=True):
+        with self._hay_trabajo:
+            asignaciones = ", ".join(f"{campo} = ?" for campo in campos)
+            self._conexion.execute(f"UPDATE envios SET {asignaciones} WHERE id = ?", (*campos.values(), id))
+            self._conexion.commit()
+            comprobante = self._comprobantes.pop(id, None) if definitivo else None
+            # Puede haber mensajes al mismo destino esperando a que este termine
+            self._hay_trabajo.notify_all()
+        if comprobante:
+            comprobante._resolver(sid, error)
+
+    def _enviar(self, fila):
+        id, remitente, destino, cuerpo, content_sid, variables, campana, intentos = fila
+        espera = self._reservar(remitente)
+        if espera > 0:
+            time.sleep(espera)
+        try:
+            sid = self.twilio.enviar(destino, cuerpo, content_sid=content_sid, content_variables=variables, remitente=remitente)
+        except Exception as e:
+            intentos += 1
+            # Solo se reintentan los 429/5xx de Twilio y los errores de red; el resto (incluidos los de
+            # programación) marcan el mensaje como fallido
+            if isinstance(e, TwilioRestException):
+                reintentable = e.status == 429 or e.status >= 500
+            else:
+                reintentable = isinstance(e, (ErrorConexion, Timeout))
+            if reintentable and intentos < self.max_intentos:
+                espera = min(self.espera_maxima, self.espera_base * 2 ** (intentos - 1)) * random.uniform(0.5, 1.0)
+                print(f"Error al enviar el mensaje {id} a {destino} (intento {intentos}), se reintenta en {espera:.1f}s: {e}")
+                with self._lock:
+                    self._metricas["reintentos"] += 1
+                self._terminar(id, {"estado": "pendiente", "intentos": intentos, "disponible_en": time.time() + espera,
+                                    "error": str(e)}, definitivo=False)
+            else:
+                print(f"No se pudo enviar el mensaje {id} a {destino}: {e}")
+                with self._lock:
+                    self._metricas["fallidos"] += 1
+                self._terminar(id, {"estado": "fallido", "intentos": intentos, "error": str(e), "terminado": time.time()},
+                               error=str(e))
+            return
+        print(f"Message sent to {destino}: {sid}")
+        with self._lock:
+            self._metricas["enviados"] += 1
+        # El mensaje ya salió: se marca como enviado antes que nada para que un error posterior no lo reencole
+        self._terminar(id, {"estado": "enviado", "intentos": intentos + 1, "sid": sid, "error": None,
+                            "terminado": time.time()}, sid=sid)
+        if self.entregas:
+            try:
+                self.entregas.registrar_envio(sid, campana)
+            except Exception as e:
+                print(f"No se pudo registrar la entrega del mensaje {sid}: {e}")
+
+    def _trabajar(self):
+        while True:
+            fila = None
+            try:
+                with self._hay_trabajo:
+                    fila, espera = self._tomar()
+                    while fila is None:
+                        # Otros workers también encolan y terminan envíos: se vuelve a mirar la base cada segundo
+                        self._hay_trabajo.wait(min(espera, 1.0) if espera is not None else 1.0)
+                        fila, espera = self._tomar()
+                self._enviar(fila)
+            except Exception as e:
+                # Un error inesperado (p. ej. "database is locked") no debe matar al trabajador ni dejar bloqueado al destino
+                print(f"Error en el despachador de mensajes: {e}")
+                if fila:
+                    try:
+                        self._terminar(fila[0], {"estado": "pendiente"}, definitivo=False)
+                    except Exception as e:
+                        print(f"No se pudo devolver el mensaje {fila[0]} a la cola: {e}")
+                time.sleep(1)
+
+    def iniciar(self):
+        """Lanza los hilos que envían los mensajes de la cola (también los que quedaron pendientes de antes)."""
+        if self._trabajadores:
+            return self
+        for i in range(self.hilos):
+            hilo = threading.Thread(target=self._trabajar, daemon=True, name=f"envios-twilio-{i}")
+            hilo.start()
+            self._trabajadores.append(hilo)
+        return self
+
+    def metricas(self):
+        """Contadores de envíos y mensajes de la cola por estado."""
+        with self._lock:
+            metricas = dict(self._metricas)
+            metricas["cola"] = dict(self._conexion.execute("SELECT estado, COUNT(*) FROM envios GROUP BY estado").fetchall())
+        return metricas
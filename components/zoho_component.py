@@ -1,45 +1,180 @@
+import os
 import requests
 import json
+import threading
+import time
+from itertools import islice
 from datetime import datetime, timedelta
+try:
+    import fcntl
+except ImportError:  # Windows: el caché se comparte sin bloqueo entre procesos
+    fcntl = None
 
-class ZohoCRMManager:
-    def __init__(self, client_id, client_secret, redirect_uri, refresh_token):
-        self.api_base_url = "https://www.zohoapis.com/crm/v2"
+# Máximo de registros por página que acepta la API de Zoho CRM
+MAX_POR_PAGINA = 200
+
+class ZohoTokenManager:
+    """
+    Access token de Zoho compartido entre hilos y entre los workers de gunicorn.
+
+    El token se guarda con su vencimiento (expires_in) en memoria y en un archivo local, y se renueva
+    `margen` segundos antes de que venza, así ninguna petición sale con un token vencido. La renovación
+    se hace bajo un lock del proceso y un lock de archivo: si otro worker ya la hizo, se toma su token
+    del archivo en lugar de pedir otro (Zoho limita cuántos tokens se pueden pedir por minuto).
+    """
+
+    URL_TOKEN = "https://accounts.zoho.com/oauth/v2/token"
+
+    def __init__(self, client_id, client_secret, refresh_token, ruta_cache=None, margen=300):
         self.client_id = client_id
         self.client_secret = client_secret
-        self.redirect_uri = redirect_uri
         self.refresh_token = refresh_token
-        self.access_token = None  # Inicializa el access_token como None
-        self.headers = {}  # Inicializa headers como un diccionario vacío
-        self.refresh_access_token()  # Refresca el access_token al iniciar la instancia
-
-    def refresh_access_token(self):
-        """Refresca el access token y actualiza los headers."""
-        url = "https://accounts.zoho.com/oauth/v2/token"
+        self.ruta_cache = ruta_cache or os.getenv("ZOHO_TOKEN_CACHE", "/tmp/zoho_token.json")
+        self.margen = margen
+        self._token = None
+        self._expira = 0.0
+        self._proximo_intento = 0.0
+        self._lock = threading.Lock()
+        self._metricas = {"renovaciones": 0, "desde_cache": 0, "invalidaciones": 0, "errores": 0}
+
+    def _vigente(self, expira):
+        return time.time() < expira - self.margen
+
+    def obtener(self):
+        """
+        Devuelve un access token vigente, renovándolo (o tomándolo del caché compartido) si está por vencer.
+        Si la renovación falla devuelve el último token conocido (o None) y no la reintenta hasta pasados 30 s.
+        """
+        token, expira = self._token, self._expira
+        if token and self._vigente(expira):
+            return token
+        with self._lock:
+            if (self._token and self._vigente(self._expira)) or time.time() < self._proximo_intento:
+                return self._token
+            with open(f"{self.ruta_cache}.lock", "a") as archivo_lock:
+                if fcntl:
+                    fcntl.flock(archivo_lock, fcntl.LOCK_EX)
+                try:
+                    cache = self._leer_cache()
+                    if cache and cache["token"] != self._token and self._vigente(cache["expira"]):
+                        self._token, self._expira = cache["token"], cache["expira"]
+                        self._metricas["desde_cache"] += 1
+                    else:
+                        self._renovar()
+                finally:
+                    if fcntl:
+                        fcntl.flock(archivo_lock, fcntl.LOCK_UN)
+            return self._token
+
+    def _renovar(self):
+        """Pide un access token nuevo a Zoho y lo guarda en el caché. Se llama con los locks tomados."""
         params = {
             'refresh_token': self.refresh_token,
             'client_id': self.client_id,
             'client_secret': self.client_secret,
             'grant_type': 'refresh_token'
         }
-        response = requests.post(url, params=params)
-        if response.status_code == 200:
-            tokens = response.json()
-            self.access_token = tokens.get('access_token')
-            self.headers['Authorization'] = f'Zoho-oauthtoken {self.access_token}'
-            self.headers['Content-Type'] = 'application/json'
-            print("Access token actualizado.")
-        else:
-            print(f"Error al refrescar el access token: {response.text}")
+        try:
+            response = requests.post(self.URL_TOKEN, params=params)
+            tokens = response.json() if response.status_code == 200 else {}
+            detalle = response.text
+        except (requests.RequestException, ValueError) as e:
+            tokens, detalle = {}, str(e)
+        if not tokens.get('access_token'):
+            # Zoho responde 200 con {"error": ...} cuando rechaza la renovación
+            print(f"Error al refrescar el access token: {detalle}")
+            self._metricas["errores"] += 1
+            self._proximo_intento = time.time() + 30
+            return
+        self._proximo_intento = 0.0
+        self._token = tokens['access_token']
+        self._expira = time.time() + int(tokens.get('expires_in', 3600))
+        self._metricas["renovaciones"] += 1
+        self._escribir_cache()
+        print("Access token actualizado.")
+
+    def _leer_cache(self):
+        try:
+            with open(self.ruta_cache) as archivo:
+                cache = json.load(archivo)
+        except (OSError, ValueError):
+            return None
+        # El caché puede ser de otra aplicación de Zoho si se comparte la ruta
+        return cache if cache.get("client_id") == self.client_id else None
+
+    def _escribir_cache(self):
+        temporal = f"{self.ruta_cache}.{os.getpid()}.tmp"
+        try:
+            # Solo lectura para el usuario del proceso: el archivo contiene el token
+            descriptor = os.open(temporal, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(descriptor, "w") as archivo:
+                json.dump({"client_id": self.client_id, "token": self._token, "expira": self._expira}, archivo)
+            os.replace(temporal, self.ruta_cache)
+        except OSError as e:
+            print(f"No se pudo guardar el access token de Zoho en {self.ruta_cache}: {e}")
+
+    def invalidar(self, token):
+        """Descarta `token` tras un 401 para que el próximo `obtener` lo renueve (si otro hilo no lo hizo ya)."""
+        if token is None:
+            # Sin token no hay nada que descartar; invalidarlo reiniciaría la espera tras una renovación fallida
+            return
+        with self._lock:
+            if self._token == token:
+                self._expira = 0.0
+                self._proximo_intento = 0.0
+                self._metricas["invalidaciones"] += 1
+
+    def metricas(self):
+        with self._lock:
+            metricas = dict(self._metricas)
+            metricas["segundos_para_vencer"] = round(self._expira - time.time()) if self._token else None
+        return metricas
+
+class ZohoCRMManager:
+    def __init__(self, client_id, client_secret, redirect_uri, refresh_token):
+        self.api_base_url = "https://www.zohoapis.com/crm/v2"
+        # La v2.1 devuelve next_page_token para seguir leyendo más allá de los 2000 primeros registros
+        self.api_paginacion_url = "https://www.zohoapis.com/crm/v2.1"
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.redirect_uri = redirect_uri
+        self.refresh_token = refresh_token
+        # El token se pide en la primera llamada y se renueva antes de vencer
+        self.tokens = ZohoTokenManager(client_id, client_secret, refresh_token)
+
+    @property
+    def access_token(self):
+        return self.tokens.obtener()
+
+    def _headers(self, token):
+        return {'Authorization': f'Zoho-oauthtoken {token}', 'Content-Type': 'application/json'}
+
+    def refresh_access_token(self):
+        """Fuerza la renovación del access token (normalmente no hace falta: se renueva antes de vencer)."""
+        self.tokens.invalidar(self.tokens.obtener())
+        self.tokens.obtener()
+
+    def _sin_token(self, url):
+        """Respuesta 401 local para no llamar a Zoho sin access token (la renovación falló y espera para reintentar)."""
+        response = requests.Response()
+        response.status_code = 401
+        response.url = url
+        response._content = b'{"code": "SIN_TOKEN", "message": "No hay access token de Zoho disponible"}'
+        return response
 
     def _request_with_token_refresh(self, method, url, **kwargs):
-        """Realiza una solicitud y refresca el token en caso de error de autenticación."""
-        response = requests.request(method, url, headers=self.headers, **kwargs)
-        if response.status_code == 401:  # Unauthorized, probablemente el token ha expirado
-            print("El access token ha expirado. Intentando refrescar el token...")
-            self.refresh_access_token()
-            # Reintenta la solicitud con el nuevo token
-            response = requests.request(method, url, headers=self.headers, **kwargs)
+        """Realiza una solicitud con un token vigente y, si Zoho lo revocó antes de tiempo (401), reintenta una vez con uno nuevo."""
+        token = self.tokens.obtener()
+        if token is None:
+            return self._sin_token(url)
+        response = requests.request(method, url, headers=self._headers(token), **kwargs)
+        if response.status_code == 401:
+            print("Zoho rechazó el access token. Intentando refrescar el token...")
+            self.tokens.invalidar(token)
+            token = self.tokens.obtener()
+            if token is None:
+                return self._sin_token(url)
+            response = requests.request(method, url, headers=self._headers(token), **kwargs)
         return response
 
     def obtener_leads_formateados(self, limit=10):
@@ -73,48 +208,70 @@ class ZohoCRMManager:
         return leads_formateados
     
 
-    def obtener_todos_los_leads(self, limit=None):
+    def _iterar_registros(self, modulo, campos=None, por_pagina=MAX_POR_PAGINA, **filtros):
+        """
+        Recorre los registros de un módulo de Zoho página a página, a medida que se consumen.
+
+        Sigue info.more_records con el número de página y, cuando Zoho lo devuelve, con next_page_token.
+        Solo guarda en memoria la página actual. Si una página falla se informa y la iteración termina.
+
+        Args:
+            modulo (str): Módulo de Zoho ("Leads", "Contacts", ...).
+            campos (list): Campos a traer; acotarlos reduce el tamaño de cada página.
+            por_pagina (int): Registros por página, hasta MAX_POR_PAGINA.
+            **filtros: Parámetros adicionales de la consulta (p. ej. sort_by, cvid).
+        """
+        url = f"{self.api_paginacion_url}/{modulo}"
+        params = dict(filtros, per_page=min(max(1, por_pagina), MAX_POR_PAGINA), page=1)
+        if campos:
+            params['fields'] = ",".join(campos)
+        while True:
+            response = self._request_with_token_refresh("GET", url, params=params)
+            if response.status_code == 204:  # Sin registros
+                return
+            if response.status_code != 200:
+                print(f"Error al obtener {modulo} (página {params.get('page')}): {response.text}")
+                return
+            contenido = response.json()
+            yield from contenido.get('data', [])
+
+            info = contenido.get('info', {})
+            if not info.get('more_records'):
+                return
+            if info.get('next_page_token'):
+                params.pop('page', None)
+                params['page_token'] = info['next_page_token']
+            else:
+                params['page'] = info.get('page', params.get('page', 1)) + 1
+
+    def iterar_leads(self, campos=None, por_pagina=MAX_POR_PAGINA, **filtros):
+        """Generador con todos los leads de Zoho, página a página (ver _iterar_registros)."""
+        return self._iterar_registros("Leads", campos, por_pagina, **filtros)
+
+    def iterar_contactos(self, campos=None, por_pagina=MAX_POR_PAGINA, **filtros):
+        """Generador con todos los contactos de Zoho, página a página (ver _iterar_registros)."""
+        return self._iterar_registros("Contacts", campos, por_pagina, **filtros)
+
+    def obtener_todos_los_leads(self, limit=None, campos=None):
         """
         Obtiene una lista de leads desde Zoho CRM, con un límite opcional.
         
         Args:
-            limit (int): Cantidad máxima de leads a recuperar.
+            limit (int): Cantidad máxima de leads a recuperar; sin límite se recorren todas las páginas.
+            campos (list): Campos a traer de cada lead (todos por defecto).
             
         Returns:
             list: Lista de leads.
         """
-        url = f"{self.api_base_url}/Leads"
-        params = {}
-        
-        # Establecemos el límite de resultados en los parámetros, si se especifica
-        if limit:
-            params['per_page'] = limit
-            params['page'] = 1
+        # Para volúmenes grandes conviene iterar_leads, que no carga todos los leads en memoria
+        por_pagina = min(limit, MAX_POR_PAGINA) if limit else MAX_POR_PAGINA
+        leads = list(islice(self.iterar_leads(campos, por_pagina), limit))
+        print(f"Se obtuvieron {len(leads)} leads.")
+        return leads
 
-        response = self._request_with_token_refresh("GET", url, params=params)
-        if response.status_code == 200:
-            leads = response.json().get('data', [])
-            print(f"Se obtuvieron {len(leads)} leads.")
-            return leads
-        else:
-            print(f"Error al obtener los leads: {response.text}")
-            return []
-
-    def obtener_todos_los_clientes(self, limit=None):
-        url = f"{self.api_base_url}/Contacts"
-        params = {}
-        
-        # Si se especifica un límite, lo incluimos en los parámetros
-        if limit:
-            params['per_page'] = limit
-
-        response = self._request_with_token_refresh("GET", url, params=params)
-        if response.status_code == 200:
-            contactos = response.json().get('data', [])
-            return contactos
-        else:
-            print(f"Error al obtener los contactos: {response.text}")
-            return []
+    def obtener_todos_los_clientes(self, limit=None, campos=None):
+        por_pagina = min(limit, MAX_POR_PAGINA) if limit else MAX_POR_PAGINA
+        return list(islice(self.iterar_contactos(campos, por_pagina), limit))
 
     def obtener_cliente_por_id(self, contact_id):
         url = f"{self.api_base_url}/Contacts/{contact_id}"
@@ -294,11 +451,6 @@ class ZohoCRMManager:
             list: Lista de leads que cumplen con los filtros.
         """
         url = f"{self.api_base_url}/coql"
-        headers = {
-            'Authorization': f'Zoho-oauthtoken {self.access_token}',
-            'Content-Type': 'application/json'
-        }
-        print(self.access_token)
         # Construir la consulta COQL
         query = "SELECT * FROM Leads"
         conditions = []
@@ -325,7 +477,7 @@ class ZohoCRMManager:
             'select_query': query
         }
 
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
+        response = self._request_with_token_refresh("POST", url, data=json.dumps(payload))
 
         if response.status_code == 200:
             leads = response.json().get('data', [])
@@ -0,0 +1,147 @@
+import random
+import time
+import datetime as dt
+import pytz
+from components.calendar_component import GoogleCalendarManager, IndiceOcupacion, intervalo_evento
+
+# Compara el cálculo de horarios libres con una referencia por minutos sobre calendarios sintéticos
+# muy cargados (eventos desordenados, solapados, de todo el día, cancelados y transparentes), sin
+# llamar a Google Calendar. También mide cuánto tarda el índice y cuántas páginas se leen.
+
+DIAS = 200
+EVENTOS_POR_DIA = (20, 400)
+POR_PAGINA = 50
+CONSULTAS_CONFLICTO = 2000
+
+lima_tz = pytz.timezone("America/Lima")
+random.seed(7)
+
+class _Peticion:
+    def __init__(self, resultado):
+        self.resultado = resultado
+
+    def execute(self):
+        return self.resultado
+
+class _EventosSimulados:
+    """events().list con paginación sobre una lista fija de eventos (sin orden)."""
+
+    def __init__(self, servicio):
+        self.servicio = servicio
+
+    def list(self, maxResults=250, pageToken=None, **kwargs):
+        self.servicio.paginas += 1
+        inicio = int(pageToken or 0)
+        pagina = self.servicio.eventos[inicio:inicio + maxResults]
+        resultado = {"items": pagina}
+        if inicio + maxResults < len(self.servicio.eventos):
+            resultado["nextPageToken"] = str(inicio + maxResults)
+        return _Peticion(resultado)
+
+class CalendarioSimulado:
+    def __init__(self):
+        self.eventos = []
+        self.paginas = 0
+
+    def events(self):
+        return _EventosSimulados(self)
+
+def generar_dia(fecha):
+    """Eventos aleatorios de un día: solapados, desordenados y con casos especiales."""
+    eventos = []
+    for _ in range(random.randint(*EVENTOS_POR_DIA)):
+        inicio = lima_tz.localize(dt.datetime.combine(fecha, dt.time(8, 0))) + dt.timedelta(minutes=random.randrange(0, 14 * 60, 5))
+        fin = inicio + dt.timedelta(minutes=random.choice((10, 15, 30, 45, 60, 90, 120)))
+        evento = {"start": {"dateTime": inicio.isoformat()}, "end": {"dateTime": fin.isoformat()}}
+        azar = random.random()
+        if azar < 0.05:
+            evento["transparency"] = "transparent"
+        elif azar < 0.08:
+            evento["status"] = "cancelled"
+        eventos.append(evento)
+    # Evento de todo el día que no bloquea (p. ej. un recordatorio) y, a veces, uno que sí bloquea
+    eventos.append({"start": {"date": fecha.isoformat()}, "end": {"date": (fecha + dt.timedelta(days=1)).isoformat()},
+                    "transparency": "transparent"})
+    if random.random() < 0.05:
+        eventos.append({"start": {"date": fecha.isoformat()}, "end": {"date": (fecha + dt.timedelta(days=1)).isoformat()}})
+    random.shuffle(eventos)
+    return eventos
+
+def libres_referencia(eventos, inicio, fin):
+    """Horarios libres minuto a minuto (lento pero evidente)."""
+    ocupados = [intervalo for intervalo in (intervalo_evento(evento, lima_tz) for evento in eventos) if intervalo]
+    libres = []
+    actual = None
+    minuto = inicio
+    while minuto < fin:
+        libre = not any(a <= minuto < b for a, b in ocupados)
+        if libre and actual is None:
+            actual = minuto
+        elif not libre and actual is not None:
+            libres.append((actual, minuto))
+            actual = None
+        minuto += dt.timedelta(minutes=1)
+    if actual is not None:
+        libres.append((actual, fin))
+    return libres
+
+def libres_anterior(eventos, inicio, fin, max_results=10):
+    """Barrido anterior: primeros `max_results` eventos, asumiendo que vienen ordenados y sin solaparse."""
+    libres = []
+    for evento in eventos[:max_results]:
+        if "dateTime" not in evento["start"]:
+            return []  # el código anterior fallaba con eventos de todo el día
+        evento_inicio = dt.datetime.fromisoformat(evento["start"]["dateTime"]).astimezone(lima_tz)
+        evento_fin = dt.datetime.fromisoformat(evento["end"]["dateTime"]).astimezone(lima_tz)
+        if inicio < evento_fin and evento_inicio < fin:
+            if evento_inicio > inicio:
+                libres.append((inicio, evento_inicio))
+            inicio = evento_fin
+    if inicio < fin:
+        libres.append((inicio, fin))
+    return libres
+
+servicio = CalendarioSimulado()
+calendar = GoogleCalendarManager(ttl_disponibilidad=0, service=servicio)
+
+fecha = dt.date(2030, 1, 1)  # martes
+diferencias = 0
+diferencias_anterior = 0
+total_eventos = 0
+tiempo_lectura = 0.0
+tiempo_indice = 0.0
+tiempo_conflictos = 0.0
+for _ in range(DIAS):
+    servicio.eventos = generar_dia(fecha)
+    total_eventos += len(servicio.eventos)
+    tramo_inicio = lima_tz.localize(dt.datetime.combine(fecha, dt.time(13, 30)))
+    tramo_fin = lima_tz.localize(dt.datetime.combine(fecha, dt.time(20, 30)))
+
+    inicio_medicion = time.perf_counter()
+    intervalos = calendar._eventos_ocupados(fecha.isoformat(), por_pagina=POR_PAGINA)
+    tiempo_lectura += time.perf_counter() - inicio_medicion
+
+    inicio_medicion = time.perf_counter()
+    indice = IndiceOcupacion(intervalos)
+    libres = indice.libres(tramo_inicio, tramo_fin)
+    tiempo_indice += time.perf_counter() - inicio_medicion
+
+    inicio_medicion = time.perf_counter()
+    for _ in range(CONSULTAS_CONFLICTO):
+        consulta = tramo_inicio + dt.timedelta(minutes=random.randrange(0, 7 * 60, 5))
+        indice.conflicto(consulta, consulta + dt.timedelta(minutes=30))
+    tiempo_conflictos += time.perf_counter() - inicio_medicion
+
+    referencia = libres_referencia(servicio.eventos, tramo_inicio, tramo_fin)
+    diferencias += libres != referencia
+    diferencias_anterior += libres_anterior(servicio.eventos, tramo_inicio, tramo_fin) != referencia
+    fecha += dt.timedelta(days=7)
+
+print("=== Horarios libres en días muy cargados ===")
+print(f"Días evaluados: {DIAS} ({total_eventos / DIAS:.0f} eventos por día en promedio)")
+print(f"Páginas leídas de Calendar: {servicio.paginas} ({POR_PAGINA} eventos por página)")
+print(f"Días con horarios distintos a la referencia: {diferencias}")
+print(f"Días con horarios distintos a la referencia con el barrido anterior: {diferencias_anterior}")
+print(f"Lectura y conversión de eventos: {tiempo_lectura / DIAS * 1000:.2f} ms por día")
+print(f"Índice y horarios libres: {tiempo_indice / DIAS * 1000:.3f} ms por día")
+print(f"Verificación de conflictos: {tiempo_conflictos / (DIAS * CONSULTAS_CONFLICTO) * 1e6:.2f} µs por consulta")
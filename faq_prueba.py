@@ -0,0 +1,69 @@
+from components.openai_component import OpenAIManager
+from components.database_mongodb_component import DataBaseMongoDBManager
+from helpers.helpers import formatear_conversacion
+
+# Compara prompt_consulta v4 (todas las preguntas frecuentes) con v5 (solo las relevantes, índice BM25)
+# sobre las conversaciones guardadas en MongoDB: tokens por llamada y, opcionalmente, paridad de respuestas.
+
+MAX_CONVERSACIONES = 30
+# Genera las respuestas con ambas versiones y pide al modelo que juzgue si son equivalentes (hace llamadas reales)
+COMPARAR_RESPUESTAS = False
+MAX_COMPARACIONES = 20
+
+openai = OpenAIManager()
+dbMongoManager = DataBaseMongoDBManager()
+
+v4 = openai.prompts.obtener("consulta", "v4")
+v5 = openai.prompts.obtener("consulta", "v5")
+cliente = {"nombre": "Cliente", "celular": "+51000000000", "estado": "seguimiento"}
+
+turnos = []
+for documento in dbMongoManager.obtener_conversaciones_activas()[:MAX_CONVERSACIONES]:
+    interacciones = documento["conversaciones"][0].get("interacciones", [])
+    for fin in range(1, len(interacciones) + 1):
+        if interacciones[fin - 1].get("mensaje_chatbot"):
+            turnos.append({"interacciones": interacciones[:fin]})
+
+if not turnos:
+    print("No hay conversaciones guardadas para comparar.")
+    raise SystemExit
+
+print("=== Tokens por llamada de consulta ===")
+tokens_v4 = [v4.tokens(cliente=cliente, conversacion=turno) for turno in turnos]
+tokens_v5 = [v5.tokens(cliente=cliente, conversacion=turno) for turno in turnos]
+media_v4 = sum(tokens_v4) / len(turnos)
+media_v5 = sum(tokens_v5) / len(turnos)
+print(f"Turnos evaluados: {len(turnos)}")
+print(f"v4: {media_v4:.0f} tokens de prompt (sin la conversación) en promedio")
+print(f"v5: {media_v5:.0f} tokens de prompt (sin la conversación) en promedio")
+print(f"Ahorro: {media_v4 - media_v5:.0f} tokens por llamada ({(1 - media_v5 / media_v4) * 100:.1f}%)")
+print(f"Turnos que usaron el respaldo completo: {sum(1 for a, b in zip(tokens_v4, tokens_v5) if b >= a)}")
+
+if COMPARAR_RESPUESTAS:
+    print("=== Paridad de respuestas v4 vs v5 ===")
+    equivalentes = 0
+    comparados = turnos[-MAX_COMPARACIONES:]
+    for turno in comparados:
+        conversacion = formatear_conversacion(turno)
+        respuestas = []
+        for plantilla in (v4, v5):
+            estatico, dinamico = plantilla.armar(cliente=cliente, conversacion=turno)
+            respuestas.append(openai._completar(openai._mensajes(estatico, dinamico + conversacion), max_tokens=250,
+                                                clave_cache=plantilla.etiqueta, prompt=plantilla.etiqueta))
+        veredicto = openai._completar(
+            [{"role": "system", "content": f"""Compara dos respuestas de una asesora a la misma conversación.
+Responde solo SI si ambas dan la misma información al cliente (aunque cambie la redacción) o NO en otro caso.
+
+Conversación:
+{conversacion}
+
+Respuesta A: {respuestas[0]}
+Respuesta B: {respuestas[1]}"""}],
+            max_tokens=5,
+            ruta="clasificacion",
+        )
+        equivalentes += 1 if veredicto.strip().upper().startswith("SI") else 0
+        print("v4:", respuestas[0])
+        print("v5:", respuestas[1])
+        print("Equivalentes:", veredicto)
+    print(f"Paridad: {equivalentes}/{len(comparados)} respuestas equivalentes")
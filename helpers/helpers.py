@@ -1,6 +1,9 @@
 import re
 import datetime
 import json
+import unicodedata
+import threading
+import time
 
 def json_a_lista(datos):
     # Asumimos que `datos` ya es un diccionario JSON
@@ -34,6 +37,105 @@ def extraer_json(texto):
         print("Error: No se encontró un JSON válido en el texto.")
         return None
 
+class ExtractorJSONIncremental:
+    """
+    Extrae los valores de claves de primer nivel de un JSON que llega por fragmentos (streaming).
+
+    Cada vez que se completa el valor de una de las claves en `campos`, se llama a
+    `al_campo(clave, valor)`. Si el callback devuelve True, `alimentar` devuelve True para
+    indicar que ya no es necesario seguir leyendo el stream.
+    """
+
+    def __init__(self, campos, al_campo):
+        self.campos = set(campos)
+        self.al_campo = al_campo
+        self.valores = {}
+        self.completo = False
+        self._profundidad = 0
+        self._en_cadena = False
+        self._escape = False
+        self._literal = False
+        self._token = []
+        self._clave = None
+        self._esperando_valor = False
+
+    def alimentar(self, fragmento):
+        """Procesa un fragmento de texto; devuelve True si el callback pidió detener la lectura."""
+        for caracter in fragmento:
+            if self._procesar(caracter):
+                self.completo = True
+        return self.completo
+
+    def _procesar(self, caracter):
+        if self._en_cadena:
+            if self._escape:
+                self._escape = False
+            elif caracter == "\\":
+                self._escape = True
+            elif caracter == '"':
+                self._en_cadena = False
+                return self._cerrar_cadena()
+            self._token.append(caracter)
+            return False
+
+        detener = False
+        if self._literal:
+            if caracter not in ",}]" and not caracter.isspace():
+                self._token.append(caracter)
+                return False
+            self._literal = False
+            detener = self._cerrar_literal()
+
+        if caracter == '"':
+            self._en_cadena = True
+            self._token = []
+        elif caracter in "{[":
+            self._profundidad += 1
+            if self._profundidad > 1:
+                # Los valores anidados no se extraen
+                self._esperando_valor = False
+        elif caracter in "}]":
+            self._profundidad -= 1
+        elif self._profundidad == 1:
+            if caracter == ":":
+                self._esperando_valor = True
+            elif caracter == ",":
+                self._clave = None
+                self._esperando_valor = False
+            elif self._esperando_valor and not caracter.isspace():
+                self._literal = True
+                self._token = [caracter]
+        return detener
+
+    def _cerrar_cadena(self):
+        if self._profundidad != 1:
+            return False
+        texto = json.loads('"' + "".join(self._token) + '"')
+        if self._esperando_valor:
+            self._esperando_valor = False
+            return self._emitir(texto)
+        self._clave = texto
+        return False
+
+    def _cerrar_literal(self):
+        self._esperando_valor = False
+        literal = "".join(self._token)
+        try:
+            valor = json.loads(literal)
+        except json.JSONDecodeError:
+            valor = literal
+        return self._emitir(valor)
+
+    def _emitir(self, valor):
+        if self._clave not in self.campos or self._clave in self.valores:
+            return False
+        self.valores[self._clave] = valor
+        return bool(self.al_campo(self._clave, valor))
+
+def limpiar_respuesta(mensaje):
+    """Quita el prefijo de rol y las comillas sobrantes del mensaje que se envía al cliente."""
+    return mensaje.replace("Asesor: ", "").strip('"')
+
 def format_number(numero_celular):
     # Verificar si el número ya comienza con "+51"
     if numero_celular.startswith("+51"):
@@ -64,6 +166,11 @@ def formatear_historial_conversaciones(conversaciones):
 def formatear_conversacion(conversacion):
     """Convierte una conversación en un formato de string con saltos de línea entre interacciones."""
     historial_formateado = []
+
+    # Si los turnos más antiguos ya se plegaron en un resumen, este va antes de los turnos recientes
+    resumen = conversacion.get("resumen")
+    if resumen:
+        historial_formateado.append(f'Resumen de la conversación anterior: "{resumen}"')
     
     for interaccion in conversacion.get("interacciones", []):
         mensaje_cliente = interaccion.get("mensaje_cliente", "")
@@ -78,6 +185,64 @@ def formatear_conversacion(conversacion):
     return "\n".join(historial_formateado)
 
 
+def normalizar_texto(texto):
+    """Minúsculas, sin tildes, sin signos de puntuación (salvo ? : / -) y con espacios simples."""
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    texto = "".join(caracter for caracter in texto if not unicodedata.combining(caracter))
+    texto = re.sub(r"[^\w\s?:/-]", " ", texto)
+    return re.sub(r"\s+", " ", texto).strip()
+
+def contar_tokens(texto):
+    """
+    Cuenta los tokens de un texto con tiktoken si está instalado; si no, los estima a razón
+    de ~4 caracteres por token, que es suficiente para controlar presupuestos de prompt.
+    """
+    global _codificador_tokens
+    if _codificador_tokens is None:
+        try:
+            import tiktoken
+            _codificador_tokens = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _codificador_tokens = False
+    if _codificador_tokens:
+        return len(_codificador_tokens.encode(texto))
+    return len(texto) // 4 + 1
+
+_codificador_tokens = None
+
+class TokenBucket:
+    """
+    Limitador de tasa tipo token bucket, seguro entre hilos.
+
+    Se recargan `tasa` unidades por segundo hasta `capacidad`. `reservar` descuenta las unidades
+    de inmediato (el saldo puede quedar negativo) y devuelve los segundos que el llamador debe
+    esperar antes de usarlas, de modo que sirve tanto para código síncrono como asíncrono.
+    """
+
+    def __init__(self, tasa, capacidad):
+        self.tasa = float(tasa)
+        self.capacidad = float(capacidad)
+        self._saldo = float(capacidad)
+        self._ultima_recarga = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reservar(self, cantidad=1):
+        """Reserva `cantidad` unidades y devuelve la espera necesaria en segundos (0 si hay saldo)."""
+        with self._lock:
+            ahora = time.monotonic()
+            self._saldo = min(self.capacidad, self._saldo + (ahora - self._ultima_recarga) * self.tasa)
+            self._ultima_recarga = ahora
+            # Una petición mayor que la capacidad se acota para que no bloquee para siempre
+            self._saldo -= min(cantidad, self.capacidad)
+            return 0.0 if self._saldo >= 0 else -self._saldo / self.tasa
+
+    def adquirir(self, cantidad=1):
+        """Versión bloqueante de `reservar`: espera hasta que las unidades estén disponibles."""
+        espera = self.reservar(cantidad)
+        if espera > 0:
+            time.sleep(espera)
+
+
 def extract_datetime(message):
     print("Mensaje recibido:", repr(message))
     # Expresiones regulares para distintos formatos de fecha y hora
@@ -110,7 +275,8 @@ def extract_datetime(message):
                         "julio": 7, "agosto": 8, "septiembre": 9, "octubre": 10, "noviembre": 11, "diciembre": 12
                     }
                     user_date = datetime.date(datetime.datetime.now().year, month_dict[month.lower()], int(day))
-            except ValueError:
+            except (ValueError, KeyError):
+                # KeyError: "5 de la tarde" encaja con "D de Mes" pero "la" no es un mes
                 continue
 
             print("User date",user_date)
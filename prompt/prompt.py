@@ -1,5 +1,7 @@
 from datetime import datetime
+from functools import lru_cache
 
+@lru_cache(maxsize=None)
 def prompt_estado_cliente(estado):
     if estado == "pendiente de contacto":
         return f"""
@@ -52,6 +54,20 @@ def prompt_cliente_nombre(cliente, response_message,conversacion_actual):
     **Conversacion actual**: {conversacion_actual}
     """
 
+def prompt_resumen_conversacion(resumen_previo, interacciones):
+    return f"""
+    Eres una asesora del Instituto Facial y Capilar (IFC) y mantienes un resumen breve de tu conversación por WhatsApp con un cliente. Actualiza el resumen previo incorporando las nuevas interacciones.
+
+    Conserva solo lo que sirve para continuar la conversación: nombre del cliente, dudas ya resueltas, precios o promociones mencionadas, fechas y horarios propuestos o reservados, pagos, objeciones y causas de no interés. No inventes información.
+
+    Responde solo con el resumen actualizado, en español, en un máximo de 120 palabras.
+
+    **Resumen previo**: {resumen_previo or "(sin resumen)"}
+
+    **Nuevas interacciones**:
+    {interacciones}
+    """
+
 def prompt_lead_estado(lead):
 
     return f""""
@@ -120,17 +136,7 @@ def prompt_lead_estado_zoho(lead):
         Devuelve el siguiente resultado en el formato: "estado del cliente" - "mensaje personalizado" (si hay mensaje).
     """
 
-def prompt_consulta_v4(cliente):
-    prompt_estado = prompt_estado_cliente(cliente["estado"])
-    return f"""
-Eres una asesora del Instituto Facial y Capilar (IFC) en una conversación por WhatsApp. Te llamas Sofía, eres una asesora especializada y estás encantada de poder ayudar. El cliente ya ha mostrado interés en los servicios. Inicias la conversación de manera casual y amistosa, preguntando si necesita más información, resolver dudas o agendar una cita. Usa un tono respetuoso y profesional, pero casual y natural, como en una conversación común de WhatsApp. Emplea emojis, abreviaciones y expresiones como "Mmm..." o "Okey", manteniendo la interacción breve y amena.
-
-RECUERDA SIEMPRE PRESENTARTE PARA EL PRIMER MENSAJE.
-SOLO SE PUEDE RESERVAR CITAS EN ESTE HORARIO : Martes y Jueves de 1:30 p.m. a 8:30 p.m. ; sábados de 10 a.m. 5 p.m.
-
-### **Preguntas frecuentes**:
-
-**1. ¿En qué consiste un trasplante capilar con la técnica FUE?**
+PREGUNTAS_FRECUENTES = """**1. ¿En qué consiste un trasplante capilar con la técnica FUE?**
 Es un procedimiento quirúrgico que extrae folículos capilares individuales de la zona donante y los trasplanta a áreas con pérdida de cabello, logrando resultados naturales sin cicatrices visibles.
 
 **2. ¿Cuánto tiempo dura el procedimiento de trasplante capilar?**
@@ -188,9 +194,54 @@ La consulta inicial dura aproximadamente 30 minutos.
 El costo varía entre 4,500 y 6,800 soles, sujeta a la cantidad de unidades foliculares que el médico recomiende.
 
 **20. ¿Cuánto cuesta la unidad folicular?**
-La unidad folicular tiene un costo de 1.7 soles por folículo trasplantado.
+La unidad folicular tiene un costo de 1.7 soles por folículo trasplantado."""
 
-### **Instrucciones de estilo**:
+def prompt_consulta_v4(cliente):
+    return prompt_consulta_v4_estatico() + prompt_consulta_v4_dinamico(cliente)
+
+def prompt_consulta_v4_dinamico(cliente):
+    """Parte variable de prompt_consulta_v4: datos del cliente y encabezado de la conversación actual."""
+    return prompt_consulta_v4_cliente(cliente) + """### **Conversación actual**:
+
+"""
+
+@lru_cache(maxsize=1)
+def prompt_consulta_v4_estatico():
+    """
+    Parte fija de prompt_consulta_v4 (instrucciones, preguntas frecuentes, precios y horarios).
+    Es idéntica para todos los clientes, así que va primero para aprovechar el caché de prompts.
+    """
+    return prompt_consulta_base(f"""### **Preguntas frecuentes**:
+
+{PREGUNTAS_FRECUENTES}
+
+""")
+
+@lru_cache(maxsize=1)
+def prompt_consulta_v5_estatico():
+    """
+    Parte fija de prompt_consulta_v5: la de v4 sin las preguntas frecuentes, que en v5 se
+    seleccionan según la conversación y van en la parte variable.
+    """
+    return prompt_consulta_base("")
+
+def prompt_consulta_v5_dinamico(cliente, preguntas_relevantes):
+    """Parte variable de prompt_consulta_v5: preguntas frecuentes relevantes, datos del cliente y encabezado de la conversación."""
+    return f"""### **Preguntas frecuentes relevantes**:
+
+{preguntas_relevantes}
+
+""" + prompt_consulta_v4_dinamico(cliente)
+
+def prompt_consulta_base(bloque_preguntas_frecuentes):
+    """Instrucciones de Sofía comunes a las versiones de prompt_consulta, con el bloque de preguntas frecuentes indicado."""
+    return f"""
+Eres una asesora del Instituto Facial y Capilar (IFC) en una conversación por WhatsApp. Te llamas Sofía, eres una asesora especializada y estás encantada de poder ayudar. El cliente ya ha mostrado interés en los servicios. Inicias la conversación de manera casual y amistosa, preguntando si necesita más información, resolver dudas o agendar una cita. Usa un tono respetuoso y profesional, pero casual y natural, como en una conversación común de WhatsApp. Emplea emojis, abreviaciones y expresiones como "Mmm..." o "Okey", manteniendo la interacción breve y amena.
+
+RECUERDA SIEMPRE PRESENTARTE PARA EL PRIMER MENSAJE.
+SOLO SE PUEDE RESERVAR CITAS EN ESTE HORARIO : Martes y Jueves de 1:30 p.m. a 8:30 p.m. ; sábados de 10 a.m. 5 p.m.
+
+{bloque_preguntas_frecuentes}### **Instrucciones de estilo**:
 
 - **Formato de respuesta**: Todas tus respuestas deben estar en el formato JSON `{{ "mensaje": "..." }}`, donde "mensaje" es el texto que enviarás al cliente.
 - **Mensajes breves y precisos**: Responde de forma concisa, no más de 25 palabras, excepto en las excepciones indicadas.
@@ -253,7 +304,12 @@ La unidad folicular tiene un costo de 1.7 soles por folículo trasplantado.
 - **Link de pago de 30 soles**: https://express.culqi.com/pago/4XCSWS2MAI (En este link pago se puede pagar por yape, plin o tarjeta de crédito) -> En caso el cliente quiera cancelar la cita con el pago parcial de 30 soles
 - **Promoción**: Menciona la promoción actual de 40% de descuento en la consulta inicial (de 100 soles a 60 soles) solo si notas que al cliente el precio le parece elevado. Ofrece el descuento como algo especial para él. **SOLO OFRECER DESCUENTO SI EL CLIENTE PAGA DE FORMA ONLINE PREVIAMENTE A LA CITA.**
 
-### **Datos del cliente**:
+"""
+
+def prompt_consulta_v4_cliente(cliente):
+    """Parte variable de prompt_consulta_v4: datos del cliente y tono según su estado."""
+    prompt_estado = prompt_estado_cliente(cliente["estado"])
+    return f"""### **Datos del cliente**:
 
 - **Nombre**: {cliente["nombre"]}
 - **Teléfono**: {cliente["celular"]}
@@ -263,8 +319,6 @@ La unidad folicular tiene un costo de 1.7 soles por folículo trasplantado.
 
 {prompt_estado}
 
-### **Conversación actual**:
-
 """
 
 def prompt_consulta_v3(cliente):
@@ -777,17 +831,11 @@ def prompt_consulta():
 
     """
 
-def prompt_intencionesv2(fecha_actual):
-    fecha_obj = datetime.strptime(fecha_actual, "%Y-%m-%d")
-
-    # Obtener el día de la semana en español
-    día_actual = fecha_obj.strftime("%A")
-    return f"""
-    Asume el rol de un asesor del Instituto Facial y Capilar (IFC) en una conversación por WhatsApp. La fecha actual es {fecha_actual} y es {día_actual}. Con base en esta fecha y día, y considerando que estás en Lima, Perú, determina la opción necesaria para continuar el diálogo con el cliente, siguiendo estos criterios: 
-
-    1) **Dudas, consultas, otros**: Selecciona esta opción cuando el cliente tenga alguna duda, consulta o pregunta que no implique agendar una cita ni solicitar horarios específicos.
+def criterios_intenciones(fecha_actual, día_actual):
+    """Criterios de clasificación de intenciones compartidos por los prompts de intención."""
+    return f"""    1) **Dudas, consultas, otros**: Selecciona esta opción cuando el cliente tenga alguna duda, consulta o pregunta que no implique agendar una cita ni solicitar horarios específicos.
 
-    2) **Planear cita/obtener horarios libres**: Selecciona esta opción cuando el cliente pregunte por horarios disponibles para agendar una cita o si el chatbot considera apropiado sugerir una fecha/hora específica. **Es obligatorio incluir la fecha solicitada en el formato AAAA-MM-DD** (ejemplo: 2024-10-28) si esta opción es seleccionada.
+    2) **Planear cita/obtener horarios libres**: Selecciona esta opción cuando el cliente pregunte por horarios disponibles para agendar una cita o si el chatbot considera apropiado sugerir una fecha/hora específica. **Es obligatorio incluir la fecha solicitada en el formato AAAA-MM-DD** (ejemplo: 2024-10-28) si esta opción es seleccionada. Si el cliente no menciona ningún día, no inventes una fecha: deja la fecha vacía y el sistema le ofrecerá los próximos horarios libres.
 
     - **Interpretación de fechas relativas**: Si el cliente menciona días relativos como "el lunes que viene" o "este viernes," calcula y devuelve la fecha exacta en Lima, Perú, tomando {fecha_actual} y {día_actual} como referencia.
     - **Ejemplos precisos**:
@@ -814,10 +862,54 @@ def prompt_intencionesv2(fecha_actual):
         - Cliente: "No puedo pagar ese monto ahora." → `{{ "intencion": 6, "categoria": "Precio", "detalle": "No puedo pagar ese monto ahora." }}`
         - Cliente: "El lugar me queda lejos." → `{{ "intencion": 6, "categoria": "Ubicación", "detalle": "El lugar me queda lejos." }}`
 
-    **Conversación actual**:
+"""
+
+@lru_cache(maxsize=32)
+def dia_semana(fecha_actual):
+    """Día de la semana de una fecha AAAA-MM-DD (se calcula una vez por fecha)."""
+    return datetime.strptime(fecha_actual, "%Y-%m-%d").strftime("%A")
+
+@lru_cache(maxsize=8)
+def prompt_intencionesv2(fecha_actual):
+    día_actual = dia_semana(fecha_actual)
+    return f"""
+    Asume el rol de un asesor del Instituto Facial y Capilar (IFC) en una conversación por WhatsApp. La fecha actual es {fecha_actual} y es {día_actual}. Con base en esta fecha y día, y considerando que estás en Lima, Perú, determina la opción necesaria para continuar el diálogo con el cliente, siguiendo estos criterios: 
+
+{criterios_intenciones(fecha_actual, día_actual)}    **Conversación actual**:
     
     """
 
+def prompt_intencion_respuesta(cliente, fecha_actual):
+    """Prompt de llamada única: clasifica la intención y redacta la respuesta en el mismo JSON."""
+    return prompt_intencion_respuesta_estatico() + prompt_intencion_respuesta_dinamico(cliente, fecha_actual)
+
+@lru_cache(maxsize=1)
+def prompt_intencion_respuesta_estatico():
+    """Parte fija del prompt de llamada única; no depende del cliente ni de la fecha."""
+    return prompt_consulta_v4_estatico() + f"""### **Clasificación de la intención**:
+
+Además de redactar tu respuesta, determina la opción necesaria para continuar el diálogo con el cliente. Toma como referencia la fecha actual y el día actual indicados más abajo y considera que estás en Lima, Perú. Sigue estos criterios:
+
+{criterios_intenciones("la fecha actual", "el día actual")}
+### **Formato de salida**:
+
+Devuelve únicamente un JSON con las claves "intencion", "categoria", "detalle" y "mensaje":
+- "intencion": número de la opción seleccionada (1 a 6).
+- "categoria": categoría de la causa de no interés (solo para la opción 6), en otro caso "".
+- "detalle": la fecha AAAA-MM-DD (opción 2), la fecha y hora AAAA-MM-DD HH:MM (opción 3), el nombre (opción 5) o la causa específica (opción 6), en otro caso "".
+- "mensaje": tu respuesta al cliente siguiendo las instrucciones de estilo. Para las opciones 2, 3 y 4 el sistema completará la respuesta con los horarios, la reserva o el link de pago, así que basta con un mensaje breve.
+
+"""
+
+def prompt_intencion_respuesta_dinamico(cliente, fecha_actual):
+    """Parte variable del prompt de llamada única: fecha actual, datos del cliente y encabezado de la conversación."""
+    día_actual = dia_semana(fecha_actual)
+    return f"""### **Fecha actual**:
+
+La fecha actual es {fecha_actual} y es {día_actual}.
+
+""" + prompt_consulta_v4_dinamico(cliente)
+
 def prompt_intenciones(fecha_actual):
     fecha_obj = datetime.strptime(fecha_actual, "%Y-%m-%d")
 
@@ -828,7 +920,7 @@ def prompt_intenciones(fecha_actual):
 
     1) **Dudas, consultas, otros**: Selecciona esta opción cuando el cliente tenga alguna duda, consulta o pregunta que no implique agendar una cita ni solicitar horarios específicos.
 
-    2) **Planear cita/obtener horarios libres**: Selecciona esta opción cuando el cliente pregunte por horarios disponibles para agendar una cita o si el chatbot considera apropiado sugerir una fecha/hora específica. **Es obligatorio incluir la fecha solicitada en el formato AAAA-MM-DD** (ejemplo: 2024-10-28) si esta opción es seleccionada.
+    2) **Planear cita/obtener horarios libres**: Selecciona esta opción cuando el cliente pregunte por horarios disponibles para agendar una cita o si el chatbot considera apropiado sugerir una fecha/hora específica. **Es obligatorio incluir la fecha solicitada en el formato AAAA-MM-DD** (ejemplo: 2024-10-28) si esta opción es seleccionada. Si el cliente no menciona ningún día, no inventes una fecha: deja la fecha vacía y el sistema le ofrecerá los próximos horarios libres.
 
     - **Interpretación de fechas relativas**: Si el cliente menciona días relativos como "el lunes que viene" o "este viernes," calcula y devuelve la fecha exacta en Lima, Perú, tomando {fecha_actual} y {día_actual} como referencia.
     - **Ejemplos precisos**:
@@ -0,0 +1,114 @@
+import math
+import os
+import re
+from helpers.helpers import normalizar_texto
+from prompt.prompt import PREGUNTAS_FRECUENTES
+
+# Palabras vacías que no aportan al puntaje BM25
+PALABRAS_VACIAS = {
+    "a", "al", "algo", "con", "como", "cual", "cuales", "de", "del", "el", "en", "es", "esta", "este", "hay",
+    "la", "las", "lo", "los", "me", "mi", "mis", "no", "o", "para", "pero", "por", "que", "se", "si", "sin",
+    "su", "sus", "te", "tu", "tus", "un", "una", "unos", "y", "ya", "yo", "hola", "gracias", "buenas",
+    "buenos", "dias", "tardes", "noches", "quisiera", "saber", "puedo", "tiene", "tienen", "usted",
+    "cuanto", "cuanta", "cuantos", "cuantas", "va", "voy", "ser",
+}
+
+# Sinónimos que se reducen a un mismo término para que la consulta del cliente coincida con la pregunta
+SINONIMOS = {
+    "cuesta": "costo", "cuestan": "costo", "precio": "costo", "vale": "costo", "sale": "costo", "cobran": "costo",
+    "soles": "costo", "caro": "costo",
+    "duele": "dolor", "doler": "dolor", "doloroso": "dolor", "indoloro": "dolor", "molestia": "dolor",
+    "demora": "tiempo", "tarda": "tiempo", "dura": "tiempo", "durar": "tiempo", "demorar": "tiempo",
+    "pelo": "cabello", "calvicie": "perdida", "caida": "perdida", "alopecia": "perdida",
+    "injerto": "trasplante", "implante": "trasplante", "operacion": "procedimiento", "cirugia": "procedimiento",
+    "recupero": "recuperarse", "recuperacion": "recuperarse",
+}
+
+def separar_preguntas_frecuentes(texto=PREGUNTAS_FRECUENTES):
+    """Divide el bloque de preguntas frecuentes en entradas "**n. pregunta**\\nrespuesta"."""
+    return [entrada.strip() for entrada in re.split(r"\n\s*\n(?=\*\*\d+\.)", texto) if entrada.strip()]
+
+def _terminos(texto):
+    terminos = []
+    for palabra in re.findall(r"[a-z0-9ñ]+", normalizar_texto(texto)):
+        if palabra in PALABRAS_VACIAS:
+            continue
+        palabra = SINONIMOS.get(palabra, palabra)
+        # Raíz mínima: se igualan singular y plural ("sesion"/"sesiones", "folículo"/"folículos")
+        if len(palabra) > 4 and palabra.endswith("es"):
+            palabra = palabra[:-2]
+        elif len(palabra) > 3 and palabra.endswith("s"):
+            palabra = palabra[:-1]
+        terminos.append(palabra)
+    return terminos
+
+class IndiceFAQ:
+    """
+    Índice BM25 local sobre las preguntas frecuentes de prompt_consulta.
+
+    Se construye una vez al importar el módulo; `relevantes` devuelve las `top_k` entradas más
+    parecidas a los últimos mensajes del cliente. Si ninguna alcanza `puntaje_minimo` se usa el
+    respaldo: el bloque completo de preguntas frecuentes ("completo", mismo contenido que
+    prompt_consulta_v4) o ninguna entrada ("ninguno").
+    """
+
+    def __init__(self, entradas, top_k=3, puntaje_minimo=1.0, respaldo="completo", mensajes_consulta=3, k1=1.5, b=0.75):
+        self.entradas = entradas
+        self.top_k = top_k
+        self.puntaje_minimo = puntaje_minimo
+        self.respaldo = respaldo
+        self.mensajes_consulta = mensajes_consulta
+        self.k1 = k1
+        self.b = b
+        self._documentos = [_terminos(entrada) for entrada in entradas]
+        self._longitud_media = sum(len(documento) for documento in self._documentos) / max(1, len(self._documentos))
+        frecuencia_documental = {}
+        for documento in self._documentos:
+            for termino in set(documento):
+                frecuencia_documental[termino] = frecuencia_documental.get(termino, 0) + 1
+        total = len(self._documentos)
+        self._idf = {
+            termino: math.log(1 + (total - frecuencia + 0.5) / (frecuencia + 0.5))
+            for termino, frecuencia in frecuencia_documental.items()
+        }
+
+    @classmethod
+    def desde_entorno(cls):
+        return cls(
+            separar_preguntas_frecuentes(),
+            top_k=int(os.getenv("FAQ_TOP_K", "3")),
+            puntaje_minimo=float(os.getenv("FAQ_PUNTAJE_MINIMO", "1.0")),
+            respaldo=os.getenv("FAQ_RESPALDO", "completo"),
+        )
+
+    def puntajes(self, consulta):
+        """Puntaje BM25 de cada entrada para el texto `consulta`."""
+        terminos = set(_terminos(consulta))
+        puntajes = []
+        for documento in self._documentos:
+            longitud = len(documento)
+            puntaje = 0.0
+            for termino in terminos:
+                frecuencia = documento.count(termino)
+                if not frecuencia:
+                    continue
+                normalizacion = self.k1 * (1 - self.b + self.b * longitud / self._longitud_media)
+                puntaje += self._idf[termino] * frecuencia * (self.k1 + 1) / (frecuencia + normalizacion)
+            puntajes.append(puntaje)
+        return puntajes
+
+    def consulta_conversacion(self, conversacion):
+        """Texto de búsqueda: los últimos mensajes del cliente de la conversación."""
+        interacciones = (conversacion or {}).get("interacciones", [])[-self.mensajes_consulta:]
+        return " ".join(interaccion.get("mensaje_cliente", "") or "" for interaccion in interacciones)
+
+    def relevantes(self, conversacion):
+        """Bloque de texto con las entradas relevantes para la conversación (o todas, como respaldo)."""
+        puntajes = self.puntajes(self.consulta_conversacion(conversacion))
+        ordenadas = sorted(range(len(self.entradas)), key=lambda indice: puntajes[indice], reverse=True)[:self.top_k]
+        if not ordenadas or puntajes[ordenadas[0]] < self.puntaje_minimo:
+            return PREGUNTAS_FRECUENTES if self.respaldo == "completo" else "(Ninguna relacionada con la conversación.)"
+        # Se conserva el orden original de las preguntas
+        return "\n\n".join(self.entradas[indice] for indice in sorted(ordenadas) if puntajes[indice] > 0)
+
+indice_faq = IndiceFAQ.desde_entorno()
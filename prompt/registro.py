@@ -0,0 +1,104 @@
+import os
+from helpers.helpers import contar_tokens
+from prompt.recuperacion_faq import indice_faq
+from prompt.prompt import (
+    prompt_consulta_v4_estatico, prompt_consulta_v4_dinamico,
+    prompt_consulta_v5_estatico, prompt_consulta_v5_dinamico,
+    prompt_intencion_respuesta_estatico, prompt_intencion_respuesta_dinamico,
+    prompt_intencionesv2, prompt_lead_estado, prompt_lead_estado_zoho,
+    prompt_cliente_nombre, prompt_resumen_conversacion,
+)
+
+class PlantillaPrompt:
+    """
+    Versión de un prompt dividida en una parte estática, armada una sola vez, y una parte dinámica
+    que depende del cliente, la fecha o la conversación. El conteo de tokens de la parte estática
+    se calcula al registrar la plantilla.
+    """
+
+    def __init__(self, nombre, version, estatico, dinamico):
+        self.nombre = nombre
+        self.version = version
+        self.estatico = estatico
+        self.dinamico = dinamico
+        self.tokens_estatico = contar_tokens(estatico) if estatico else 0
+
+    @property
+    def etiqueta(self):
+        """Nombre con versión (p. ej. "consulta_v4"), usado como clave de caché y en las métricas."""
+        return f"{self.nombre}_{self.version}"
+
+    def armar(self, **datos):
+        """Devuelve la tupla (estatico, dinamico) con los datos de la llamada."""
+        return self.estatico, self.dinamico(**datos)
+
+    def tokens(self, **datos):
+        """Tokens del prompt completo con los datos de la llamada, antes de enviarlo."""
+        return self.tokens_estatico + contar_tokens(self.dinamico(**datos))
+
+class RegistroPrompts:
+    """
+    Registro de los prompts por nombre y versión.
+
+    La versión usada por defecto es la registrada como predeterminada, salvo que se indique otra en la
+    variable de entorno PROMPT_<NOMBRE>_VERSION (p. ej. PROMPT_CONSULTA_VERSION=v4).
+    """
+
+    def __init__(self):
+        self._plantillas = {}
+        self._predeterminadas = {}
+
+    def registrar(self, nombre, version, estatico, dinamico, predeterminada=False):
+        plantilla = PlantillaPrompt(nombre, version, estatico, dinamico)
+        self._plantillas.setdefault(nombre, {})[version] = plantilla
+        if predeterminada or nombre not in self._predeterminadas:
+            self._predeterminadas[nombre] = version
+        return plantilla
+
+    def obtener(self, nombre, version=None):
+        version = version or os.getenv(f"PROMPT_{nombre.upper()}_VERSION") or self._predeterminadas.get(nombre)
+        try:
+            return self._plantillas[nombre][version]
+        except KeyError:
+            raise KeyError(f"No existe el prompt {nombre} en la versión {version}")
+
+    def versiones(self, nombre):
+        return list(self._plantillas.get(nombre, {}))
+
+    def resumen(self):
+        """Versiones registradas, versión por defecto y tokens de la parte estática de cada prompt."""
+        return {
+            nombre: {
+                "predeterminada": self._predeterminadas[nombre],
+                "versiones": {version: plantilla.tokens_estatico for version, plantilla in versiones.items()},
+            }
+            for nombre, versiones in self._plantillas.items()
+        }
+
+registro_prompts = RegistroPrompts()
+registro_prompts.registrar(
+    "consulta", "v4", prompt_consulta_v4_estatico(),
+    lambda cliente, conversacion=None: prompt_consulta_v4_dinamico(cliente),
+)
+# v5 solo incluye las preguntas frecuentes relevantes para la conversación (índice BM25 local)
+registro_prompts.registrar(
+    "consulta", "v5", prompt_consulta_v5_estatico(),
+    lambda cliente, conversacion=None: prompt_consulta_v5_dinamico(cliente, indice_faq.relevantes(conversacion)),
+    predeterminada=True,
+)
+registro_prompts.registrar(
+    "intencion_respuesta", "v1", prompt_intencion_respuesta_estatico(),
+    lambda cliente, fecha_actual: prompt_intencion_respuesta_dinamico(cliente, fecha_actual),
+)
+# Los prompts siguientes no tienen una parte fija que se pueda compartir entre clientes
+registro_prompts.registrar("intenciones", "v2", "", lambda fecha_actual: prompt_intencionesv2(fecha_actual))
+registro_prompts.registrar("lead_estado", "v1", "", lambda lead: prompt_lead_estado(lead))
+registro_prompts.registrar("lead_estado_zoho", "v1", "", lambda lead: prompt_lead_estado_zoho(lead))
+registro_prompts.registrar(
+    "cliente_nombre", "v1", "",
+    lambda cliente, response_message, conversacion_actual: prompt_cliente_nombre(cliente, response_message, conversacion_actual),
+)
+registro_prompts.registrar(
+    "resumen_conversacion", "v1", "",
+    lambda resumen_previo, interacciones: prompt_resumen_conversacion(resumen_previo, interacciones),
+)
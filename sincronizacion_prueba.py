@@ -0,0 +1,94 @@
+import os
+import tempfile
+import datetime as dt
+import httplib2
+from googleapiclient.errors import HttpError
+from components.calendar_component import GoogleCalendarManager
+from components.calendar_sync_component import CalendarSyncManager
+
+# Reproduce contra una API de Calendar simulada (páginas grabadas) la sincronización del espejo local:
+# lectura completa paginada, cambios incrementales con syncToken y relectura completa tras un 410.
+# Al final verifica que los horarios se calculan desde el espejo sin llamar a Google.
+
+CALENDAR_ID = GoogleCalendarManager.CALENDAR_ID
+
+def evento(id, inicio, fin, **extra):
+    return {"id": id, "start": {"dateTime": inicio}, "end": {"dateTime": fin}, **extra}
+
+# (syncToken, pageToken) -> respuesta de events().list, o el código HTTP de error que devuelve Google
+PAGINAS = {
+    (None, None): {"items": [evento("a", "2030-01-01T14:00:00-05:00", "2030-01-01T15:00:00-05:00"),
+                             evento("b", "2030-01-01T16:00:00-05:00", "2030-01-01T17:00:00-05:00")],
+                   "nextPageToken": "p2"},
+    (None, "p2"): {"items": [evento("c", "2030-01-03T18:00:00-05:00", "2030-01-03T19:00:00-05:00"),
+                             evento("d", "2030-01-01T18:00:00-05:00", "2030-01-01T19:00:00-05:00", transparency="transparent"),
+                             {"id": "e", "start": {"date": "2030-01-05"}, "end": {"date": "2030-01-06"}}],
+                   "nextSyncToken": "t1"},
+    # "b" se mueve al jueves, "c" se cancela y llega "f"
+    ("t1", None): {"items": [evento("b", "2030-01-03T14:00:00-05:00", "2030-01-03T15:00:00-05:00"),
+                             {"id": "c", "status": "cancelled"},
+                             evento("f", "2030-01-01T19:00:00-05:00", "2030-01-01T20:00:00-05:00")],
+                   "nextSyncToken": "t2"},
+    ("t2", None): 410,
+}
+
+class _Peticion:
+    def __init__(self, resultado):
+        self.resultado = resultado
+
+    def execute(self):
+        if isinstance(self.resultado, int):
+            raise HttpError(httplib2.Response({"status": self.resultado}), b"Sync token is no longer valid")
+        return self.resultado
+
+class _EventosGrabados:
+    def __init__(self, servicio):
+        self.servicio = servicio
+
+    def list(self, syncToken=None, pageToken=None, **kwargs):
+        self.servicio.llamadas.append((syncToken, pageToken))
+        return _Peticion(PAGINAS[(syncToken, pageToken)])
+
+class CalendarioGrabado:
+    def __init__(self):
+        self.llamadas = []
+
+    def events(self):
+        return _EventosGrabados(self)
+
+def ids_espejo(espejo):
+    with espejo._lock:
+        return sorted(fila[0] for fila in espejo._conexion.execute("SELECT id FROM eventos"))
+
+servicio = CalendarioGrabado()
+ruta = os.path.join(tempfile.mkdtemp(), "espejo.db")
+espejo = CalendarSyncManager(servicio, CALENDAR_ID, ruta=ruta)
+calendar = GoogleCalendarManager(service=servicio)
+calendar.usar_espejo(espejo)
+
+print("=== Lectura completa ===")
+fechas = espejo.sincronizar()
+print("Páginas pedidas:", servicio.llamadas)
+print("Eventos en el espejo:", ids_espejo(espejo), "(esperado: a, b, c, e)")
+print("Fechas afectadas:", sorted(fechas))
+
+print("=== Cambios incrementales ===")
+servicio.llamadas.clear()
+fechas = espejo.sincronizar()
+print("Páginas pedidas:", servicio.llamadas)
+print("Eventos en el espejo:", ids_espejo(espejo), "(esperado: a, b, e, f)")
+print("Fechas afectadas:", sorted(fechas), "(esperado: 2030-01-01 y 2030-01-03)")
+
+print("=== Horarios desde el espejo ===")
+servicio.llamadas.clear()
+print("Martes 2030-01-01:", calendar.listar_horarios_disponibles("2030-01-01"), "(esperado: 13:30-14:00, 15:00-19:00, 20:00-20:30)")
+print("Jueves 2030-01-03:", calendar.listar_horarios_disponibles("2030-01-03"), "(esperado: 13:30-14:00, 15:00-20:30)")
+print("Sábado 2030-01-05:", calendar.listar_horarios_disponibles("2030-01-05"), "(esperado: ninguno, evento de todo el día)")
+print("Llamadas a Calendar para calcular horarios:", len(servicio.llamadas), "(esperado: 0)")
+
+print("=== Token vencido (410) ===")
+servicio.llamadas.clear()
+espejo.sincronizar()
+print("Páginas pedidas:", servicio.llamadas, "(esperado: t2 y luego la lectura completa)")
+print("Eventos en el espejo:", ids_espejo(espejo), "(esperado: a, b, c, e)")
+print(espejo.metricas())
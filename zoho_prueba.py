@@ -15,4 +15,9 @@ leads_formateados = zoho_manager.obtener_leads_formateados(limit=1)
 for lead in leads_formateados:
     print(lead)
 
-print(zoho_manager.obtener_todos_los_leads(limit=1))
\ No newline at end of file
+print(zoho_manager.obtener_todos_los_leads(limit=1))
+# Recorrer todos los leads página a página, trayendo solo los campos necesarios
+total = 0
+for lead in zoho_manager.iterar_leads(campos=["First_Name", "Last_Name", "Mobile"]):
+    total += 1
+print("Leads recorridos:", total)